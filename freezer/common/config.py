@@ -63,6 +63,7 @@ DEFAULT_PARAMS = {
     'download_limit': -1, 'hostname': None, 'remove_from_date': None,
     'restart_always_level': False, 'lvm_dirmount': None,
     'rsync_block_size': 4096, 'dereference_symlink': None,
+    'rsync_workers': 1, 'rsync_workers_type': 'thread', 'scan_workers': 1,
     'config': None, 'mysql_conf': False,
     'insecure': False, 'lvm_snapname': None,
     'lvm_snapperm': 'ro', 'snapshot': None,
@@ -74,6 +75,9 @@ DEFAULT_PARAMS = {
     'nova_inst_id': '', '__version__': FREEZER_VERSION,
     'nova_inst_name': '',
     'remove_older_than': None, 'restore_from_date': None,
+    'restore_path_filter': None, 'synthetic_full': False,
+    'upload_workers': 4, 'swift_slo': False, 'download_workers': 4,
+    'backup_catalog': None, 'backup_catalog_ttl': 300, 'delete_workers': 4,
     'upload_limit': -1, 'always_level': False, 'version': None,
     'dry_run': False, 'lvm_snapsize': DEFAULT_LVM_SNAPSIZE,
     'restore_abs_path': None, 'log_file': None, 'log_level': "info",
@@ -81,15 +85,18 @@ DEFAULT_PARAMS = {
     'windows_volume': '', 'command': None, 'metadata_out': None,
     'storage': 'swift', 'ssh_key': os.path.join(home, '.ssh/id_rsa'),
     'ssh_username': '', 'ssh_password': '', 'ssh_host': '',
-    'ssh_port': DEFAULT_SSH_PORT,
+    'ssh_port': DEFAULT_SSH_PORT, 'ssh_channels': 1,
     'access_key': '', 'secret_key': '', 'endpoint': '',
+    'listing_cache_ttl': 0, 'storages_replication': 'sync',
+    'replication_journal': None, 'replication_wait': False,
+    'local_sync_interval': 0,
     'compression': 'gzip', 'overwrite': False,
     'incremental': None, 'consistency_check': False,
     'consistency_checksum': None, 'nova_restore_network': None,
     'cindernative_backup_id': None, 'sync': True, 'engine_name': 'tar',
     'timeout': 120, 'project_id': None, 'ftp_username': '',
     'ftp_password': '', 'ftp_host': '', 'ftp_port': DEFAULT_FTP_PORT,
-    'ftp_keyfile': '', 'ftp_certfile': '',
+    'ftp_keyfile': '', 'ftp_certfile': '', 'dedup_chunk_size': 1048576,
 }
 
 _COMMON = [
@@ -126,7 +133,8 @@ _COMMON = [
                     "nova(OpenStack Instance). Default set to fs"),
     cfg.StrOpt('engine',
                short='e',
-               choices=['tar', 'rsync', 'rsyncv2', 'nova', 'osbrick'],
+               choices=['tar', 'rsync', 'rsyncv2', 'dedup', 'nova',
+                        'osbrick'],
                dest='engine_name',
                default=DEFAULT_PARAMS['engine_name'],
                help="Engine to be used for backup/restore. "
@@ -136,9 +144,12 @@ _COMMON = [
                     "blocks changes will be verified and only the changed "
                     "blocks will be backed up. Tar is faster, but is uses "
                     "more space and bandwidth. Rsync is slower, but uses "
-                    "less space and bandwidth. Nova engine can be used to"
-                    " backup/restore running instances. Backing up instances"
-                    " and it's metadata.",
+                    "less space and bandwidth. With dedup, the files are "
+                    "split in content defined chunks and every chunk is "
+                    "stored only once, so a level 0 only uploads the "
+                    "chunks missing in the storage. Nova engine can be "
+                    "used to backup/restore running instances. Backing up "
+                    "instances and it's metadata.",
                required=True
                ),
     cfg.StrOpt('container',
@@ -241,6 +252,15 @@ _COMMON = [
                     "than the provided datetime in the form "
                     "'YYYY-MM-DDThh:mm:ss' i.e. '1974-03-25T23:23:23'. "
                     "Make sure the 'T' is between date and time "),
+    cfg.BoolOpt('synthetic-full',
+                dest='synthetic_full',
+                default=DEFAULT_PARAMS['synthetic_full'],
+                help="With the admin action, merge the latest level 0 backup "
+                     "and its increments in a new level 0 backup, built from "
+                     "the stored backups only. The following backups are "
+                     "increments of the new level 0. Only supported by the "
+                     "rsyncv2 engine. Default False (Disabled)"
+                ),
     cfg.StrOpt('no-incremental',
                dest='no_incremental',
                default=DEFAULT_PARAMS['no_incremental'],
@@ -306,12 +326,51 @@ _COMMON = [
                dest='rsync_block_size',
                help="Set the data block size of used by rsync to "
                     "generate signature. Default 4096 bytes (4K)."),
+    cfg.IntOpt('rsync-workers',
+               default=DEFAULT_PARAMS['rsync_workers'],
+               dest='rsync_workers',
+               min=1,
+               help="Set the number of workers used by the rsyncv2 engine "
+                    "to compute files deltas and signatures concurrently. "
+                    "The backup data is still streamed in the same order. "
+                    "On restore, the number of threads writing the files "
+                    "and setting their inode. Default 1 (no workers pool)."),
+    cfg.StrOpt('rsync-workers-type',
+               choices=['thread', 'process'],
+               default=DEFAULT_PARAMS['rsync_workers_type'],
+               dest='rsync_workers_type',
+               help="Set the type of workers used by the rsyncv2 engine "
+                    "when --rsync-workers is greater than 1. Default thread."),
+    cfg.IntOpt('scan-workers',
+               default=DEFAULT_PARAMS['scan_workers'],
+               dest='scan_workers',
+               min=1,
+               help="Set the number of threads used by the rsync, rsyncv2 "
+                    "and dedup engines to stat the files of a directory "
+                    "concurrently while scanning the tree to backup. Useful "
+                    "on high latency filesystems such as NFS. Default 1."),
+    cfg.IntOpt('dedup-chunk-size',
+               default=DEFAULT_PARAMS['dedup_chunk_size'],
+               dest='dedup_chunk_size',
+               min=4096,
+               help="Set the average size of the chunks used by the dedup "
+                    "engine. Default 1048576 bytes (1MB)."),
     cfg.StrOpt('restore-abs-path',
                dest='restore_abs_path',
                default=DEFAULT_PARAMS['restore_abs_path'],
                help="Set the absolute path where you want your data restored. "
                     "Default False."
                ),
+    cfg.StrOpt('restore-path-filter',
+               dest='restore_path_filter',
+               default=DEFAULT_PARAMS['restore_path_filter'],
+               help="Restore only the paths matching one of these comma "
+                    "separated patterns, relative to the root of the backup, "
+                    "with the content of the matching directories. Only "
+                    "supported by the rsync engine, the restores of the other "
+                    "engines are rejected. The data of the backups with a "
+                    "data index is read by ranges from the storage."
+               ),
     cfg.StrOpt('restore-from-date',
                dest='restore_from_date',
                default=DEFAULT_PARAMS['restore_from_date'],
@@ -366,6 +425,68 @@ _COMMON = [
                 default=DEFAULT_PARAMS['dry_run'],
                 help="Do everything except writing or removing objects"
                 ),
+    cfg.IntOpt('upload-workers',
+               dest='upload_workers',
+               min=1,
+               default=DEFAULT_PARAMS['upload_workers'],
+               help="Set the number of segments uploaded concurrently to the "
+                    "swift storage, or of parts to the s3 storage, each one "
+                    "on its own connection. Up to this number of segments "
+                    "are held in memory. Default 4."
+               ),
+    cfg.BoolOpt('swift-slo',
+                dest='swift_slo',
+                default=DEFAULT_PARAMS['swift_slo'],
+                help="Upload the backups to swift as static large objects, "
+                     "whose manifest lists the segments with their etag and "
+                     "size, instead of dynamic large objects that depend on "
+                     "the listing of the segments container. The backups of "
+                     "more than 1000 segments are still uploaded as dynamic "
+                     "large objects. Default False (Disabled)"
+                ),
+    cfg.StrOpt('backup-catalog',
+               dest='backup_catalog',
+               default=DEFAULT_PARAMS['backup_catalog'],
+               help="Path of a local SQLite catalog of the backups, shared "
+                    "by the agents of the node. The backups written are "
+                    "recorded in it, and the backups of a backup name are "
+                    "listed from the storage only the first time they are "
+                    "looked up, then for the level selection, the restore "
+                    "from date, the retention and the info action they are "
+                    "read from the catalog. Default None (Disabled)."
+               ),
+    cfg.IntOpt('backup-catalog-ttl',
+               dest='backup_catalog_ttl',
+               min=0,
+               default=DEFAULT_PARAMS['backup_catalog_ttl'],
+               help="Set the number of seconds after which the backups "
+                    "listed in the backup catalog are listed again from the "
+                    "storage, to see the backups written or removed by other "
+                    "nodes. With 0, they are listed again only when a "
+                    "backup of the catalog is missing from the storage. "
+                    "Default 300."
+               ),
+    cfg.IntOpt('delete-workers',
+               dest='delete_workers',
+               min=1,
+               default=DEFAULT_PARAMS['delete_workers'],
+               help="Set the number of deletion requests sent concurrently "
+                    "to the swift and s3 storages when removing backups. "
+                    "The objects are deleted by batches with the swift bulk "
+                    "delete middleware or the s3 DeleteObjects requests when "
+                    "available, one by one otherwise. Default 4."
+               ),
+    cfg.IntOpt('download-workers',
+               dest='download_workers',
+               min=1,
+               default=DEFAULT_PARAMS['download_workers'],
+               help="Set the number of segments downloaded concurrently from "
+                    "the swift storage, or of ranges of max-segment-size "
+                    "bytes from the s3 storage, on restore. Up to this number "
+                    "of segments are held in memory. With multiple storages "
+                    "it can be set in the section of every storage. "
+                    "Default 4."
+               ),
     cfg.IntOpt('upload-limit',
                dest='upload_limit',
                default=DEFAULT_PARAMS['upload_limit'],
@@ -460,6 +581,50 @@ _COMMON = [
                default=DEFAULT_PARAMS['endpoint'],
                help="Endpoint of S3 compatible storage"
                ),
+    cfg.IntOpt('listing-cache-ttl',
+               dest='listing_cache_ttl',
+               min=0,
+               default=DEFAULT_PARAMS['listing_cache_ttl'],
+               help="Set the number of seconds during which a listing of the "
+                    "S3 compatible storage is reused, the listings are "
+                    "invalidated when the agent writes or deletes objects. "
+                    "Default 0, disabled."
+               ),
+    cfg.IntOpt('local-sync-interval',
+               dest='local_sync_interval',
+               min=0,
+               default=DEFAULT_PARAMS['local_sync_interval'],
+               help="Set the number of bytes of a backup written to the local "
+                    "storage between two syncs of the data to the disk. "
+                    "Default 0, the data is left to the page cache."
+               ),
+    cfg.StrOpt('storages-replication',
+               dest='storages_replication',
+               choices=['sync', 'async'],
+               default=DEFAULT_PARAMS['storages_replication'],
+               help="Set how the backups are written to multiple storages. "
+                    "With sync, the backups are written to all the storages "
+                    "at once. With async, they are written to the first "
+                    "storage, then copied to the other storages in the "
+                    "background, the copies interrupted are resumed by the "
+                    "next backup. Default sync."
+               ),
+    cfg.StrOpt('replication-journal',
+               dest='replication_journal',
+               default=DEFAULT_PARAMS['replication_journal'],
+               help="Path of the journal of the pending copies of the async "
+                    "replication of the storages. The agents running "
+                    "concurrently must use different journals. Default "
+                    "~/.freezer/replication.json."
+               ),
+    cfg.BoolOpt('replication-wait',
+                dest='replication_wait',
+                default=DEFAULT_PARAMS['replication_wait'],
+                help="With the async replication of the storages, wait for "
+                     "the copies of the backups to the other storages before "
+                     "exiting. Otherwise the copies not finished are left to "
+                     "the next backup. Default False (Disabled)"
+                ),
     cfg.StrOpt('ssh-key',
                dest='ssh_key',
                default=DEFAULT_PARAMS['ssh_key'],
@@ -486,6 +651,15 @@ _COMMON = [
                help="Remote port for SSH(SFTP) storage"
                     " only (default 22)"
                ),
+    cfg.IntOpt('ssh-channels',
+               dest='ssh_channels',
+               min=1,
+               default=DEFAULT_PARAMS['ssh_channels'],
+               help="Number of SFTP channels the segments of a backup are "
+                    "written and read on concurrently, for SSH(SFTP) "
+                    "storage only. Up to this number of segments are held "
+                    "in memory. Default 1."
+               ),
     cfg.StrOpt('config',
                dest='config',
                default=DEFAULT_PARAMS['config'],
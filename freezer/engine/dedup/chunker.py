@@ -0,0 +1,143 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content defined chunking.
+
+The chunk boundaries are placed where the sum of a random value per byte
+over the last WINDOW_SIZE bytes has all the mask bits set to zero. As the
+boundaries only depend on the content, inserting or removing data only
+changes the chunks around the modified region.
+
+The rolling sums are computed for a whole buffer at once, packing one sum
+per 48 bits lane of a python long, so that the work per byte is done by the
+interpreter C loops.
+"""
+
+import hashlib
+
+import six
+
+from freezer.utils import utils
+
+# Number of bytes used to compute the rolling sum
+WINDOW_SIZE = 64
+# Number of bytes read from the file at once
+READ_SIZE = 1024 * 1024
+# Number of bytes scanned at once, bounds the memory used by a scan
+SCAN_SIZE = 1024 * 1024
+# Size in bytes of the lane holding the rolling sum of one offset
+LANE_SIZE = 6
+# Largest supported boundary mask
+MAX_MASK = (1 << 24) - 1
+
+GEAR_TABLE = tuple(
+    int(hashlib.md5(six.int2byte(i)).hexdigest()[:8], 16) for i in range(256))
+
+# GEAR_TABLE split in four translation tables, one per byte of the values
+GEAR_BYTES = tuple(
+    bytes(bytearray((value >> (8 * i)) & 0xff for value in GEAR_TABLE))
+    for i in range(4))
+
+
+def chunk_limits(avg_size):
+    """Return the minimum size, the maximum size and the boundary mask
+    used to obtain chunks of about avg_size bytes.
+
+    :param avg_size: requested average chunk size
+    :return: tuple (min_size, max_size, mask)
+    """
+    mask = min((1 << (max(avg_size, WINDOW_SIZE).bit_length() - 1)) - 1,
+               MAX_MASK)
+    min_size = max((mask + 1) // 4, WINDOW_SIZE)
+    return min_size, (mask + 1) * 4, mask
+
+
+def _scan(window, mask):
+    """Return the flags of the offsets of window from WINDOW_SIZE - 1"""
+    count = len(window)
+    lane_bits = LANE_SIZE * 8
+    lanes = bytearray(count * LANE_SIZE)
+    for index, table in enumerate(GEAR_BYTES):
+        lanes[index::LANE_SIZE] = window.translate(table)
+    sums = utils.bytes_to_long(lanes)
+
+    # After the loop every lane holds the sum of itself and of the
+    # previous WINDOW_SIZE - 1 lanes
+    width = 1
+    while width < WINDOW_SIZE:
+        sums += sums << (lane_bits * width)
+        width *= 2
+
+    # A lane not equal to zero once masked overflows in the bit mask_bits
+    # adding the mask to it
+    mask_bits = mask.bit_length()
+    ones = utils.bytes_to_long(b'\x01'.ljust(LANE_SIZE, b'\x00') * count)
+    flags = (((sums & (ones * mask)) + ones * mask) >> mask_bits) & ones
+    flags = utils.long_to_bytes(flags, count * LANE_SIZE)[::LANE_SIZE]
+    return flags[WINDOW_SIZE - 1:]
+
+
+def window_flags(data, start, mask):
+    """Compute the boundary flags of data from the start offset.
+
+    The flag of the offset i is zero when a chunk may end after data[i].
+
+    :param data: bytes to scan
+    :param start: first offset to scan, at least WINDOW_SIZE - 1
+    :param mask: boundary mask
+    :rtype: bytearray
+    """
+    flags = bytearray()
+    for offset in range(start, len(data), SCAN_SIZE):
+        flags += _scan(data[offset - WINDOW_SIZE + 1:offset + SCAN_SIZE],
+                       mask)
+    return flags
+
+
+def chunks(instream, avg_size):
+    """Split the content of instream in content defined chunks.
+
+    :param instream: file like object open in binary mode
+    :param avg_size: average chunk size
+    :return: generator of chunks
+    """
+    min_size, max_size, mask = chunk_limits(avg_size)
+    data = b''
+    flags = bytearray()
+    eof = False
+    while True:
+        index = flags.find(b'\x00', min_size - 1, max_size)
+        if index >= 0:
+            cut = index + 1
+        elif len(data) >= max_size:
+            cut = max_size
+        elif not eof:
+            block = instream.read(READ_SIZE)
+            if not block:
+                eof = True
+                continue
+            start = len(data)
+            data += block
+            # the first bytes have not enough context to be a boundary, they
+            # are always shorter than min_size
+            padding = max(min(WINDOW_SIZE - 1, len(data)) - start, 0)
+            flags += b'\x01' * padding
+            flags += window_flags(data, start + padding, mask)
+            continue
+        elif data:
+            cut = len(data)
+        else:
+            return
+        yield data[:cut]
+        data = data[cut:]
+        del flags[:cut]
@@ -0,0 +1,752 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Freezer content defined chunking deduplication engine
+"""
+
+import collections
+import getpass
+import grp
+import hashlib
+import hmac
+import operator
+import os
+import pwd
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import uuid
+
+import msgpack
+from oslo_log import log
+import six
+
+from freezer.engine.dedup import chunker
+from freezer.engine import engine
+from freezer.storage import base
+from freezer.utils import compress
+from freezer.utils import crypt
+from freezer.utils import scanner
+from freezer.utils import streaming
+from freezer.utils import utils
+
+LOG = log.getLogger(__name__)
+
+# Version of the meta data structure format
+DEDUP_DATA_STRUCT_VERSION = 1
+# Directory of the storage holding the chunks of every backup
+CHUNKS_DIR = 'chunks'
+# Name of the object holding the chunk data in the chunk directory
+CHUNK_OBJECT = 'chunk'
+# Number of chunks kept in memory during a restore
+RESTORE_CACHE_SIZE = 8
+# Directory of the storage holding a marker per dedup backup in progress
+IN_PROGRESS_DIR = 'dedup_in_progress'
+# Name of the object of a marker in its directory
+MARKER_OBJECT = 'marker'
+# Seconds after which the marker of a backup is considered left by an agent
+# that died, so that it no longer prevents the removal of the chunks
+IN_PROGRESS_TTL = 2 * 86400
+# Name of the directory of a backup in its chain: <level>_<timestamp>
+BACKUP_DIR_RE = re.compile(r'^(\d+)_(\d+)$')
+
+
+class ChunkPool(object):
+    """
+    Chunks stored in a physical storage under their content hash.
+
+    Every chunk is stored in CHUNKS_DIR/<compression>/<id[:2]>/<id>/chunk
+    so that the chunks are shared by all the backups of the storage and the
+    existing ones can be listed on every kind of storage.
+
+    :type storage: freezer.storage.physical.PhysicalStorage
+    """
+
+    def __init__(self, storage, compression_algo):
+        self.storage = storage
+        self.path = utils.path_join(storage.storage_path, CHUNKS_DIR,
+                                    compression_algo)
+        self._listed = {}
+
+    def chunk_path(self, chunk_id):
+        return utils.path_join(self.path, chunk_id[:2], chunk_id)
+
+    def exists(self, chunk_id):
+        """Check if the chunk is stored, listing the chunks with the same
+        prefix only once.
+
+        :param chunk_id: chunk content hash
+        :rtype: bool
+        """
+        prefix = chunk_id[:2]
+        if prefix not in self._listed:
+            self._listed[prefix] = set(self.storage.listdir(
+                utils.path_join(self.path, prefix)))
+        return chunk_id in self._listed[prefix]
+
+    def put(self, chunk_id, from_path):
+        path = self.chunk_path(chunk_id)
+        self.storage.create_dirs(path)
+        self.storage.put_file(from_path, utils.path_join(path, CHUNK_OBJECT))
+        self._listed.setdefault(chunk_id[:2], set()).add(chunk_id)
+
+    def refresh(self):
+        """Forget the chunks listed, to list them again"""
+        self._listed = {}
+
+    def get(self, chunk_id, to_path):
+        self.storage.get_file(
+            utils.path_join(self.chunk_path(chunk_id), CHUNK_OBJECT), to_path)
+
+    def list(self):
+        """:return: set of the ids of the stored chunks"""
+        chunk_ids = set()
+        for prefix in self.storage.listdir(self.path):
+            chunk_ids.update(self.storage.listdir(
+                utils.path_join(self.path, prefix)))
+        return chunk_ids
+
+    def remove(self, chunk_id):
+        self.storage.rmtree(self.chunk_path(chunk_id))
+        self._listed.get(chunk_id[:2], set()).discard(chunk_id)
+
+
+class DedupEngine(engine.BackupEngine):
+    """
+    Split the regular files in content defined chunks and upload every
+    chunk only once. The backup data is the manifest of the backed up
+    tree: every backup, incremental or not, lists all the files and their
+    chunks, so only the last level has to be restored.
+
+    Freezer dedup manifest data structure::
+
+        [ {
+            'path': '' (path to file),
+            'inode': {
+                'mode': st_mode,
+                'uid': st_uid,
+                'gid': st_gid,
+                'uname': username,
+                'gname': groupname,
+                'atime': st_atime,
+                'mtime': st_mtime,
+                'size': st_size
+            },
+            'lname': 'link_name' (if symlink),
+            'rdev': st_rdev (if block or character device),
+            'chunks': [[chunk_id, chunk_size], ...] (if regular file)
+          },
+          ...
+        ]
+    """
+
+    def __init__(self, **kwargs):
+        self.compression_algo = kwargs.get('compression')
+        self.encrypt_pass_file = kwargs.get('encrypt_key', None)
+        self.exclude = kwargs.get('exclude')
+        self.storage = kwargs.get('storage')
+        self.dry_run = kwargs.get('dry_run', False)
+        self.max_segment_size = kwargs.get('max_segment_size')
+        self.chunk_size = kwargs.get('dedup_chunk_size')
+        self.scan_workers = kwargs.get('scan_workers') or 1
+        # (storage, path) of the in progress markers of the backup
+        self._markers = []
+        super(DedupEngine, self).__init__(storage=kwargs.get('storage'))
+
+    @property
+    def name(self):
+        return "dedup"
+
+    def metadata(self, *args):
+        return {
+            "engine_name": self.name,
+            "compression": self.compression_algo,
+            "dedup_chunk_size": self.chunk_size,
+            # the encrypt_pass_file might be key content so we need to convert
+            # to boolean
+            "encryption": bool(self.encrypt_pass_file)
+        }
+
+    def restore_levels(self, backups):
+        # Every level lists the whole backed up tree
+        return [max(backups.keys())]
+
+    def backup(self, *args, **kwargs):
+        """Back up, keeping the in progress markers written by backup_data
+        until the metadata of the backup is stored.
+        """
+        try:
+            return super(DedupEngine, self).backup(*args, **kwargs)
+        finally:
+            self._remove_markers()
+
+    @staticmethod
+    def _markers_path(storage):
+        return utils.path_join(storage.storage_path, IN_PROGRESS_DIR)
+
+    def _add_markers(self, storages, tmpdir):
+        """Mark a backup in progress on the storages, before any chunk is
+        uploaded, so that its chunks are not removed until it is stored.
+        """
+        marker_id = '{0}_{1}'.format(int(time.time()), uuid.uuid4().hex)
+        marker_file = os.path.join(tmpdir, MARKER_OBJECT)
+        with open(marker_file, 'w') as marker_fd:
+            marker_fd.write(marker_id)
+        for storage in storages:
+            path = utils.path_join(self._markers_path(storage), marker_id)
+            storage.create_dirs(path)
+            storage.put_file(marker_file,
+                             utils.path_join(path, MARKER_OBJECT))
+            self._markers.append((storage, path))
+
+    def _remove_markers(self):
+        markers, self._markers = self._markers, []
+        for storage, path in markers:
+            try:
+                storage.rmtree(path)
+            except Exception as e:
+                LOG.warning('Unable to remove the dedup backup marker {0}, '
+                            'it expires in {1} seconds: {2}'.format(
+                                path, IN_PROGRESS_TTL, e))
+
+    def _backups_in_progress(self, storage):
+        """
+        :return: the names of the markers of the dedup backups in progress
+                 on the storage, except the expired ones
+        """
+        oldest = time.time() - IN_PROGRESS_TTL
+        in_progress = []
+        for name in storage.listdir(self._markers_path(storage)):
+            try:
+                started = int(name.split('_', 1)[0])
+            except ValueError:
+                continue
+            if started >= oldest:
+                in_progress.append(name)
+            else:
+                LOG.warning('Ignoring the expired dedup backup marker '
+                            '{0}'.format(name))
+        return in_progress
+
+    def backup_data(self, backup_path, manifest_path):
+        """Upload the chunks missing in the storage and return the manifest
+        of the backed up tree.
+
+        The files not modified since the backup described in manifest_path
+        are not read again.
+
+        :param backup_path: Path to backup
+        :param manifest_path: Path to backup metadata
+        """
+        LOG.info('Starting dedup engine backup stream')
+
+        old_files, chunk_size = self.get_fs_meta_struct(manifest_path)
+        if chunk_size and chunk_size != self.chunk_size:
+            LOG.warning('[*] Incremental backup will be performed '
+                        'with dedup_chunk_size={}'.format(chunk_size))
+            self.chunk_size = chunk_size
+
+        files_meta = {
+            'files': {},
+            'platform': sys.platform,
+            'abs_backup_path': os.getcwd(),
+            'dedup_struct_ver': DEDUP_DATA_STRUCT_VERSION,
+            'dedup_chunk_size': self.chunk_size}
+
+        counts = {
+            'total_files': 0,
+            'total_dirs': 0,
+            'unchanged_files': 0,
+            'total_chunks': 0,
+            'uploaded_chunks': 0,
+            'uploaded_size': 0,
+            'backup_size_on_disk': 0,
+        }
+
+        storages = getattr(self.storage, 'storages', [self.storage])
+        pools = [ChunkPool(storage, self.compression_algo)
+                 for storage in storages]
+        # The chunks referenced by the previous backup are already stored
+        known_chunks = set(chunk_id for meta in six.itervalues(old_files)
+                           for chunk_id, size in meta['chunks'])
+        chunk_key = self._get_chunk_key()
+
+        manifest = []
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self._add_markers(storages, tmpdir)
+            chunk_file = os.path.join(tmpdir, CHUNK_OBJECT)
+            for rel_path, dir_entry in self._walk(backup_path):
+                entry, os_stat = self._get_entry(rel_path, dir_entry)
+                if not entry:
+                    continue
+                file_mode = entry['inode']['mode']
+                if stat.S_ISDIR(file_mode):
+                    counts['total_dirs'] += 1
+                elif stat.S_ISREG(file_mode):
+                    counts['total_files'] += 1
+                    counts['backup_size_on_disk'] += entry['inode']['size']
+                    file_meta = self._backup_reg_file(
+                        rel_path, os_stat, old_files.get(rel_path), pools,
+                        known_chunks, chunk_key, chunk_file, counts)
+                    files_meta['files'][rel_path] = file_meta
+                    entry['chunks'] = file_meta['chunks']
+                else:
+                    counts['total_files'] += 1
+                manifest.append(entry)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self._check_chunks(files_meta['files'], pools)
+        LOG.info("Backup session metrics: {0}".format(counts))
+
+        self.write_engine_meta(manifest_path, files_meta)
+
+        data = compress.one_shot_compress(self.compression_algo,
+                                          msgpack.dumps(manifest))
+        if self.encrypt_pass_file:
+            cipher = crypt.AESEncrypt(self.encrypt_pass_file)
+            data = cipher.generate_header() + cipher.encrypt(data)
+
+        segments = streaming.SegmentBuilder(self.max_segment_size)
+        for segment in segments.add(data):
+            yield segment
+        segment = segments.flush()
+        if segment:
+            yield segment
+
+        LOG.info("Dedup engine backup stream completed")
+
+    def remove_unreferenced_data(self, storage):
+        """Remove the chunks that no remaining dedup backup references.
+
+        The chunks are shared by the backups of every name, so all the
+        dedup backups of the storage are read before any chunk is removed.
+        The storage is skipped while a dedup backup is in progress on it, or
+        if one of its backups is incomplete.
+
+        :type storage: freezer.storage.base.Storage
+        """
+        for physical in getattr(storage, 'storages', [storage]):
+            if self._backups_in_progress(physical):
+                LOG.info('Dedup backups in progress on the {0} storage, its '
+                         'chunks are not removed'.format(physical.type))
+                continue
+            try:
+                referenced = self._referenced_chunks(physical)
+            except Exception as e:
+                LOG.warning('Unable to read the dedup backups of the {0} '
+                            'storage, its chunks are not removed: '
+                            '{1}'.format(physical.type, e))
+                continue
+
+            removed = 0
+            for compression_algo in physical.listdir(utils.path_join(
+                    physical.storage_path, CHUNKS_DIR)):
+                pool = ChunkPool(physical, compression_algo)
+                unreferenced = pool.list() - referenced[compression_algo]
+                if unreferenced and self._backups_in_progress(physical):
+                    LOG.info('A dedup backup started on the {0} storage, '
+                             'its chunks are not removed'.format(
+                                 physical.type))
+                    break
+                for chunk_id in sorted(unreferenced):
+                    pool.remove(chunk_id)
+                removed += len(unreferenced)
+            LOG.info('Removed {0} unreferenced chunks of the {1} '
+                     'storage'.format(removed, physical.type))
+
+    def _referenced_chunks(self, storage):
+        """Read the chunks referenced by the dedup backups of a storage.
+
+        :type storage: freezer.storage.physical.PhysicalStorage
+        :return: dictionary of the sets of chunk ids, by compression
+        """
+        referenced = collections.defaultdict(set)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            engine_meta = os.path.join(tmpdir, 'engine_meta')
+            for backup in self._stored_backups(storage):
+                compression_algo = backup.metadata().get('compression')
+                storage.get_file(backup.engine_metadata_path, engine_meta)
+                files_meta = self._read_files_meta(engine_meta,
+                                                   compression_algo)
+                for meta in six.itervalues(files_meta.get('files', {})):
+                    referenced[compression_algo].update(
+                        chunk_id for chunk_id, size in meta['chunks'])
+        finally:
+            shutil.rmtree(tmpdir)
+        return referenced
+
+    def _stored_backups(self, storage):
+        """Yield the backups of the engine in a storage, whatever their
+        name.
+
+        :type storage: freezer.storage.physical.PhysicalStorage
+        :rtype: collections.Iterable[freezer.storage.base.Backup]
+        """
+        data_path = utils.path_join(storage.storage_path, 'data', self.name)
+        pending = [[]]
+        while pending:
+            parts = pending.pop()
+            for name in storage.listdir(utils.path_join(data_path, *parts)):
+                match = BACKUP_DIR_RE.match(name)
+                if match and len(parts) >= 2:
+                    yield base.Backup(
+                        engine=self,
+                        hostname_backup_name='/'.join(parts[:-1]),
+                        level_zero_timestamp=int(parts[-1]),
+                        timestamp=int(match.group(2)),
+                        level=int(match.group(1)),
+                        storage=storage)
+                else:
+                    pending.append(parts + [name])
+
+    @staticmethod
+    def _check_chunks(files, pools):
+        """Check that the chunks of a backup are all stored, the chunks
+        known from the previous backup could have been removed since.
+        """
+        chunk_ids = set(chunk_id for meta in six.itervalues(files)
+                        for chunk_id, size in meta['chunks'])
+        for pool in pools:
+            pool.refresh()
+            missing = [chunk_id for chunk_id in chunk_ids
+                       if not pool.exists(chunk_id)]
+            if missing:
+                raise Exception(
+                    '[*] {0} chunks of the backup are missing from the {1} '
+                    'storage, they were removed during the backup'.format(
+                        len(missing), pool.storage.type))
+
+    def _walk(self, backup_path):
+        """Yield the relative path and the scanner entry of every file and
+        directory of backup_path, sorted by name in every directory.
+        """
+        if not os.path.isdir(backup_path):
+            yield backup_path, None
+            return
+
+        by_name = operator.attrgetter('name')
+        for dir_path, dirs, files in scanner.walk(
+                backup_path, self.exclude, workers=self.scan_workers):
+            dirs.sort(key=by_name)
+            for entry in dirs:
+                yield os.path.relpath(entry.path, backup_path), entry
+
+            for entry in sorted(files, key=by_name):
+                yield os.path.relpath(entry.path, backup_path), entry
+
+    @staticmethod
+    def _get_entry(rel_path, dir_entry=None):
+        try:
+            if dir_entry is not None:
+                os_stat = dir_entry.stat(follow_symlinks=False)
+            else:
+                os_stat = os.lstat(rel_path)
+        except (OSError, IOError) as error:
+            raise Exception('[*] Error on file stat: {}'.format(error))
+
+        file_mode = os_stat.st_mode
+        if stat.S_ISSOCK(file_mode):
+            return None, os_stat
+
+        try:
+            uname = scanner.get_user_name(os_stat.st_uid)
+        except KeyError:
+            uname = None
+        try:
+            gname = scanner.get_group_name(os_stat.st_gid)
+        except KeyError:
+            gname = None
+
+        entry = {
+            'path': rel_path,
+            'inode': {
+                'mode': file_mode,
+                'uid': os_stat.st_uid,
+                'gid': os_stat.st_gid,
+                'uname': uname,
+                'gname': gname,
+                'atime': os_stat.st_atime,
+                'mtime': os_stat.st_mtime,
+                'size': os_stat.st_size
+            }
+        }
+
+        if stat.S_ISLNK(file_mode):
+            entry['lname'] = os.readlink(rel_path)
+        elif stat.S_ISBLK(file_mode) or stat.S_ISCHR(file_mode):
+            entry['rdev'] = os_stat.st_rdev
+
+        return entry, os_stat
+
+    def _backup_reg_file(self, rel_path, os_stat, old_file_meta, pools,
+                         known_chunks, chunk_key, chunk_file, counts):
+        """Upload the missing chunks of a regular file.
+
+        :return: the file meta data with the list of its chunks
+        """
+        file_meta = {
+            'mode': os_stat.st_mode,
+            'ctime': os_stat.st_ctime,
+            'mtime': os_stat.st_mtime,
+            'size': os_stat.st_size
+        }
+
+        if old_file_meta and all(old_file_meta.get(key) == value for
+                                 key, value in six.iteritems(file_meta)):
+            counts['unchanged_files'] += 1
+            counts['total_chunks'] += len(old_file_meta['chunks'])
+            file_meta['chunks'] = old_file_meta['chunks']
+            return file_meta
+
+        chunks = []
+        with open(rel_path, 'rb') as instream:
+            for data in chunker.chunks(instream, self.chunk_size):
+                chunk_id = self._get_chunk_id(data, chunk_key)
+                if chunk_id not in known_chunks:
+                    self._upload_chunk(chunk_id, data, pools, chunk_file,
+                                       counts)
+                    known_chunks.add(chunk_id)
+                chunks.append([chunk_id, len(data)])
+
+        counts['total_chunks'] += len(chunks)
+        file_meta['chunks'] = chunks
+        return file_meta
+
+    def _upload_chunk(self, chunk_id, data, pools, chunk_file, counts):
+        missing = [pool for pool in pools if not pool.exists(chunk_id)]
+        if not missing:
+            return
+
+        data = self._encode_chunk(data)
+        with open(chunk_file, 'wb') as chunk_fd:
+            chunk_fd.write(data)
+        for pool in missing:
+            pool.put(chunk_id, chunk_file)
+
+        counts['uploaded_chunks'] += 1
+        counts['uploaded_size'] += len(data)
+
+    def _get_chunk_key(self):
+        """Return the key used to hash the chunks of encrypted backups.
+
+        Keyed hashes do not disclose the content of the chunks and keep the
+        chunks encrypted with different keys apart.
+        """
+        if not self.encrypt_pass_file:
+            return None
+        with open(self.encrypt_pass_file, 'rb') as pass_file:
+            return pass_file.readline()
+
+    @staticmethod
+    def _get_chunk_id(data, chunk_key):
+        if chunk_key:
+            return hmac.new(chunk_key, data, hashlib.sha256).hexdigest()
+        return hashlib.sha256(data).hexdigest()
+
+    def _encode_chunk(self, data):
+        data = compress.one_shot_compress(self.compression_algo, data)
+        if self.encrypt_pass_file:
+            cipher = crypt.AESEncrypt(self.encrypt_pass_file)
+            data = cipher.generate_header() + cipher.encrypt(data)
+        return data
+
+    def _decode_chunk(self, data):
+        if self.encrypt_pass_file:
+            decryptor = crypt.AESDecrypt(self.encrypt_pass_file,
+                                         data[:crypt.BS])
+            data = decryptor.decrypt(data[crypt.BS:])
+        return compress.one_shot_decompress(self.compression_algo, data)
+
+    def restore_level(self, restore_path, read_pipe, backup, except_queue):
+        """Restore the tree described by the backup manifest into
+        restore_path, downloading its chunks.
+
+        :param restore_path: Path where to restore file(s)
+        :param read_pipe: backup data
+        :param backup: Backup info
+        :param except_queue: Queue for exceptions
+        """
+        try:
+            metadata = backup.metadata()
+            if (not self.encrypt_pass_file and
+                    metadata.get("encryption", False)):
+                raise Exception("Cannot restore encrypted backup without key")
+
+            self.compression_algo = metadata.get('compression',
+                                                 self.compression_algo)
+
+            if not os.path.exists(restore_path):
+                raise ValueError(
+                    'Provided restore path does not exist: {0}'.format(
+                        restore_path))
+
+            manifest = self._read_manifest(read_pipe)
+            if self.dry_run:
+                LOG.info('Dry run, {0} entries not restored'.format(
+                    len(manifest)))
+                return
+
+            self._restore_manifest(manifest, restore_path,
+                                   ChunkPool(backup.storage,
+                                             self.compression_algo))
+            LOG.info('Dedup restore process completed')
+        except Exception as e:
+            LOG.exception(e)
+            except_queue.put(e)
+            raise
+
+    def _read_manifest(self, read_pipe):
+        blocks = []
+        while True:
+            try:
+                blocks.append(read_pipe.recv_bytes())
+            except EOFError:
+                break
+
+        data = b''.join(blocks)
+        if self.encrypt_pass_file:
+            decryptor = crypt.AESDecrypt(self.encrypt_pass_file,
+                                         data[:crypt.BS])
+            data = decryptor.decrypt(data[crypt.BS:])
+        return msgpack.loads(compress.one_shot_decompress(
+            self.compression_algo, data))
+
+    def _restore_manifest(self, manifest, restore_path, pool):
+        chunk_key = self._get_chunk_key()
+        cache = collections.OrderedDict()
+        directories = []
+        tmpdir = tempfile.mkdtemp()
+        try:
+            chunk_file = os.path.join(tmpdir, CHUNK_OBJECT)
+            for entry in manifest:
+                file_abs_path = os.path.join(restore_path, entry['path'])
+                inode = entry['inode']
+                file_mode = inode['mode']
+
+                if stat.S_ISDIR(file_mode):
+                    if not os.path.isdir(file_abs_path):
+                        self._remove_file(file_abs_path)
+                        os.makedirs(file_abs_path)
+                    # Restored files would change the directories times
+                    directories.append((file_abs_path, inode))
+                    continue
+
+                self._remove_file(file_abs_path)
+                if stat.S_ISREG(file_mode):
+                    with open(file_abs_path, 'wb') as fd:
+                        for chunk_id, size in entry['chunks']:
+                            fd.write(self._get_chunk(
+                                chunk_id, pool, cache, chunk_key,
+                                chunk_file))
+                elif stat.S_ISLNK(file_mode):
+                    os.symlink(entry['lname'], file_abs_path)
+                    continue
+                elif stat.S_ISBLK(file_mode) or stat.S_ISCHR(file_mode):
+                    os.mknod(file_abs_path, file_mode, entry['rdev'])
+                elif stat.S_ISFIFO(file_mode):
+                    os.mkfifo(file_abs_path)
+
+                self._set_inode(file_abs_path, inode)
+
+            for file_abs_path, inode in reversed(directories):
+                self._set_inode(file_abs_path, inode)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _get_chunk(self, chunk_id, pool, cache, chunk_key, chunk_file):
+        """Download a chunk, keeping the last ones in cache.
+
+        :return: the chunk content
+        """
+        data = cache.pop(chunk_id, None)
+        if data is None:
+            pool.get(chunk_id, chunk_file)
+            with open(chunk_file, 'rb') as chunk_fd:
+                data = self._decode_chunk(chunk_fd.read())
+            os.remove(chunk_file)
+
+            if self._get_chunk_id(data, chunk_key) != chunk_id:
+                raise Exception('[*] Corrupted chunk {0}'.format(chunk_id))
+
+            if len(cache) >= RESTORE_CACHE_SIZE:
+                cache.popitem(last=False)
+        cache[chunk_id] = data
+        return data
+
+    @staticmethod
+    def _remove_file(file_abs_path):
+        if os.path.isdir(file_abs_path) and not os.path.islink(
+                file_abs_path):
+            shutil.rmtree(file_abs_path)
+        elif os.path.lexists(file_abs_path):
+            os.unlink(file_abs_path)
+
+    @staticmethod
+    def _set_inode(file_path, inode):
+        """Set the file owner, mode and times according to the inode.
+
+        The owner is looked up by name, then by id, then the current user
+        is used.
+        """
+        try:
+            set_uid = pwd.getpwnam(inode['uname']).pw_uid
+            set_gid = grp.getgrnam(inode['gname']).gr_gid
+        except (KeyError, TypeError):
+            set_uid = inode['uid']
+            set_gid = inode['gid']
+        try:
+            os.chown(file_path, set_uid, set_gid)
+        except (OSError, IOError):
+            try:
+                os.chown(file_path, pwd.getpwnam(getpass.getuser()).pw_uid,
+                         grp.getgrnam(getpass.getuser()).gr_gid)
+            except (KeyError, OSError, IOError):
+                LOG.warning(
+                    '[*] Unable to set owner for {}'.format(file_path))
+        try:
+            os.chmod(file_path, inode['mode'])
+            os.utime(file_path, (inode['atime'], inode['mtime']))
+        except (OSError, IOError):
+            LOG.warning(
+                '[*] Unable to set inode info for {}'.format(file_path))
+
+    def write_engine_meta(self, manifest_path, files_meta):
+        with open(manifest_path, 'wb') as manifest_file:
+            cmp_meta = compress.one_shot_compress(
+                self.compression_algo, msgpack.dumps(files_meta))
+            manifest_file.write(cmp_meta)
+
+    def get_fs_meta_struct(self, fs_meta_path):
+        old_files_meta = {}
+
+        if os.path.isfile(fs_meta_path):
+            old_files_meta = self._read_files_meta(fs_meta_path,
+                                                   self.compression_algo)
+
+        old_fs_meta_struct = old_files_meta.get('files', {})
+        chunk_size = old_files_meta.get('dedup_chunk_size')
+
+        return old_fs_meta_struct, chunk_size
+
+    @staticmethod
+    def _read_files_meta(fs_meta_path, compression_algo):
+        with open(fs_meta_path, 'rb') as meta_file:
+            return msgpack.loads(compress.one_shot_decompress(
+                compression_algo, meta_file.read()))
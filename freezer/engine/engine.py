@@ -14,10 +14,11 @@
 
 
 import abc
+import contextlib
+import errno
 import multiprocessing
 import shutil
 import tempfile
-import time
 
 from oslo_log import log
 from oslo_serialization import jsonutils as json
@@ -79,6 +80,11 @@ class BackupEngine(object):
     :type storage: freezer.storage.base.Storage
     """
 
+    # True if synthetic_data can merge the backup chains of the engine
+    supports_synthetic = False
+    # True if the engine restores only the paths of restore_path_filter
+    supports_path_filter = False
+
     def __init__(self, storage):
         """
         :type storage: freezer.storage.base.Storage
@@ -130,10 +136,8 @@ class BackupEngine(object):
 
         try:
             engine_meta = utils.path_join(tmpdir, "engine_meta")
-            freezer_meta = utils.path_join(tmpdir, "freezer_meta")
             if prev_backup:
-                prev_backup.storage.get_file(prev_backup.engine_metadata_path,
-                                             engine_meta)
+                self.get_engine_metadata(prev_backup, engine_meta)
             timestamp = utils.DateTime.now().timestamp
             level_zero_timestamp = (prev_backup.level_zero_timestamp
                                     if prev_backup else timestamp)
@@ -145,83 +149,227 @@ class BackupEngine(object):
                 level=(prev_backup.level + 1 if prev_backup else 0)
             )
 
-            input_queue = streaming.RichQueue(queue_size)
-            read_except_queue = queue.Queue()
-            write_except_queue = queue.Queue()
-
-            read_stream = streaming.QueuedThread(
-                self.backup_stream,
-                input_queue,
-                read_except_queue,
-                kwargs={"backup_resource": backup_resource,
-                        "manifest_path": engine_meta})
-
-            write_stream = streaming.QueuedThread(
-                self.storage.write_backup,
-                input_queue,
-                write_except_queue,
-                kwargs={"backup": backup})
-
-            read_stream.daemon = True
-            write_stream.daemon = True
-            read_stream.start()
-            write_stream.start()
-            read_stream.join()
-            write_stream.join()
-
-            # queue handling is different from SimpleQueue handling.
-            def handle_except_queue(except_queue):
-                if not except_queue.empty():
-                    while not except_queue.empty():
-                        e = except_queue.get_nowait()
-                        LOG.critical('Engine error: {0}'.format(e))
-                    return True
-                else:
-                    return False
-
-            got_exception = None
-            got_exception = (handle_except_queue(read_except_queue) or
-                             got_exception)
-            got_exception = (handle_except_queue(write_except_queue) or
-                             got_exception)
-
-            if got_exception:
-                raise engine_exceptions.EngineException(
-                    "Engine error. Failed to backup.")
-
-            with open(freezer_meta, mode='wb') as b_file:
-                b_file.write(json.dumps(self.metadata(backup_resource)))
-            self.storage.put_metadata(engine_meta, freezer_meta, backup)
+            self._store_backup(
+                backup, self.backup_stream,
+                {"backup_resource": backup_resource,
+                 "manifest_path": engine_meta},
+                tmpdir, backup_resource, queue_size)
         finally:
             shutil.rmtree(tmpdir)
 
-    def read_blocks(self, backup, write_pipe, read_pipe, except_queue):
-        # Close the read pipe in this child as it is unneeded
-        # and download the objects from swift in chunks. The
-        # Chunk size is set by RESP_CHUNK_SIZE and sent to che write
-        # pipe
+    def synthetic_backup(self, hostname_backup_name, queue_size=2):
+        """Merge the latest level 0 backup and its increments in a new
+        level 0 backup, from the stored data only.
+
+        The new backup has the timestamp of the last increment and starts
+        a new chain: the next backups are increments of it.
 
+        :param hostname_backup_name:
+        :return: the new level 0 backup or None if the latest backup is
+                 already a level 0
+        """
+        if not self.supports_synthetic:
+            raise engine_exceptions.EngineException(
+                'Synthetic backups not supported by the {0} engine'.format(
+                    self.name))
+        backups = self.storage.get_latest_level_zero_increments(
+            engine=self,
+            hostname_backup_name=hostname_backup_name)
+        last_backup = backups[max(backups)]
+        if not last_backup.level:
+            LOG.info('Backup {0} has no increments, nothing to '
+                     'merge'.format(hostname_backup_name))
+            return None
+
+        LOG.info('Merging {0} levels of backup {1} in a new level '
+                 '0'.format(len(backups), hostname_backup_name))
+        tmpdir = tempfile.mkdtemp()
         try:
+            engine_meta = utils.path_join(tmpdir, "engine_meta")
+            backup = base.Backup(
+                engine=self,
+                hostname_backup_name=hostname_backup_name,
+                level_zero_timestamp=last_backup.timestamp,
+                timestamp=last_backup.timestamp,
+                level=0
+            )
 
-            read_pipe.close()
-            for block in backup.storage.backup_blocks(backup):
-                write_pipe.send_bytes(block)
+            self._store_backup(
+                backup, self.synthetic_stream,
+                {"backups": backups, "manifest_path": engine_meta},
+                tmpdir, None, queue_size)
+        finally:
+            shutil.rmtree(tmpdir)
+        return backup
 
-            # Closing the pipe after checking no data
-            # is still available in the pipe.
-            while True:
-                if not write_pipe.poll():
-                    write_pipe.close()
-                    break
-                time.sleep(1)
+    def synthetic_stream(self, backups, rich_queue, manifest_path):
+        rich_queue.put_messages(self.synthetic_data(backups, manifest_path))
 
-        except IOError:
-            pass
+    def synthetic_data(self, backups, manifest_path):
+        """Produce the data of a level 0 backup holding the final state of
+        a backup chain, for the engines supporting synthetic backups.
+
+        :param backups: Dictionary[backup_level, backup]
+        :param manifest_path: local path where to write the engine metadata
+                              of the new backup
+        :return: generator of the backup data
+        """
+        raise NotImplementedError(
+            'Synthetic backups not supported by the {0} engine'.format(
+                self.name))
+
+    def _store_backup(self, backup, stream, stream_kwargs, tmpdir,
+                      backup_resource, queue_size):
+        """Upload the data produced by stream, then the metadata.
+
+        :type backup: freezer.storage.base.Backup
+        :param backup: backup to store
+        :param stream: function putting the backup data on a rich_queue
+        :param stream_kwargs: arguments of stream, the manifest_path is
+                              uploaded as the engine metadata
+        :param tmpdir: local directory of the metadata files
+        :param backup_resource: resource backed up, for the freezer metadata
+        :param queue_size:
+        """
+        input_queue = streaming.RichQueue(queue_size)
+        read_except_queue = queue.Queue()
+        write_except_queue = queue.Queue()
+
+        read_stream = streaming.QueuedThread(
+            stream,
+            input_queue,
+            read_except_queue,
+            kwargs=stream_kwargs)
+
+        write_stream = streaming.QueuedThread(
+            self.storage.write_backup,
+            input_queue,
+            write_except_queue,
+            kwargs={"backup": backup})
+
+        read_stream.daemon = True
+        write_stream.daemon = True
+        read_stream.start()
+        write_stream.start()
+        read_stream.join()
+        write_stream.join()
+
+        # queue handling is different from SimpleQueue handling.
+        def handle_except_queue(except_queue):
+            if not except_queue.empty():
+                while not except_queue.empty():
+                    e = except_queue.get_nowait()
+                    LOG.critical('Engine error: {0}'.format(e))
+                return True
+            else:
+                return False
+
+        got_exception = None
+        got_exception = (handle_except_queue(read_except_queue) or
+                         got_exception)
+        got_exception = (handle_except_queue(write_except_queue) or
+                         got_exception)
+
+        if got_exception:
+            raise engine_exceptions.EngineException(
+                "Engine error. Failed to backup.")
+
+        data_index = utils.path_join(tmpdir, "data_index")
+        if self.write_data_index(data_index):
+            self.storage.put_data_index(data_index, backup)
+
+        freezer_meta = utils.path_join(tmpdir, "freezer_meta")
+        metadata = self.metadata(backup_resource)
+        with open(freezer_meta, mode='wb') as b_file:
+            b_file.write(json.dumps(metadata))
+        self.storage.put_metadata(stream_kwargs["manifest_path"],
+                                  freezer_meta, backup)
+        self.storage.record_backup(backup, input_queue.transmitted_bytes,
+                                   metadata)
+
+    def write_data_index(self, data_index_path):
+        """Write the index of the offsets of the data of the last backup.
+
+        :param data_index_path: local path of the index
+        :return: True if the engine wrote an index, False otherwise
+        """
+        return False
+
+    def get_engine_metadata(self, backup, manifest_path):
+        """Download the engine metadata of the backup.
+
+        :type backup: freezer.storage.base.Backup
+        :param backup: backup used for the incremental backup
+        :param manifest_path: local path of the engine metadata
+        """
+        backup.storage.get_file(backup.engine_metadata_path, manifest_path)
+
+    def remove_unreferenced_data(self, storage):
+        """Remove the data shared by the backups of the engine that no
+        remaining backup references, after backups were removed.
+
+        :type storage: freezer.storage.base.Storage
+        """
+        pass
+
+    def read_blocks(self, backups, pipe, except_queue):
+        """Download the data of backups, in order, ending every level on
+        the pipe.
+
+        The download stops when the reader closes the pipe.
+
+        :param backups: list of freezer.storage.base.Backup
+        :type pipe: freezer.utils.streaming.BlockPipe
+        """
+        try:
+            pipe.close_read_end()
+            for backup in backups:
+                for block in backup.storage.backup_blocks(backup):
+                    pipe.send_bytes(block)
+                pipe.end_level()
+
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                except_queue.put(e)
+                raise
 
         except Exception as e:
             except_queue.put(e)
             raise
 
+        finally:
+            pipe.close_write_end()
+
+    @contextlib.contextmanager
+    def open_backup_pipe(self, backup):
+        """Download the data of the backup in a child process.
+
+        The download is stopped when the pipe is closed before the end of
+        the data.
+
+        :type backup: freezer.storage.base.Backup
+        :param backup: backup to download
+        :return: context manager of the read end of the pipe
+        """
+        # Use SimpleQueue because Queue does not work on Mac OS X.
+        except_queue = SimpleQueue()
+        pipe = streaming.block_pipe()
+        process_stream = multiprocessing.Process(
+            target=self.read_blocks,
+            args=([backup], pipe, except_queue))
+        process_stream.daemon = True
+        process_stream.start()
+        pipe.close_write_end()
+        try:
+            yield pipe
+        finally:
+            pipe.close_read_end()
+            process_stream.join()
+            if not except_queue.empty():
+                LOG.exception('Engine error: {0}'.format(except_queue.get()))
+                raise engine_exceptions.EngineException(
+                    "Engine error. Failed to restore.")
+
     def restore(self, hostname_backup_name, restore_resource,
                 overwrite,
                 recent_to_date,
@@ -251,63 +399,90 @@ class BackupEngine(object):
             hostname_backup_name=hostname_backup_name,
             recent_to_date=recent_to_date)
 
-        max_level = max(backups.keys())
-
-        # Use SimpleQueue because Queue does not work on Mac OS X.
-        read_except_queue = SimpleQueue()
         LOG.info("Restoring backup {0}".format(hostname_backup_name))
-        for level in range(0, max_level + 1):
-            LOG.info("Restoring from level {0}".format(level))
-            backup = backups[level]
-            read_pipe, write_pipe = multiprocessing.Pipe()
-            process_stream = multiprocessing.Process(
-                target=self.read_blocks,
-                args=(backup, write_pipe, read_pipe, read_except_queue))
-
-            process_stream.daemon = True
-            process_stream.start()
-            write_pipe.close()
-
-            # Start the tar pipe consumer process
-
-            # Use SimpleQueue because Queue does not work on Mac OS X.
-            write_except_queue = SimpleQueue()
+        self.restore_increments(restore_resource, backups)
 
-            engine_stream = multiprocessing.Process(
-                target=self.restore_level,
-                args=(restore_resource, read_pipe, backup, write_except_queue))
+        LOG.info(
+            'Restore completed successfully for backup name '
+            '{0}'.format(hostname_backup_name))
 
-            engine_stream.daemon = True
-            engine_stream.start()
+    def restore_increments(self, restore_resource, backups):
+        """Restore the levels of a backup chain one by one, in order.
 
-            read_pipe.close()
-            write_pipe.close()
-            process_stream.join()
-            engine_stream.join()
+        A single process downloads the data of all the levels while another
+        one restores them, the levels are delimited on the pipe between
+        them.
 
-            # SimpleQueue handling is different from queue handling.
-            def handle_except_SimpleQueue(except_queue):
+        :param restore_resource: path or resource where to restore
+        :param backups: Dictionary[backup_level, backup]
+        """
+        chain = [backups[level] for level in self.restore_levels(backups)]
+        # Use SimpleQueue because Queue does not work on Mac OS X.
+        read_except_queue = SimpleQueue()
+        write_except_queue = SimpleQueue()
+        pipe = streaming.block_pipe()
+
+        process_stream = multiprocessing.Process(
+            target=self.read_blocks,
+            args=(chain, pipe, read_except_queue))
+        process_stream.daemon = True
+        process_stream.start()
+
+        engine_stream = multiprocessing.Process(
+            target=self.restore_chain,
+            args=(restore_resource, pipe, chain, write_except_queue))
+        engine_stream.daemon = True
+        engine_stream.start()
+
+        pipe.close()
+        engine_stream.join()
+        process_stream.join()
+
+        # SimpleQueue handling is different from queue handling.
+        def handle_except_SimpleQueue(except_queue):
+            if not except_queue.empty():
+                while not except_queue.empty():
+                    e = except_queue.get()
+                    LOG.exception('Engine error: {0}'.format(e))
+                return True
+            else:
+                return False
+
+        got_exception = None
+        got_exception = (handle_except_SimpleQueue(read_except_queue) or
+                         got_exception)
+        got_exception = (handle_except_SimpleQueue(write_except_queue) or
+                         got_exception)
+
+        if engine_stream.exitcode or got_exception:
+            raise engine_exceptions.EngineException(
+                "Engine error. Failed to restore.")
+
+    def restore_chain(self, restore_resource, pipe, backups, except_queue):
+        """Restore the levels read from the pipe, stopping at the first
+        failure.
+
+        :type pipe: freezer.utils.streaming.BlockPipe
+        :param backups: list of freezer.storage.base.Backup, in order
+        """
+        try:
+            pipe.close_write_end()
+            for backup in backups:
+                LOG.info("Restoring from level {0}".format(backup.level))
+                self.restore_level(restore_resource, pipe, backup,
+                                   except_queue)
                 if not except_queue.empty():
-                    while not except_queue.empty():
-                        e = except_queue.get()
-                        LOG.exception('Engine error: {0}'.format(e))
-                    return True
-                else:
-                    return False
-
-            got_exception = None
-            got_exception = (handle_except_SimpleQueue(read_except_queue) or
-                             got_exception)
-            got_exception = (handle_except_SimpleQueue(write_except_queue) or
-                             got_exception)
-
-            if engine_stream.exitcode or got_exception:
-                raise engine_exceptions.EngineException(
-                    "Engine error. Failed to restore.")
+                    return
+                pipe.skip_level()
+        finally:
+            pipe.close_read_end()
 
-        LOG.info(
-            'Restore completed successfully for backup name '
-            '{0}'.format(hostname_backup_name))
+    def restore_levels(self, backups):
+        """
+        :param backups: Dictionary[backup_level, backup]
+        :return: the levels to restore, in order
+        """
+        return range(0, max(backups.keys()) + 1)
 
     @abc.abstractmethod
     def restore_level(self, restore_path, read_pipe, backup, except_queue):
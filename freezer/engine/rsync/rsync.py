@@ -33,6 +33,8 @@ from freezer.engine import engine
 from freezer.engine.rsync import pyrsync
 from freezer.utils import compress
 from freezer.utils import crypt
+from freezer.utils import scanner
+from freezer.utils import streaming
 from freezer.utils import winutils
 
 LOG = log.getLogger(__name__)
@@ -64,6 +66,7 @@ class RsyncEngine(engine.BackupEngine):
         # Compression and encryption objects
         self.compressor = None
         self.cipher = None
+        self.scan_workers = kwargs.get('scan_workers') or 1
         super(RsyncEngine, self).__init__(storage=storage)
 
     @property
@@ -91,8 +94,7 @@ class RsyncEngine(engine.BackupEngine):
         """
         LOG.info("Starting RSYNC engine backup data stream")
 
-        file_read_limit = 0
-        data_chunk = b''
+        segments = streaming.SegmentBuilder(self.max_segment_size)
         LOG.info(
             'Recursively archiving and compressing files from {}'.format(
                 os.getcwd()))
@@ -101,7 +103,7 @@ class RsyncEngine(engine.BackupEngine):
 
         if self.encrypt_pass_file:
             self.cipher = crypt.AESEncrypt(self.encrypt_pass_file)
-            data_chunk += self.cipher.generate_header()
+            segments.add(self.cipher.generate_header())
 
         rsync_queue = queue.Queue(maxsize=2)
 
@@ -121,15 +123,12 @@ class RsyncEngine(engine.BackupEngine):
             if len(file_block) == 0:
                 continue
 
-            data_chunk += file_block
-            file_read_limit += len(file_block)
-            if file_read_limit >= self.max_segment_size:
-                yield data_chunk
-                data_chunk = b''
-                file_read_limit = 0
+            for segment in segments.add(file_block):
+                yield segment
 
         # Upload segments smaller then max_segment_size
-        if len(data_chunk) < self.max_segment_size:
+        data_chunk = segments.flush()
+        if data_chunk:
             yield data_chunk
 
         # Rejoining thread
@@ -625,8 +624,8 @@ class RsyncEngine(engine.BackupEngine):
 
         ctime = int(os_stat.st_ctime)
         mtime = int(os_stat.st_mtime)
-        uname = pwd.getpwuid(os_stat.st_uid)[0]
-        gname = grp.getgrgid(os_stat.st_gid)[0]
+        uname = scanner.get_user_name(os_stat.st_uid)
+        gname = scanner.get_group_name(os_stat.st_gid)
 
         dev = os_stat.st_dev
         inumber = os_stat.st_ino
@@ -771,10 +770,12 @@ class RsyncEngine(engine.BackupEngine):
         if os.path.isdir(fs_path):
             # If given path is a directory, change cwd to path to backup
             os.chdir(fs_path)
-            for root, dirs, files in os.walk(fs_path):
+            for root, dirs, files in scanner.walk(
+                    fs_path, workers=self.scan_workers):
                 self.process_file(root, fs_path, files_meta,
                                   old_fs_meta_struct, write_queue)
 
+                files = [entry.name for entry in files]
                 # Check if exclude is in filename. If it is, log the file
                 # exclusion and continue to the next iteration.
                 if self.exclude:
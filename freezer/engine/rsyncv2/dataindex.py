@@ -0,0 +1,169 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Data offset index of the rsync backups.
+
+The compression of the backup stream is fully flushed every
+DATA_INDEX_INTERVAL bytes of file data, so that the stream can be
+decompressed from there on its own. For every such sync point the index
+records the offset of the file data in the decompressed stream, counted
+from the end of the header, and the position of the compressed data in the
+stored object, that is the segment and the offset in the segment. A part of
+the backup can then be restored with ranged reads of the object.
+"""
+
+import bisect
+
+import msgpack
+
+from freezer.utils import compress
+
+DATA_INDEX_VERSION = 1
+# Number of bytes of file data between two sync points
+DATA_INDEX_INTERVAL = 4 * 1024 * 1024
+
+
+class DataIndex(object):
+    def __init__(self, segment_size, points=None):
+        """
+        :param segment_size: size of the segments of the stored object
+        :param points: list of [data_offset, position] of the sync points
+        """
+        self.segment_size = segment_size
+        self.points = points or []
+        self._offsets = [point[0] for point in self.points]
+
+    def add(self, data_offset, position):
+        self.points.append([data_offset, position])
+        self._offsets.append(data_offset)
+
+    def segment(self, point):
+        """Get the segment and the offset in the segment of a sync point.
+
+        :param point: index of the sync point
+        :return: tuple (segment, offset)
+        """
+        return divmod(self.points[point][1], self.segment_size)
+
+    def runs(self, pieces):
+        """Group the pieces of data to read by runs decoded from the same
+        sync point.
+
+        A run is extended to the next piece as long as no sync point lies
+        between them.
+
+        :param pieces: list of (stream_offset, length, ...) in stream order
+        :return: list of (start_point, end_point, pieces), end_point is the
+                 first sync point after the run or None if the run extends
+                 to the end of the stream
+        """
+        runs = []
+        run_end = 0
+        for piece in pieces:
+            start = piece[0]
+            point = max(bisect.bisect_right(self._offsets, start) - 1, 0)
+            if runs and self._offsets[point] <= run_end:
+                runs[-1][2].append(piece)
+                run_end = max(run_end, start + piece[1])
+                continue
+            if runs:
+                runs[-1][1] = self._end_point(run_end)
+            runs.append([point, None, [piece]])
+            run_end = start + piece[1]
+        if runs:
+            runs[-1][1] = self._end_point(run_end)
+        return [tuple(run) for run in runs]
+
+    def _end_point(self, data_offset):
+        point = bisect.bisect_left(self._offsets, data_offset)
+        return point if point < len(self.points) else None
+
+    def write(self, path, compression_algo):
+        with open(path, 'wb') as index_file:
+            index_file.write(compress.one_shot_compress(
+                compression_algo, msgpack.dumps({
+                    'version': DATA_INDEX_VERSION,
+                    'segment_size': self.segment_size,
+                    'points': self.points})))
+
+    @classmethod
+    def read(cls, path, compression_algo):
+        """Load an index, return None if its version is not supported"""
+        with open(path, 'rb') as index_file:
+            data = msgpack.loads(compress.one_shot_decompress(
+                compression_algo, index_file.read()))
+        if data.get('version') != DATA_INDEX_VERSION:
+            return None
+        return cls(data['segment_size'], data['points'])
+
+
+class IndexingCompressor(object):
+    """Compress the backup stream, fully flushing the compression at the
+    sync points of the file data and recording them in a DataIndex.
+    """
+
+    def __init__(self, compressor, segment_size, position=0):
+        """
+        :param compressor: compress.Compressor
+        :param segment_size: size of the segments of the stored object
+        :param position: position in the stored object of the first
+                         compressed byte, after the encryption header
+        """
+        self.compressor = compressor
+        self.index = DataIndex(segment_size)
+        self.position = position
+        # Offset of the file data, None while compressing the header
+        self.data_offset = None
+        self._next_sync = 0
+
+    def start_data(self):
+        """Mark the end of the header, the file data follows"""
+        self.data_offset = 0
+
+    def compress(self, data):
+        if self.data_offset is None:
+            return self._output(self.compressor.compress(data))
+
+        chunks = []
+        start = 0
+        while start < len(data):
+            if self.index is None:
+                size = len(data) - start
+            else:
+                if self.data_offset == self._next_sync:
+                    chunks.append(self._sync())
+                    self._next_sync += DATA_INDEX_INTERVAL
+                size = min(len(data) - start,
+                           self._next_sync - self.data_offset)
+            block = data if size == len(data) else data[start:start + size]
+            chunks.append(self._output(self.compressor.compress(block)))
+            start += size
+            self.data_offset += size
+        return b''.join(chunks)
+
+    def flush(self):
+        return self._output(self.compressor.flush())
+
+    def _sync(self):
+        flushed = self.compressor.full_flush()
+        if flushed is None:
+            # Not supported by the compression algorithm
+            self.index = None
+            return b''
+        flushed = self._output(flushed)
+        self.index.add(self.data_offset, self.position)
+        return flushed
+
+    def _output(self, data):
+        self.position += len(data)
+        return data
@@ -0,0 +1,308 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Final state planner of the rsync restores.
+
+The headers of all the levels of a backup chain are replayed on an in
+memory tree before anything is written. Every regular file of the final
+tree is described by its pieces: the ranges of the file holding data, each
+one mapped to the range of the data stream of the level that holds it. The
+patches are composed with the pieces of the previous version of the file,
+so the data overwritten or deleted by a later level is never restored and
+every byte of the final tree is written once.
+"""
+
+import bisect
+import fnmatch
+import stat
+
+import six
+
+from freezer.engine.rsyncv2 import pyrsync
+
+
+class PlannedFile(object):
+    """File of the final tree.
+
+    The paths hard linked together share the same PlannedFile.
+    """
+    __slots__ = ('header', 'size', 'pieces')
+
+    def __init__(self, header, size=0, pieces=None):
+        """
+        :param header: file header of the level creating the file
+        :param size: size of a regular file
+        :param pieces: list of (file_offset, length, level, stream_offset)
+                       sorted by file_offset, the ranges of a regular file
+                       not covered by a piece are holes
+        """
+        self.header = header
+        self.size = size
+        self.pieces = pieces or []
+
+    @property
+    def mode(self):
+        return self.header['inode']['mode']
+
+    def data_ranges(self):
+        """Get the ranges of a regular file holding data.
+
+        :return: list of [file_offset, length], the contiguous pieces are
+                 merged
+        """
+        ranges = []
+        for file_offset, length, _, _ in self.pieces:
+            if ranges and sum(ranges[-1]) == file_offset:
+                ranges[-1][1] += length
+            else:
+                ranges.append([file_offset, length])
+        return ranges
+
+
+def _add_piece(pieces, file_offset, length, level, stream_offset):
+    """Append a piece, merging it with the previous one when contiguous"""
+    if not length:
+        return
+    if pieces:
+        last_offset, last_length, last_level, last_stream = pieces[-1]
+        if (last_level == level and
+                last_offset + last_length == file_offset and
+                last_stream + last_length == stream_offset):
+            pieces[-1] = (last_offset, last_length + length, level,
+                          last_stream)
+            return
+    pieces.append((file_offset, length, level, stream_offset))
+
+
+def patch_pieces(old_file, patch, block_size, level, stream_offset):
+    """Compose a patch with the pieces of the previous version of a file.
+
+    :param old_file: PlannedFile of the previous version
+    :param patch: list of [block_index, count] operations
+    :param block_size: rsync block size of the patch
+    :param level: level of the patch
+    :param stream_offset: offset of the literal data of the patch in the
+                          data stream of the level
+    :return: tuple (pieces, size, literals_size) of the new version
+    """
+    old_pieces = old_file.pieces
+    old_offsets = [piece[0] for piece in old_pieces]
+    pieces = []
+    size = 0
+    literals_size = 0
+    for block_index, count in patch:
+        if block_index == pyrsync.LITERAL:
+            _add_piece(pieces, size, count, level,
+                       stream_offset + literals_size)
+            literals_size += count
+            size += count
+            continue
+
+        start = block_index * block_size
+        end = min(start + count * block_size, old_file.size)
+        if end <= start:
+            continue
+        index = max(bisect.bisect_right(old_offsets, start) - 1, 0)
+        for piece in old_pieces[index:]:
+            piece_offset, piece_length, piece_level, piece_stream = piece
+            if piece_offset >= end:
+                break
+            copy_start = max(piece_offset, start)
+            copy_end = min(piece_offset + piece_length, end)
+            if copy_start < copy_end:
+                _add_piece(pieces, size + copy_start - start,
+                           copy_end - copy_start, piece_level,
+                           piece_stream + copy_start - piece_offset)
+        size += end - start
+    return pieces, size, literals_size
+
+
+def data_pieces(file_header, level, stream_offset):
+    """Get the pieces of a regular file fully stored in the data stream.
+
+    :param file_header: header of the file
+    :param level: level of the backup
+    :param stream_offset: offset of the file data in the data stream
+    :return: tuple (pieces, size, data_size)
+    """
+    size = file_header['inode']['size']
+    extents = file_header.get('extents')
+    if extents is None:
+        extents = [[0, size]]
+    pieces = []
+    data_size = 0
+    for offset, length in extents:
+        _add_piece(pieces, offset, length, level, stream_offset + data_size)
+        data_size += length
+    return pieces, size, data_size
+
+
+class RestorePlan(object):
+    """Replay the headers of the levels of a backup chain, in order, the
+    same way the sequential restore applies them on the restore path.
+    """
+
+    def __init__(self):
+        # PlannedFile by path
+        self.files = {}
+        # All the paths written or removed by any level
+        self.touched = set()
+        # Size of the data following the header, by level
+        self.data_sizes = {}
+
+    def add_level(self, level, files_meta, block_size):
+        """Apply the headers of a level on the planned tree.
+
+        :param level: level of the backup
+        :param files_meta: list of file headers of the backup
+        :param block_size: rsync block size of the backup
+        """
+        files = self.files
+        # The previous version of the renamed files is moved away first
+        moved = {}
+        for file_header in files_meta:
+            prev_name = file_header.get('prev_name')
+            if prev_name in files:
+                moved[prev_name] = files.pop(prev_name)
+
+        position = 0
+        for file_header in files_meta:
+            path = file_header['path']
+            self.touched.add(path)
+            inode = file_header.get('inode', {})
+            file_mode = inode.get('mode')
+
+            if 'link' in file_header:
+                target = files.get(file_header['link'])
+                self._remove(path)
+                if target:
+                    files[path] = target
+                continue
+
+            if 'prev_name' in file_header:
+                renamed = moved.pop(file_header['prev_name'], None)
+                if renamed:
+                    self._remove(path)
+                    files[path] = renamed
+                if not file_header.get('new_level'):
+                    if renamed:
+                        renamed.header = dict(renamed.header, inode=inode)
+                    continue
+
+            if path in files:
+                if level == 0 or file_header.get('deleted'):
+                    self._remove(path)
+                    if file_header.get('deleted'):
+                        continue
+                elif file_header.get('new_level') and not stat.S_ISREG(
+                        file_mode):
+                    files[path].header = dict(files[path].header,
+                                              inode=inode)
+                    continue
+
+            if not file_mode:
+                continue
+
+            if not stat.S_ISREG(file_mode):
+                self._replace(path, PlannedFile(file_header))
+                continue
+
+            if file_header.get('new_level') and 'patch' in file_header:
+                old_file = files.get(path)
+                if not old_file or not stat.S_ISREG(old_file.mode):
+                    raise Exception(
+                        '[*] Previous version of {0} missing, unable to '
+                        'patch it'.format(path))
+                pieces, size, data_size = patch_pieces(
+                    old_file, file_header['patch'], block_size, level,
+                    position)
+            else:
+                pieces, size, data_size = data_pieces(file_header, level,
+                                                      position)
+            position += data_size
+            self._replace(path, PlannedFile(file_header, size, pieces))
+
+        self.data_sizes[level] = position
+
+    def _replace(self, path, planned_file):
+        old_file = self.files.get(path)
+        if old_file and (stat.S_ISDIR(old_file.mode) !=
+                         stat.S_ISDIR(planned_file.mode)):
+            self._remove(path)
+        self.files[path] = planned_file
+
+    def _remove(self, path):
+        """Remove the path, with its content if it is a directory"""
+        old_file = self.files.pop(path, None)
+        if old_file and stat.S_ISDIR(old_file.mode):
+            prefix = path + '/'
+            for sub_path in [p for p in self.files if p.startswith(prefix)]:
+                del self.files[sub_path]
+
+    def select(self, patterns):
+        """Restrict the final tree to the paths matching one of the fnmatch
+        patterns, the content of the matching directories and the
+        directories leading to them.
+
+        :param patterns: list of patterns of the related paths
+        """
+        def selected(path):
+            parts = path.split('/')
+            for index in range(1, len(parts) + 1):
+                prefix = '/'.join(parts[:index])
+                for pattern in patterns:
+                    if fnmatch.fnmatch(prefix, pattern):
+                        return True
+            return False
+
+        files = {}
+        for path, planned_file in six.iteritems(self.files):
+            if path in files or not selected(path):
+                continue
+            files[path] = planned_file
+            parent = path.rpartition('/')[0]
+            while parent and parent not in files:
+                if parent in self.files:
+                    files[parent] = self.files[parent]
+                parent = parent.rpartition('/')[0]
+        self.files = files
+        self.touched = set(path for path in self.touched if selected(path))
+
+    def removed_paths(self):
+        """Get the paths written or removed by some level that are not part
+        of the final tree.
+        """
+        return self.touched.difference(self.files)
+
+    def level_pieces(self):
+        """Get the live data of every level, in stream order.
+
+        Every file is listed once, with the first of its paths.
+
+        :return: dict of lists of (stream_offset, length, path, file_offset)
+                 by level, for all the levels
+        """
+        pieces = dict((level, []) for level in self.data_sizes)
+        seen = set()
+        for path in sorted(self.files):
+            planned_file = self.files[path]
+            if id(planned_file) in seen:
+                continue
+            seen.add(id(planned_file))
+            for (file_offset, length, level,
+                 stream_offset) in planned_file.pieces:
+                pieces[level].append((stream_offset, length, path,
+                                      file_offset))
+        for level_pieces in six.itervalues(pieces):
+            level_pieces.sort()
+        return pieces
@@ -11,12 +11,33 @@
 # limitations under the License.
 
 
+import array
+import binascii
 import hashlib
+import struct
+import sys
 import zlib
 
+import six
+
+from freezer.utils import utils
 
 _BASE = 65521  # largest prime smaller than 65536
 
+# Block index of the literal data in the patches
+LITERAL = -1
+# Number of bytes read from the file at once by rsyncdelta_rolling
+READ_SIZE = 1024 * 1024
+# Bounds of the number of offsets checked at once by rsyncdelta_rolling
+MIN_SCAN_SIZE = 4096
+MAX_SCAN_SIZE = 256 * 1024
+# Strong hash of the new block signatures, blake2b is faster than sha1 and
+# is truncated to a shorter digest
+STRONG_HASH = 'blake2b' if hasattr(hashlib, 'blake2b') else 'sha1'
+BLAKE2B_DIGEST_SIZE = 16
+
+_WEAK = struct.Struct('<I')
+
 
 def adler32fast(data):
     return zlib.adler32(data) & 0xffffffff
@@ -36,27 +57,153 @@ def adler32rolling(removed, new, s1, s2, blocksize=4096):
     return ((s2 << 16) | s1) & 0xffffffff, s1, s2
 
 
+def strong_digest(hash_name):
+    """
+    Returns the function computing the binary strong hash of a block.
+    """
+    if hash_name == 'blake2b':
+        def digest(data):
+            return hashlib.blake2b(data,
+                                   digest_size=BLAKE2B_DIGEST_SIZE).digest()
+        return digest
+
+    def digest(data):
+        return hashlib.new(hash_name, data).digest()
+    return digest
+
+
+def pack_weak(values):
+    """
+    Returns the weak checksums packed as little endian unsigned 32 bits
+    integers.
+    """
+    return b''.join(_WEAK.pack(value) for value in values)
+
+
+def unpack_weak(packed):
+    """
+    Returns an array of the packed weak checksums.
+    """
+    values = array.array('I')
+    if six.PY3:
+        values.frombytes(packed)
+    else:
+        values.fromstring(packed)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def legacy_signature(signature):
+    """
+    Returns the packed signature of a weak list and sha1 hex list signature
+    of the meta data structure up to version 3.
+    """
+    weak, strong = signature
+    return ['sha1', pack_weak(weak),
+            b''.join(binascii.unhexlify(digest) for digest in strong)]
+
+
+class BlockChecksums(object):
+    """
+    Computes the signature of the blocks of data provided in pieces of
+    any size.
+    """
+
+    def __init__(self, blocksize, hash_name=STRONG_HASH):
+        self.blocksize = blocksize
+        self.hash_name = hash_name
+        self._digest = strong_digest(hash_name)
+        self._weak = []
+        self._strong = []
+        self._pending = b''
+
+    def update(self, data):
+        blocksize = self.blocksize
+        weak_append = self._weak.append
+        strong_append = self._strong.append
+        start = 0
+        if self._pending:
+            start = blocksize - len(self._pending)
+            if len(data) < start:
+                self._pending += data
+                return
+            block = self._pending + data[:start]
+            weak_append(_WEAK.pack(adler32fast(block)))
+            strong_append(self._digest(block))
+            self._pending = b''
+
+        end = len(data) - (len(data) - start) % blocksize
+        for offset in range(start, end, blocksize):
+            block = data[offset:offset + blocksize]
+            weak_append(_WEAK.pack(adler32fast(block)))
+            strong_append(self._digest(block))
+        self._pending = data[end:]
+
+    def update_zeros(self, count):
+        """
+        Adds count zero bytes, the hashes of the whole zero blocks being
+        computed only once.
+        """
+        blocksize = self.blocksize
+        if self._pending:
+            head = min(count, blocksize - len(self._pending))
+            self.update(b'\0' * head)
+            count -= head
+
+        blocks, remainder = divmod(count, blocksize)
+        if blocks:
+            zero_block = b'\0' * blocksize
+            self._weak.append(_WEAK.pack(adler32fast(zero_block)) * blocks)
+            self._strong.append(self._digest(zero_block) * blocks)
+        if remainder:
+            self.update(b'\0' * remainder)
+
+    def signature(self):
+        """
+        Returns the signature of the data: the name of the strong hash, the
+        packed weak hashes and the concatenated strong hashes.
+        """
+        weak = b''.join(self._weak)
+        strong = b''.join(self._strong)
+        if self._pending:
+            weak += _WEAK.pack(adler32fast(self._pending))
+            strong += self._digest(self._pending)
+        return [self.hash_name, weak, strong]
+
+
+class ChecksumReader(object):
+    """
+    File reader computing the signature of the data read.
+    """
+
+    def __init__(self, instream, checksums):
+        self.instream = instream
+        self.checksums = checksums
+
+    def read(self, size):
+        data = self.instream.read(size)
+        self.checksums.update(data)
+        return data
+
+
 def blockchecksums(args):
     """
-    Returns a list of weak and strong hashes for each block of the
-    defined size for the given data stream.
+    Returns the signature of the blocks of the defined size of the given
+    file: the name of the strong hash, the packed weak hashes and the
+    concatenated strong hashes.
     """
-    path, blocksize = args
-    weakhashes = []
-    stronghashes = []
-    weak_append = weakhashes.append
-    strong_append = stronghashes.append
+    path, blocksize = args[:2]
+    hash_name = args[2] if len(args) > 2 else STRONG_HASH
+    checksums = BlockChecksums(blocksize, hash_name)
 
     with open(path, 'rb') as instream:
-        instream_read = instream.read
-        read = instream_read(blocksize)
-
+        read = instream.read(READ_SIZE)
         while read:
-            weak_append(adler32fast(read))
-            strong_append(hashlib.sha1(read).hexdigest())
-            read = instream_read(blocksize)
+            checksums.update(read)
+            read = instream.read(READ_SIZE)
 
-    return weakhashes, stronghashes
+    return checksums.signature()
 
 
 def rsyncdelta_fast(datastream, remotesignatures, blocksize=4096):
@@ -75,3 +222,224 @@ def rsyncdelta_fast(datastream, remotesignatures, blocksize=4096):
 
         index += 1
         data_block = datastream.read(blocksize)
+
+
+def _reduce_lanes(value, lane_bits, ones):
+    """Reduce modulo _BASE every lane of value.
+
+    As 2 ** 16 = _BASE + 15, the lanes are folded summing 15 times their
+    high bits to their low 16 bits, then _BASE is subtracted from the
+    lanes still greater or equal to it.
+    """
+    low = ones * 0xffff
+    high = ones * ((1 << (lane_bits - 16)) - 1)
+    bits = lane_bits
+    while bits > 17:
+        value = ((value >> 16) & high) * 15 + (value & low)
+        bits = max(bits - 12, 16) + 1
+    overflow = ((value + ones * ((1 << 17) - _BASE)) >> 17) & ones
+    return value - overflow * _BASE
+
+
+def adler32_windows(data, blocksize):
+    """
+    Returns the adler32 checksums of all the windows of blocksize bytes of
+    data, packed as little endian unsigned 32 bits integers.
+
+    One lane of a python long is used per window, so the rolling sums of
+    all the windows are computed by the interpreter C loops:
+    a = 1 + sum(x[j]) and b = blocksize + sum((blocksize - j) * x[j]).
+    The sums of the windows of 2 * n bytes are obtained from the sums of
+    the windows of n bytes and the windows of blocksize bytes are
+    composed from the powers of two of blocksize.
+    """
+    count = len(data) - blocksize + 1
+    if count <= 0:
+        return b''
+
+    max_sum = 255 * blocksize * (blocksize + 1) // 2 + blocksize
+    # the lanes also hold the 32 bits checksums
+    lane_size = max((max_sum.bit_length() + 8) // 8, 4)
+    lane_bits = lane_size * 8
+    lanes = bytearray(len(data) * lane_size)
+    lanes[::lane_size] = data
+    ones = utils.bytes_to_long(b'\x01'.ljust(lane_size, b'\x00') * count)
+
+    # sums and weighted sums of the windows of size bytes
+    sums = weighted = utils.bytes_to_long(lanes)
+    size = 1
+    # sums and weighted sums of the windows of length bytes
+    window_sums = window_weighted = None
+    length = 0
+    remaining = blocksize
+    while True:
+        if remaining & 1:
+            if window_sums is None:
+                window_sums, window_weighted = sums, weighted
+            else:
+                shift = lane_bits * length
+                window_weighted += size * window_sums + (weighted >> shift)
+                window_sums += sums >> shift
+            length += size
+        remaining >>= 1
+        if not remaining:
+            break
+        shift = lane_bits * size
+        weighted += size * sums + (weighted >> shift)
+        sums += sums >> shift
+        size *= 2
+
+    mask = (1 << (lane_bits * count)) - 1
+    a = _reduce_lanes((window_sums & mask) + ones, lane_bits, ones)
+    b = _reduce_lanes((window_weighted & mask) + ones * blocksize, lane_bits,
+                      ones)
+    checksums = utils.long_to_bytes((b << 16) + a, count * lane_size)
+    if lane_size == 4:
+        return checksums
+
+    packed = bytearray(count * 4)
+    for index in range(4):
+        packed[index::4] = checksums[index::lane_size]
+    return bytes(packed)
+
+
+def _find_checksums(checksums, weak_set):
+    """
+    Returns the sorted indexes of the packed checksums found in weak_set.
+    """
+    indexes = []
+    for weak in weak_set.intersection(unpack_weak(checksums)):
+        needle = struct.pack('<I', weak)
+        position = checksums.find(needle)
+        while position >= 0:
+            if position % 4:
+                position = checksums.find(needle, position + 1)
+            else:
+                indexes.append(position // 4)
+                position = checksums.find(needle, position + 4)
+    return sorted(indexes)
+
+
+def rsyncdelta_rolling(instream, remotesignatures, blocksize=4096):
+    """
+    Yields (block_index, length, literal) for the data of the given stream
+    compared to the remote signatures. block_index is the index of the
+    remote block matching the next length bytes or LITERAL for data not
+    found in the remote blocks, then literal holds the data.
+
+    The blocks are first compared at the current offset, then at every
+    following offset with the rolling checksums, so inserted or removed
+    data only changes the blocks around the modification.
+    """
+    hash_name, rem_weak, rem_strong = remotesignatures
+    digest = strong_digest(hash_name)
+    weak_set = set(unpack_weak(rem_weak))
+    count = len(rem_weak) // 4
+    strong_map = {}
+    if count:
+        size = len(rem_strong) // count
+        for index in range(count):
+            strong_map.setdefault(
+                rem_strong[index * size:(index + 1) * size], index)
+
+    data = b''
+    position = 0
+    eof = False
+    scan_size = MIN_SCAN_SIZE
+    while True:
+        available = len(data) - position
+        if not eof and available < blocksize + scan_size:
+            block = instream.read(max(READ_SIZE, blocksize + scan_size))
+            if block:
+                data = data[position:] + block
+                position = 0
+            else:
+                eof = True
+            continue
+
+        if not available:
+            return
+
+        block = data[position:position + blocksize]
+        index = strong_map.get(digest(block))
+        if index is not None:
+            yield index, len(block), None
+            position += len(block)
+            scan_size = MIN_SCAN_SIZE
+            continue
+
+        if available <= blocksize or not strong_map:
+            yield LITERAL, available, data[position:]
+            position += available
+            continue
+
+        checksums = adler32_windows(
+            data[position + 1:position + blocksize + scan_size], blocksize)
+        for offset in _find_checksums(checksums, weak_set):
+            start = position + 1 + offset
+            index = strong_map.get(digest(data[start:start + blocksize]))
+            if index is not None:
+                yield LITERAL, start - position, data[position:start]
+                position = start
+                break
+        else:
+            literal = len(checksums) // 4 + 1
+            yield LITERAL, literal, data[position:position + literal]
+            position += literal
+            scan_size = min(scan_size * 2, MAX_SCAN_SIZE)
+
+
+def rsyncpatch_info(args):
+    """
+    Returns the length of the literal data, the patch to apply to the old
+    file to obtain the given file and the count of the unchanged blocks,
+    compared to the provided packed signature, reading the file once.
+
+    The patch is a list of [block_index, count] operations: copy count
+    blocks of the old file from block_index, or write count bytes of
+    literal data if block_index is LITERAL.
+
+    When a strong hash name is provided, the new signature of the file and
+    the literal data, if not longer than max_literals bytes, are returned
+    too.
+    """
+    path, signature, blocksize = args[:3]
+    hash_name, max_literals = args[3:] if len(args) > 3 else (None, 0)
+    len_literals = 0
+    fixed_blocks = 0
+    patch = []
+    literals = []
+
+    with open(path, 'rb') as instream:
+        checksums = None
+        if hash_name:
+            checksums = BlockChecksums(blocksize, hash_name)
+            instream = ChecksumReader(instream, checksums)
+
+        for index, length, literal in rsyncdelta_rolling(
+                instream, signature, blocksize):
+            last = patch[-1] if patch else None
+            if index == LITERAL:
+                len_literals += length
+                if literals is not None:
+                    if len_literals <= max_literals:
+                        literals.append(literal)
+                    else:
+                        literals = None
+                if last and last[0] == LITERAL:
+                    last[1] += length
+                else:
+                    patch.append([LITERAL, length])
+            else:
+                fixed_blocks += 1
+                if last and last[0] != LITERAL and \
+                        last[0] + last[1] == index:
+                    last[1] += 1
+                else:
+                    patch.append([index, 1])
+
+    if not checksums:
+        return len_literals, patch, fixed_blocks
+    if literals is not None:
+        literals = b''.join(literals)
+    return len_literals, patch, fixed_blocks, checksums.signature(), literals
@@ -15,16 +15,17 @@
 Freezer rsync incremental engine
 """
 
-import fnmatch
+import collections
+import contextlib
 import getpass
-import grp
 import os
-import pwd
 import shutil
 import stat
 import sys
+import tempfile
 import threading
 
+from concurrent import futures
 import msgpack
 from oslo_log import log
 import six
@@ -32,18 +33,88 @@ import six
 from six.moves import queue
 
 from freezer.engine import engine
+from freezer.engine.rsyncv2 import dataindex
+from freezer.engine.rsyncv2 import planner
 from freezer.engine.rsyncv2 import pyrsync
+from freezer.storage import base
 from freezer.utils import compress
 from freezer.utils import crypt
+from freezer.utils import scanner
+from freezer.utils import streaming
+from freezer.utils import utils
 from freezer.utils import winutils
 
 LOG = log.getLogger(__name__)
 
 # Version of the meta data structure format
-RSYNC_DATA_STRUCT_VERSION = 2
+RSYNC_DATA_STRUCT_VERSION = 5
+# Number of tasks queued per worker ahead of the consumer
+WORKER_QUEUE_DEPTH = 4
+# Largest literal data of a patch returned by the delta workers
+MAX_PATCH_LITERALS = 4 * 1024 * 1024
+# Largest literal data kept in memory until the files are backed up
+MAX_CACHED_LITERALS = 64 * 1024 * 1024
+# Largest file read from the restore stream and written by the workers
+MAX_RESTORE_BUFFERED = 1024 * 1024
+# Largest number of files kept open while writing a planned restore
+MAX_OPEN_FILES = 64
+
+
+class RestoreTasks(object):
+    """Run the file operations of a restore on a pool of threads.
+
+    At most max_pending operations are queued, the submit call waits for
+    the oldest ones beyond. The deferred operations run in reverse order
+    once all the others are completed. With a single worker every
+    operation runs at once in the calling thread.
+
+    :param workers: number of threads
+    :param max_pending: largest number of queued operations
+    """
+
+    def __init__(self, workers=1, max_pending=1):
+        self.concurrent = workers > 1
+        self.max_pending = max_pending
+        self._executor = None
+        if self.concurrent:
+            self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self._pending = collections.deque()
+        self._deferred = []
+
+    def submit(self, func, *args):
+        if not self.concurrent:
+            func(*args)
+            return
+        self._pending.append(self._executor.submit(func, *args))
+        while len(self._pending) > self.max_pending:
+            self._pending.popleft().result()
+
+    def defer(self, func, *args):
+        self._deferred.append((func, args))
+
+    def wait(self):
+        """Wait for the submitted operations, raising their errors."""
+        while self._pending:
+            self._pending.popleft().result()
+
+    def finish(self):
+        """Wait for the submitted operations then run the deferred ones."""
+        self.wait()
+        while self._deferred:
+            func, args = self._deferred.pop()
+            func(*args)
+
+    def shutdown(self):
+        if self._executor:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown()
 
 
 class Rsyncv2Engine(engine.BackupEngine):
+    supports_synthetic = True
+    supports_path_filter = True
+
     def __init__(self, **kwargs):
         self.compression_algo = kwargs.get('compression')
         self.encrypt_pass_file = kwargs.get('encrypt_key', None)
@@ -54,8 +125,16 @@ class Rsyncv2Engine(engine.BackupEngine):
         self.dry_run = kwargs.get('dry_run', False)
         self.max_segment_size = kwargs.get('max_segment_size')
         self.rsync_block_size = kwargs.get('rsync_block_size')
+        self.workers = kwargs.get('rsync_workers') or 1
+        self.workers_type = kwargs.get('rsync_workers_type') or 'thread'
+        self.scan_workers = kwargs.get('scan_workers') or 1
         self.fixed_blocks = 0
         self.modified_blocks = 0
+        # Backup of the meta data used for the incremental backup
+        self.manifest_backup = None
+        self.restore_path_filter = kwargs.get('restore_path_filter')
+        # Data offset index of the last backup stream
+        self.data_index = None
         super(Rsyncv2Engine, self).__init__(storage=kwargs.get('storage'))
 
     @property
@@ -72,6 +151,10 @@ class Rsyncv2Engine(engine.BackupEngine):
             "encryption": bool(self.encrypt_pass_file)
         }
 
+    def get_engine_metadata(self, backup, manifest_path):
+        super(Rsyncv2Engine, self).get_engine_metadata(backup, manifest_path)
+        self.manifest_backup = backup
+
     def backup_data(self, backup_path, manifest_path):
         """Execute backup using rsync algorithm.
 
@@ -86,17 +169,6 @@ class Rsyncv2Engine(engine.BackupEngine):
         LOG.info('Recursively archiving and compressing files '
                  'from {}'.format(os.getcwd()))
 
-        file_read_limit = 0
-        data_chunk = b''
-        max_seg_size = self.max_segment_size
-
-        # Initialize objects for compressing and encrypting data
-        compressor = compress.Compressor(self.compression_algo)
-        cipher = None
-        if self.encrypt_pass_file:
-            cipher = crypt.AESEncrypt(self.encrypt_pass_file)
-            yield cipher.generate_header()
-
         write_queue = queue.Queue(maxsize=2)
 
         # Create thread for compute file signatures and read data
@@ -108,45 +180,74 @@ class Rsyncv2Engine(engine.BackupEngine):
         t_get_sign_delta.start()
 
         # Get backup data from queue
-        while True:
-            file_block = write_queue.get()
+        for segment in self._encode_stream(iter(write_queue.get, False)):
+            yield segment
 
-            if file_block is False:
-                break
+        # Rejoining thread
+        t_get_sign_delta.join()
 
-            block_len = len(file_block)
-            if block_len == 0:
+        LOG.info("Rsync engine backup stream completed")
+
+    def _encode_stream(self, blocks):
+        """Compress, encrypt and split in segments the backup stream.
+
+        :param blocks: iterable of data blocks, the first one is the backup
+                       header
+        :return: generator of segments
+        """
+        # Initialize objects for compressing and encrypting data
+        segments = streaming.SegmentBuilder(self.max_segment_size)
+        cipher = None
+        header_size = 0
+        if self.encrypt_pass_file:
+            cipher = crypt.AESEncrypt(self.encrypt_pass_file)
+            # The encryption header starts the first segment
+            header = cipher.generate_header()
+            header_size = len(header)
+            segments.add(header)
+        compressor = dataindex.IndexingCompressor(
+            compress.Compressor(self.compression_algo),
+            self.max_segment_size, header_size)
+        self.data_index = None
+
+        for file_block in blocks:
+            if len(file_block) == 0:
                 continue
 
-            data_chunk += file_block
-            file_read_limit += block_len
-            if file_read_limit >= max_seg_size:
-                yield self._process_backup_data(data_chunk, compressor, cipher)
-                data_chunk = b''
-                file_read_limit = 0
+            for segment in segments.add(compressor.compress(file_block)):
+                yield self._encrypt_segment(segment, cipher, header_size)
+                header_size = 0
 
-        flushed_data = self._flush_backup_data(data_chunk, compressor, cipher)
+            if compressor.data_offset is None:
+                # The first block is the backup header
+                compressor.start_data()
 
-        # Upload segments smaller then max_seg_size
-        if len(flushed_data) < max_seg_size:
-            yield flushed_data
+        for segment in segments.add(compressor.flush()):
+            yield self._encrypt_segment(segment, cipher, header_size)
+            header_size = 0
 
-        # Rejoining thread
-        t_get_sign_delta.join()
+        segment = segments.flush()
+        if segment:
+            yield self._encrypt_segment(segment, cipher, header_size)
 
-        LOG.info("Rsync engine backup stream completed")
+        self.data_index = compressor.index
 
-    @staticmethod
-    def _flush_backup_data(data_chunk, compressor, cipher):
-        flushed_data = b''
-        if data_chunk:
-            flushed_data += compressor.compress(data_chunk)
+    def write_data_index(self, data_index_path):
+        if not self.data_index or not self.data_index.points:
+            return False
+        self.data_index.write(data_index_path, self.compression_algo)
+        return True
 
-        flushed_data += compressor.flush()
-        if flushed_data and cipher:
-            flushed_data = cipher.encrypt(flushed_data)
+    @staticmethod
+    def _encrypt_segment(segment, cipher, header_size):
+        """Encrypt the segment data following the first header_size bytes.
 
-        return flushed_data
+        The segments are encrypted one by one, as they are decrypted on
+        restore.
+        """
+        if not cipher:
+            return segment
+        return segment[:header_size] + cipher.encrypt(segment[header_size:])
 
     def restore_level(self, restore_path, read_pipe, backup, except_queue):
         """Restore the provided backup into restore_abs_path.
@@ -166,10 +267,18 @@ class Rsyncv2Engine(engine.BackupEngine):
                     'size': st_size
                 } (optional if file removed),
                'lname': 'link_name' (optional if symlink),
-               'prev_name': '' (optional if renamed),
+               'prev_name': '' (optional if renamed, the data follows
+                                only if 'new_level' is set),
+               'link': '' (optional, path of the hard linked file holding
+                           the data),
+               'extents': [[offset, length], ...] (optional if sparse
+                          file, only these data ranges follow),
                'new_level': True (optional if incremental),
                'deleted': True (optional if removed),
-               'deltas': len_of_blocks, [modified blocks] (if patch)
+               'deltas': len_of_blocks, [modified blocks] (if patch, up to
+                         struct version 2)
+               'patch': [[block_index, count], ...] (if patch, the
+                        block_index is -1 for count bytes of data)
               },
               ...
             ]
@@ -181,55 +290,587 @@ class Rsyncv2Engine(engine.BackupEngine):
         """
 
         try:
-            metadata = backup.metadata()
-            if (not self.encrypt_pass_file and
-                    metadata.get("encryption", False)):
-                raise Exception("Cannot restore encrypted backup without key")
-
-            self.compression_algo = metadata.get('compression',
-                                                 self.compression_algo)
-
-            if not os.path.exists(restore_path):
-                raise ValueError(
-                    'Provided restore path does not exist: {0}'.format(
-                        restore_path))
+            self._load_backup_metadata(backup)
+            self._check_restore_path(restore_path)
 
             if self.dry_run:
                 restore_path = '/dev/null'
 
-            data_gen = self._restore_data(read_pipe)
+            data_stream = streaming.ChunkReader(
+                self._restore_data(read_pipe))
 
+            moved_dir = None
+            tasks = RestoreTasks(self.workers,
+                                 self.workers * WORKER_QUEUE_DEPTH)
             try:
-                data_stream = data_gen.next()
-                files_meta, data_stream = self._load_files_meta(data_stream,
-                                                                data_gen)
-
-                for fm in files_meta:
-                    data_stream = self._restore_file(
-                        fm, restore_path, data_stream, data_gen, backup.level)
-            except StopIteration:
-                LOG.info('Rsync restore process completed')
+                try:
+                    files_meta = self._load_files_meta(data_stream)
+                    moved_dir, moved_files = self._move_renamed_files(
+                        files_meta, restore_path)
+
+                    for fm in files_meta:
+                        self._restore_file(
+                            fm, restore_path, data_stream, backup.level,
+                            tasks, moved_files)
+                except EOFError:
+                    LOG.info('Rsync restore process completed')
+                tasks.finish()
+            finally:
+                tasks.shutdown()
+                if moved_dir:
+                    shutil.rmtree(moved_dir, ignore_errors=True)
         except Exception as e:
             LOG.exception(e)
             except_queue.put(e)
             raise
 
+    def _load_backup_metadata(self, backup):
+        """Set the compression and the block size used by the backup.
+
+        :param backup: Backup info
+        """
+        metadata = backup.metadata()
+        if (not self.encrypt_pass_file and
+                metadata.get("encryption", False)):
+            raise Exception("Cannot restore encrypted backup without key")
+
+        self.compression_algo = metadata.get('compression',
+                                             self.compression_algo)
+        self.rsync_block_size = metadata.get('rsync_block_size',
+                                             self.rsync_block_size)
+
     @staticmethod
-    def _load_files_meta(data_stream, data_gen):
-        files_meta = []
+    def _check_restore_path(restore_path):
+        if not os.path.exists(restore_path):
+            raise ValueError(
+                'Provided restore path does not exist: {0}'.format(
+                    restore_path))
+
+    def restore_increments(self, restore_resource, backups):
+        """Restore the final state of a backup chain of several levels.
+
+        The headers of all the levels are read first, then only the data
+        of the files that is still part of the final tree is downloaded and
+        written, once. With a restore path filter, the backups with a data
+        offset index are read by ranges from the storage. The dry runs
+        without a filter and the backups of the struct versions up to 2 are
+        restored level by level.
+
+        :param restore_resource: path where to restore
+        :param backups: Dictionary[backup_level, backup]
+        """
+        levels = list(self.restore_levels(backups))
+        if self.restore_path_filter or (not self.dry_run and
+                                        len(levels) > 1):
+            self._check_restore_path(restore_resource)
+            data_indexes = {}
+            if self.restore_path_filter:
+                for level in levels:
+                    data_indexes[level] = self._get_data_index(
+                        backups[level])
+            plan = self._plan_restore(backups, levels, data_indexes)
+            if plan:
+                if self.restore_path_filter:
+                    plan.select(self.restore_path_filter.split(','))
+                if self.dry_run:
+                    LOG.info('Dry run, {0} paths selected, not '
+                             'restored'.format(len(plan.files)))
+                    return
+                self._restore_plan(restore_resource, backups, levels, plan,
+                                   data_indexes)
+                LOG.info('Rsync restore process completed')
+                return
+            if self.restore_path_filter:
+                raise Exception('--restore-path-filter is not supported by '
+                                'the backups with legacy deltas')
+        super(Rsyncv2Engine, self).restore_increments(restore_resource,
+                                                      backups)
+
+    @contextlib.contextmanager
+    def _open_data_stream(self, backup):
+        """Download, decrypt and decompress the data of the backup.
+
+        :param backup: Backup info
+        :return: context manager of a streaming.ChunkReader
+        """
+        self._load_backup_metadata(backup)
+        with self.open_backup_pipe(backup) as read_pipe:
+            yield streaming.ChunkReader(self._restore_data(read_pipe))
+
+    def _plan_restore(self, backups, levels, data_indexes=None):
+        """Compute the final tree from the headers of all the levels.
+
+        Only the first segments of every backup holding its header are
+        downloaded.
+
+        :param backups: Dictionary[backup_level, backup]
+        :param levels: levels to restore, in order
+        :param data_indexes: dict of (data_index, salt) by level, for the
+                             levels read by ranges
+        :return: planner.RestorePlan or None if some level can only be
+                 restored on its own
+        """
+        plan = planner.RestorePlan()
+        for level in levels:
+            ranged = (data_indexes or {}).get(level)
+            if ranged:
+                data_index, salt = ranged
+                data_stream = streaming.ChunkReader(self._read_range_data(
+                    backups[level], data_index, None, 0, salt))
+                files_meta = self._load_files_meta(data_stream)
+            else:
+                with self._open_data_stream(backups[level]) as data_stream:
+                    files_meta = self._load_files_meta(data_stream)
+            if any('deltas' in fm for fm in files_meta):
+                LOG.info('Backup level {0} has legacy deltas, restoring '
+                         'the levels one by one'.format(level))
+                return None
+            plan.add_level(level, files_meta, self.rsync_block_size)
+        return plan
+
+    def _restore_plan(self, restore_path, backups, levels, plan,
+                      data_indexes=None):
+        """Write the final tree of the plan in restore_path.
+
+        :param restore_path: path where to restore
+        :param backups: Dictionary[backup_level, backup]
+        :param levels: levels to restore, in order
+        :param plan: planner.RestorePlan
+        :param data_indexes: dict of (data_index, salt) by level, for the
+                             levels read by ranges
+        """
+        level_pieces = plan.level_pieces()
+        for path in sorted(plan.removed_paths(), reverse=True):
+            file_abs_path = os.path.join(restore_path, path)
+            if os.path.lexists(file_abs_path):
+                self._remove_file(file_abs_path)
+
+        tasks = RestoreTasks(self.workers,
+                             self.workers * WORKER_QUEUE_DEPTH)
+        try:
+            reg_files, links = self._create_planned_files(restore_path,
+                                                          plan, tasks)
+            for level in levels:
+                pieces = level_pieces[level]
+                LOG.info('Restoring {0} of {1} bytes of data from level '
+                         '{2}'.format(sum(piece[1] for piece in pieces),
+                                      plan.data_sizes[level], level))
+                if not pieces:
+                    continue
+                ranged = (data_indexes or {}).get(level)
+                if ranged:
+                    self._restore_ranges(restore_path, backups[level],
+                                         pieces, *ranged)
+                    continue
+                with self._open_data_stream(backups[level]) as data_stream:
+                    self._load_files_meta(data_stream)
+                    self._write_pieces(restore_path, pieces, data_stream)
+
+            for path, target in links:
+                self._restore_hard_link(os.path.join(restore_path, target),
+                                        os.path.join(restore_path, path))
+            for path, inode in reg_files:
+                tasks.submit(self._set_inode,
+                             os.path.join(restore_path, path), inode)
+            tasks.finish()
+        finally:
+            tasks.shutdown()
+
+    def _get_data_index(self, backup):
+        """Download the data offset index of the backup, if the storage
+        supports ranged reads.
+
+        :param backup: Backup info
+        :return: tuple (dataindex.DataIndex, salt) where salt is the
+                 encryption header of the backup or None, or None if the
+                 backup cannot be read by ranges
+        """
+        self._load_backup_metadata(backup)
+        try:
+            # The first bytes are the encryption header, if any
+            head = b''.join(backup.storage.read_range(backup.data_path, 0,
+                                                      crypt.BS))
+        except NotImplementedError as error:
+            LOG.info('[*] {0}, reading the whole backup'.format(error))
+            return None
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            index_path = os.path.join(tmpdir, 'data_index')
+            try:
+                backup.storage.get_file(backup.data_index_path, index_path)
+            except Exception as error:
+                LOG.info('[*] Data index of backup level {0} not available: '
+                         '{1}'.format(backup.level, error))
+                return None
+            data_index = dataindex.DataIndex.read(index_path,
+                                                  self.compression_algo)
+        finally:
+            shutil.rmtree(tmpdir)
+        if not data_index or not data_index.points:
+            return None
+        return data_index, head if self.encrypt_pass_file else None
+
+    def _restore_ranges(self, restore_path, backup, pieces, data_index,
+                        salt):
+        """Write the pieces of data of a level read by ranges of the stored
+        backup, from the sync points of its data offset index.
+
+        :param restore_path: path where to restore
+        :param backup: Backup info
+        :param pieces: list of (stream_offset, length, path, file_offset) in
+                       stream order
+        :param data_index: dataindex.DataIndex of the backup
+        :param salt: encryption header of the backup or None
+        """
+        self._load_backup_metadata(backup)
+        runs = data_index.runs(pieces)
+        LOG.info('Reading {0} ranges of backup level {1}'.format(
+            len(runs), backup.level))
+        for start, end, run_pieces in runs:
+            data_offset = data_index.points[start][0]
+            data_stream = streaming.ChunkReader(self._read_range_data(
+                backup, data_index, start, end, salt))
+            self._write_pieces(
+                restore_path,
+                [(piece[0] - data_offset,) + tuple(piece[1:])
+                 for piece in run_pieces],
+                data_stream)
+
+    def _read_range_data(self, backup, data_index, start, end, salt=None):
+        """Decode the data stream of a backup between two sync points.
+
+        :param backup: Backup info
+        :param data_index: dataindex.DataIndex of the backup
+        :param start: index of the sync point to start from, None to start
+                      from the header
+        :param end: index of the sync point to stop at or None
+        :param salt: encryption header of the backup or None
+        :return: generator of decompressed data chunks
+        """
+        segment_size = data_index.segment_size
+        if start is None:
+            position = crypt.BS if salt else 0
+            decompressor = compress.Decompressor(self.compression_algo)
+        else:
+            position = data_index.points[start][1]
+            decompressor = compress.Decompressor(self.compression_algo,
+                                                 raw=True)
+        # The encrypted data is read from the start of the segment
+        first = position - position % segment_size if salt else position
+        length = None
+        if end is not None:
+            length = data_index.points[end][1] - first
+
+        chunks = backup.storage.read_range(backup.data_path, first, length)
+        if salt:
+            chunks = self._decrypt_segments(chunks, first // segment_size,
+                                            segment_size, salt,
+                                            position - first)
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+
+    def _decrypt_segments(self, chunks, segment, segment_size, salt,
+                          offset):
+        """Decrypt the data read from the start of a segment.
+
+        :param chunks: iterable of the encrypted data
+        :param segment: index of the first segment
+        :param segment_size: size of the segments of the stored object
+        :param salt: encryption header of the backup
+        :param offset: offset in the first segment of the data to return
+        :return: generator of decrypted data
+        """
+        decryptor = crypt.AESDecrypt(self.encrypt_pass_file, salt)
+        segments = streaming.SegmentBuilder(segment_size)
+
+        def decrypt(data):
+            if segment == 0:
+                # The encryption header is not encrypted
+                return decryptor.decrypt(data[crypt.BS:])[offset - crypt.BS:]
+            return decryptor.decrypt(data)[offset:]
+
+        for chunk in chunks:
+            for data in segments.add(chunk):
+                yield decrypt(data)
+                segment += 1
+                offset = 0
+        data = segments.flush()
+        if data:
+            yield decrypt(data)
+
+    def synthetic_data(self, backups, manifest_path):
+        """Merge a backup chain in the data of a level 0 backup.
+
+        The final tree is planned from the headers of all the levels, as
+        on restore. The live data of every level is downloaded once in a
+        local spool file, then the files are written in the new stream in
+        the order of its header.
+
+        :param backups: Dictionary[backup_level, backup]
+        :param manifest_path: local path where to write the engine metadata
+                              of the new backup
+        :return: generator of the segments of the backup data
+        """
+        LOG.info('Starting Rsync engine synthetic backup stream')
+        levels = list(self.restore_levels(backups))
+        plan = self._plan_restore(backups, levels)
+        if not plan:
+            raise Exception('The backups with legacy deltas cannot be '
+                            'merged')
+
+        self.get_engine_metadata(backups[levels[-1]], manifest_path)
+        self.write_engine_meta(manifest_path,
+                               self._synthetic_engine_meta(manifest_path))
+
+        spool_dir = tempfile.mkdtemp()
+        try:
+            self._spool_levels(spool_dir, backups, levels, plan)
+            backup_header, data_files = self._synthetic_header(plan)
+            for segment in self._encode_stream(self._synthetic_blocks(
+                    spool_dir, backup_header, data_files)):
+                yield segment
+        finally:
+            shutil.rmtree(spool_dir)
+
+        LOG.info('Rsync engine synthetic backup stream completed')
+
+    def _synthetic_engine_meta(self, manifest_path):
+        """Get the engine meta data of the last backup of a chain with all
+        the signatures inlined, as the backups they refer to are not part
+        of the new chain.
+
+        :param manifest_path: path of the engine meta data
+        :return: engine meta data
+        """
+        files_meta = self._load_engine_meta(manifest_path)
+        fs_meta_struct = files_meta.get('files', {})
+        ref_paths = [path for path, file_meta in six.iteritems(fs_meta_struct)
+                     if 'ref' in file_meta]
+        signatures = self._get_old_signatures(ref_paths, fs_meta_struct)
+        for path in ref_paths:
+            file_meta = fs_meta_struct[path]
+            del file_meta['ref']
+            if path in signatures:
+                file_meta['signature'] = signatures[path]
+        files_meta['rsync_struct_ver'] = RSYNC_DATA_STRUCT_VERSION
+        return files_meta
+
+    def _spool_levels(self, spool_dir, backups, levels, plan):
+        """Download the live data of every level in a spool file named by
+        the level, at its offset in the data stream.
+
+        :param spool_dir: path of the spool directory
+        :param backups: Dictionary[backup_level, backup]
+        :param levels: levels of the chain, in order
+        :param plan: planner.RestorePlan
+        """
+        level_pieces = plan.level_pieces()
+        for level in levels:
+            ranges = sorted(set(piece[:2] for piece in level_pieces[level]))
+            if not ranges:
+                continue
+            spool_name = str(level)
+            with open(os.path.join(spool_dir, spool_name), 'wb') as fd:
+                fd.truncate(plan.data_sizes[level])
+            with self._open_data_stream(backups[level]) as data_stream:
+                self._load_files_meta(data_stream)
+                self._write_pieces(
+                    spool_dir,
+                    [(offset, length, spool_name, offset)
+                     for offset, length in ranges],
+                    data_stream)
+
+    @staticmethod
+    def _synthetic_header(plan):
+        """Get the level 0 header of the final tree of the plan.
+
+        :param plan: planner.RestorePlan
+        :return: tuple (backup header, list of the planned regular files in
+                 the order of their data)
+        """
+        first_paths = {}
+        backup_header = []
+        links = []
+        data_files = []
+        for path in sorted(plan.files):
+            planned_file = plan.files[path]
+            file_header = dict(planned_file.header, path=path)
+            for key in ('link', 'prev_name', 'new_level', 'deleted', 'patch',
+                        'extents'):
+                file_header.pop(key, None)
+            target = first_paths.setdefault(id(planned_file), path)
+            if target != path:
+                file_header['link'] = target
+                links.append(file_header)
+                continue
+            if stat.S_ISREG(planned_file.mode):
+                extents = planned_file.data_ranges()
+                if extents != [[0, planned_file.size]] and (
+                        extents or planned_file.size):
+                    file_header['extents'] = extents
+                data_files.append(planned_file)
+            backup_header.append(file_header)
+        return backup_header + links, data_files
+
+    def _synthetic_blocks(self, spool_dir, backup_header, data_files):
+        """Read the data of the files from the spool files.
+
+        :param spool_dir: path of the spool directory
+        :param backup_header: list of file headers
+        :param data_files: planned regular files in the order of their data
+        :return: generator of the header and the data blocks
+        """
+        yield msgpack.dumps(backup_header)
+        spools = {}
+        try:
+            for planned_file in data_files:
+                for _, length, level, stream_offset in planned_file.pieces:
+                    spool = spools.get(level)
+                    if spool is None:
+                        spool = spools[level] = open(
+                            os.path.join(spool_dir, str(level)), 'rb')
+                    spool.seek(stream_offset)
+                    while length:
+                        block = spool.read(min(length,
+                                               self.max_segment_size))
+                        if not block:
+                            raise EOFError('Spool file of level {0} '
+                                           'truncated'.format(level))
+                        length -= len(block)
+                        yield block
+        finally:
+            for spool in six.itervalues(spools):
+                spool.close()
+
+    def _create_planned_files(self, restore_path, plan, tasks):
+        """Create the files of the final tree, the regular files are created
+        with their final size and no data.
+
+        :param restore_path: path where to restore
+        :param plan: planner.RestorePlan
+        :param tasks: RestoreTasks running the file operations
+        :return: list of (path, inode) of the regular files and list of
+                 (path, target path) of the hard links
+        """
+        first_paths = {}
+        reg_files = []
+        links = []
+        for path in sorted(plan.files):
+            planned_file = plan.files[path]
+            target = first_paths.setdefault(id(planned_file), path)
+            if target != path:
+                links.append((path, target))
+                continue
+
+            file_header = dict(planned_file.header, path=path)
+            for key in ('link', 'prev_name', 'new_level', 'deleted'):
+                file_header.pop(key, None)
+            if not stat.S_ISREG(planned_file.mode):
+                self._restore_file(file_header, restore_path, None, 0, tasks)
+                continue
+
+            file_abs_path = os.path.join(restore_path, path)
+            if os.path.lexists(file_abs_path):
+                self._remove_file(file_abs_path)
+            with open(file_abs_path, 'wb') as fd:
+                fd.truncate(planned_file.size)
+            reg_files.append((path, file_header['inode']))
+        return reg_files, links
+
+    def _write_pieces(self, restore_path, pieces, data_stream):
+        """Write the pieces of data of a level in their files.
+
+        The pieces sharing some data of the stream, as the copies of the
+        same block, are written from the same read.
+
+        :param restore_path: path where to restore
+        :param pieces: list of (stream_offset, length, path, file_offset) in
+                       stream order
+        :param data_stream: streaming.ChunkReader positioned at the start of
+                            the data of the level
+        """
+        files = collections.OrderedDict()
+        remaining = collections.Counter(piece[2] for piece in pieces)
+
+        def get_file(path):
+            fd = files.pop(path, None)
+            if fd is None:
+                if len(files) >= MAX_OPEN_FILES:
+                    files.popitem(last=False)[1].close()
+                fd = open(os.path.join(restore_path, path), 'rb+')
+            files[path] = fd
+            return fd
+
+        position = 0
+        index = 0
+        active = []
+        try:
+            while index < len(pieces) or active:
+                if not active:
+                    data_stream.skip(pieces[index][0] - position)
+                    position = pieces[index][0]
+                while index < len(pieces) and pieces[index][0] == position:
+                    active.append(pieces[index])
+                    index += 1
+
+                end = min(offset + length for offset, length, _, _ in active)
+                if index < len(pieces):
+                    end = min(end, pieces[index][0])
+                if len(active) == 1:
+                    stream_offset, _, path, file_offset = active[0]
+                    fd = get_file(path)
+                    fd.seek(file_offset + position - stream_offset)
+                    data_stream.write_to(fd, end - position)
+                else:
+                    end = min(end, position + MAX_RESTORE_BUFFERED)
+                    data = data_stream.read(end - position)
+                    if len(data) != end - position:
+                        raise EOFError('Data stream truncated, {0} bytes '
+                                       'missing'.format(
+                                           end - position - len(data)))
+                    for stream_offset, _, path, file_offset in active:
+                        fd = get_file(path)
+                        fd.seek(file_offset + position - stream_offset)
+                        fd.write(data)
+                position = end
+
+                for piece in [p for p in active if p[0] + p[1] == end]:
+                    active.remove(piece)
+                    remaining[piece[2]] -= 1
+                    if not remaining[piece[2]]:
+                        fd = files.pop(piece[2], None)
+                        if fd:
+                            fd.close()
+        finally:
+            for fd in six.itervalues(files):
+                fd.close()
+
+    @staticmethod
+    def _load_files_meta(data_stream):
+        """Unpack the files meta from the head of the data stream, the data
+        following it is left in the stream.
+
+        :param data_stream: streaming.ChunkReader
+        :return: list of file headers
+        """
+        unpacker = msgpack.Unpacker(max_buffer_size=0)
+        fed = 0
         while True:
+            chunk = data_stream.read_chunk()
+            if not len(chunk):
+                raise EOFError('Data stream truncated in the files meta')
+            unpacker.feed(chunk)
+            fed += len(chunk)
             try:
-                files_meta = msgpack.load(data_stream)
-            except msgpack.ExtraData as e:
-                files_meta = e.unpacked
-                data_stream = six.BytesIO(e.extra)
-                break
+                files_meta = unpacker.unpack()
             except msgpack.OutOfData:
-                data_stream.write(data_gen.next().read())
-                data_stream.seek(0)
-            else:
-                break
-        return files_meta, data_stream
+                continue
+            extra = fed - unpacker.tell()
+            data_stream.unread(chunk[len(chunk) - extra:])
+            return files_meta
 
     @staticmethod
     def _remove_file(file_abs_path):
@@ -241,31 +882,77 @@ class Rsyncv2Engine(engine.BackupEngine):
         except Exception as e:
             LOG.warning('[*] File or directory unlink error {}'.format(e))
 
-    def _restore_file(self, file_meta, restore_path, data_stream, data_gen,
-                      backup_level):
+    @staticmethod
+    def _move_renamed_files(files_meta, restore_path):
+        """Move the previous version of the renamed files out of the way,
+        so that their names can be reused in any order.
+
+        :param files_meta: list of file headers
+        :param restore_path: path where the files are restored
+        :return: the temporary directory holding the moved files, or None,
+                 and a dict of the moved files path by previous name
+        """
+        prev_names = [fm['prev_name'] for fm in files_meta
+                      if 'prev_name' in fm]
+        if not prev_names:
+            return None, {}
+
+        moved_dir = tempfile.mkdtemp(dir=restore_path,
+                                     prefix='.freezer_rename_')
+        moved_files = {}
+        for index, prev_name in enumerate(prev_names):
+            moved_path = os.path.join(moved_dir, str(index))
+            try:
+                os.rename(os.path.join(restore_path, prev_name), moved_path)
+            except (OSError, IOError) as error:
+                LOG.warning('[*] Unable to move renamed file {0}: {1}'.format(
+                    prev_name, error))
+                continue
+            moved_files[prev_name] = moved_path
+        return moved_dir, moved_files
+
+    def _restore_file(self, file_meta, restore_path, data_stream,
+                      backup_level, tasks, moved_files=None):
         file_abs_path = os.path.join(restore_path, file_meta['path'])
 
         inode = file_meta.get('inode', {})
         file_mode = inode.get('mode')
 
+        if 'link' in file_meta:
+            # The linked file may still be written by the workers
+            tasks.wait()
+            self._restore_hard_link(
+                os.path.join(restore_path, file_meta['link']), file_abs_path)
+            return
+
+        if 'prev_name' in file_meta:
+            moved_path = (moved_files or {}).get(
+                file_meta['prev_name'],
+                os.path.join(restore_path, file_meta['prev_name']))
+            self._rename_file(moved_path, file_abs_path)
+            if not file_meta.get('new_level'):
+                tasks.submit(self._set_inode, file_abs_path, inode)
+                return
+
         if os.path.exists(file_abs_path):
             if backup_level == 0:
                 self._remove_file(file_abs_path)
             else:
                 if file_meta.get('deleted'):
                     self._remove_file(file_abs_path)
-                    return data_stream
+                    return
                 elif file_meta.get('new_level') and not stat.S_ISREG(
                         file_mode):
-                    self._set_inode(file_abs_path, inode)
-                    return data_stream
+                    self._submit_set_inode(tasks, file_abs_path, inode)
+                    return
 
         if not file_mode:
-            return data_stream
+            return
 
         if stat.S_ISREG(file_mode):
-            data_stream = self._restore_reg_file(file_abs_path, file_meta,
-                                                 data_gen, data_stream)
+            self._restore_reg_file(file_abs_path, file_meta, data_stream,
+                                   tasks)
+            return
 
         elif stat.S_ISDIR(file_mode):
             try:
@@ -307,9 +994,34 @@ class Rsyncv2Engine(engine.BackupEngine):
                     file_abs_path, error))
 
         if not stat.S_ISLNK(file_mode):
-            self._set_inode(file_abs_path, inode)
+            self._submit_set_inode(tasks, file_abs_path, inode)
 
-        return data_stream
+    def _submit_set_inode(self, tasks, file_abs_path, inode):
+        """Set the inode of the file by the workers, or at the end of the
+        restore for the directories, so that their modification time and
+        their permissions do not change while their content is restored.
+        """
+        if stat.S_ISDIR(inode['mode']):
+            tasks.defer(self._set_inode, file_abs_path, inode)
+        else:
+            tasks.submit(self._set_inode, file_abs_path, inode)
+
+    def _restore_hard_link(self, target_abs_path, file_abs_path):
+        if os.path.lexists(file_abs_path):
+            self._remove_file(file_abs_path)
+        try:
+            os.link(target_abs_path, file_abs_path)
+        except (OSError, IOError) as error:
+            LOG.warning('Hard link {0} creation error: {1}'.format(
+                file_abs_path, error))
+
+    @staticmethod
+    def _rename_file(prev_abs_path, file_abs_path):
+        try:
+            os.rename(prev_abs_path, file_abs_path)
+        except (OSError, IOError) as error:
+            LOG.warning('Rename of {0} to {1} error: {2}'.format(
+                prev_abs_path, file_abs_path, error))
 
     @staticmethod
     def _make_dev_file(file_abs_path, dev, mode):
@@ -319,16 +1031,17 @@ class Rsyncv2Engine(engine.BackupEngine):
         os.mknod(file_abs_path, mode, new_dev)
 
     @staticmethod
-    def _create_reg_file(path, size, data_gen, data_stream):
+    def _create_reg_file(path, size, data_stream, extents=None):
         with open(path, 'wb') as fd:
-            while fd.tell() < size:
-                data = data_stream.read(size - fd.tell())
-                if not data:
-                    data_stream = data_gen.next()
-                    continue
-                fd.write(data)
+            if extents is None:
+                data_stream.write_to(fd, size)
+                return
 
-        return data_stream
+            # Sparse file, the holes are left unwritten
+            for offset, length in extents:
+                fd.seek(offset)
+                data_stream.write_to(fd, length)
+            fd.truncate(size)
 
     def _restore_data(self, read_pipe):
         try:
@@ -349,25 +1062,14 @@ class Rsyncv2Engine(engine.BackupEngine):
                     data_chunk += read_pipe.recv_bytes()
                     continue
                 if data_chunk:
-                    yield six.BytesIO(data_chunk)
+                    yield data_chunk
                 data_chunk = read_pipe.recv_bytes()
 
         except EOFError:
             LOG.info("[*] EOF from pipe. Flushing buffer.")
             data_chunk = decompressor.flush()
             if data_chunk:
-                yield six.BytesIO(data_chunk)
-
-    @staticmethod
-    def _process_backup_data(data, compressor, encryptor, do_compress=True):
-        """Compresses and encrypts provided data according to args"""
-
-        if do_compress:
-            data = compressor.compress(data)
-
-        if encryptor:
-            data = encryptor.encrypt(data)
-        return data
+                yield data_chunk
 
     @staticmethod
     def _process_restore_data(data, decompressor, decryptor):
@@ -379,42 +1081,260 @@ class Rsyncv2Engine(engine.BackupEngine):
         data = decompressor.decompress(data)
         return data
 
-    def _get_deltas_info(self, file_name, old_file_meta):
-        len_deltas = 0
-        old_signature = old_file_meta['signature']
+    def _get_executor(self):
+        """Create the worker pool used to diff and hash the files.
+
+        :return: a concurrent.futures executor or None if only one worker
+                 has been requested
+        """
+        if self.workers <= 1:
+            return None
+        if self.workers_type == 'process':
+            return futures.ProcessPoolExecutor(max_workers=self.workers)
+        return futures.ThreadPoolExecutor(max_workers=self.workers)
+
+    def _get_deltas_info(self, backup_header, old_fs_meta_struct,
+                         files_meta, executor):
+        """Compute the modified blocks of all the changed regular files.
+
+        The deltas are computed concurrently by the executor workers and
+        stored in the related file header. The same read of the files
+        provides their new signature and their literal data, kept in memory
+        up to MAX_CACHED_LITERALS bytes so that they are not read again.
+
+        :param backup_header: list of file headers
+        :param old_fs_meta_struct: files meta data of the previous backup
+        :param files_meta: files meta data of the current backup
+        :param executor: workers pool or None
+        :return: dict of the cached literal data by path
+        """
+        modified_files = [f for f in backup_header if f.get('new_level') and
+                          stat.S_ISREG(f['inode']['mode']) and
+                          'link' not in f]
+        # The renamed files are diffed with their previous name
+        signatures = self._get_old_signatures(
+            (f.get('prev_name', f['path']) for f in modified_files),
+            old_fs_meta_struct)
+        for f in modified_files:
+            if f.get('prev_name') and f['prev_name'] not in signatures:
+                del f['prev_name']
+                del f['new_level']
+        # The files without signature are fully backed up
+        modified_files = [f for f in modified_files
+                          if f.get('prev_name', f['path']) in signatures]
+        args = ((f['path'], signatures[f.get('prev_name', f['path'])],
+                 self.rsync_block_size, pyrsync.STRONG_HASH,
+                 MAX_PATCH_LITERALS)
+                for f in modified_files)
+
+        deltas_info = utils.imap_ordered(executor, pyrsync.rsyncpatch_info,
+                                         args,
+                                         self.workers * WORKER_QUEUE_DEPTH)
+
         rsync_bs = self.rsync_block_size
+        cached_literals = {}
+        cached_size = 0
+        for file_header, delta_info in six.moves.zip(modified_files,
+                                                     deltas_info):
+            (len_literals, patch, fixed_blocks, signature,
+             literals) = delta_info
+            self.modified_blocks += (len_literals + rsync_bs - 1) // rsync_bs
+            self.fixed_blocks += fixed_blocks
+            file_header['patch'] = patch
+            # The patched files are rebuilt from their previous version
+            file_header.pop('extents', None)
+            files_meta['files'][file_header['path']]['signature'] = signature
+            if (literals is not None and
+                    cached_size + len(literals) <= MAX_CACHED_LITERALS):
+                cached_literals[file_header['path']] = literals
+                cached_size += len(literals)
+
+        return cached_literals
+
+    def _find_links(self, backup_header, old_fs_meta_struct, files_meta):
+        """Detect the hard links and the renamed regular files.
+
+        The files sharing the same inode are backed up once: the other
+        paths get a 'link' to the path holding the data and are moved to
+        the end of the header, after it. A new path whose inode was backed
+        up under a name that no longer exists, or that now holds another
+        file, is a renamed file: it gets a 'prev_name' and is diffed with
+        the previous name if modified, or carries no data at all otherwise.
+
+        :param backup_header: list of file headers
+        :param old_fs_meta_struct: files meta data of the previous backup
+        :param files_meta: files meta data of the current backup
+        :return: list of file headers
+        """
+        new_files = files_meta['files']
+        # The paths holding data in the previous backup, by inode
+        old_inodes = {}
+        for old_path, old_meta in six.iteritems(old_fs_meta_struct):
+            if 'ino' in old_meta and ('signature' in old_meta or
+                                      'ref' in old_meta):
+                old_inodes[(old_meta['dev'], old_meta['ino'])] = old_path
+
+        inodes = collections.OrderedDict()
+        reg_headers = {}
+        for file_header in backup_header:
+            inode = file_header.get('inode')
+            if inode and stat.S_ISREG(inode['mode']):
+                file_meta = new_files[file_header['path']]
+                inodes.setdefault((file_meta['dev'], file_meta['ino']),
+                                  []).append(file_header)
+                reg_headers[file_header['path']] = file_header
+
+        links = []
+        for inode_key, headers in six.iteritems(inodes):
+            old_path = old_inodes.get(inode_key)
+            target = headers[0]
+            for file_header in headers:
+                if file_header['path'] == old_path:
+                    target = file_header
+            for file_header in headers:
+                if file_header is not target:
+                    file_header.pop('new_level', None)
+                    file_header['link'] = target['path']
+                    links.append(file_header)
+
+            if not old_path or target['path'] in old_fs_meta_struct:
+                continue
+            if old_path in new_files:
+                # The previous name holds another file, backed up in full
+                # as the renamed data is moved away on restore
+                reused_header = reg_headers.get(old_path)
+                if not reused_header or reused_header in headers:
+                    continue
+                reused_header.pop('new_level', None)
+            self._set_renamed(target, old_path,
+                              old_fs_meta_struct[old_path], new_files)
 
-        # Get changed blocks index only
-        index = 0
-        modified_blocks = []
-        with open(file_name, 'rb') as fd:
-            for block_index in pyrsync.rsyncdelta_fast(
-                    fd,
-                    (old_signature[0], old_signature[1]),
-                    rsync_bs):
-
-                if not isinstance(block_index, int):
-                    block_len = len(block_index)
-                    if block_len > 0:
-                        len_deltas += block_len
-                        modified_blocks.append(index)
-                        self.modified_blocks += 1
-                else:
-                    self.fixed_blocks += 1
+        if not links:
+            return backup_header
+        return [f for f in backup_header if 'link' not in f] + links
 
-                index += 1
+    def _set_renamed(self, file_header, prev_name, old_file_meta, new_files):
+        """Mark the file as renamed from prev_name.
 
-        return len_deltas, modified_blocks
+        :param file_header: header of the file
+        :param prev_name: path of the file in the previous backup
+        :param old_file_meta: meta data of the previous backup execution
+        :param new_files: files meta data of the current backup by path
+        """
+        file_path = file_header['path']
+        file_header['prev_name'] = prev_name
+        file_meta = new_files[file_path]
+        if (old_file_meta['mtime'] == file_meta['mtime'] and
+                old_file_meta['size'] == file_meta['size']):
+            # Only renamed, the data of the previous backup is reused
+            carried_meta = dict(self._carry_file_meta(old_file_meta))
+            carried_meta.update(file_meta)
+            new_files[file_path] = carried_meta
+        else:
+            file_header['new_level'] = True
+
+    @staticmethod
+    def _has_data(file_header):
+        """Check if the file data follows the header in the backup stream.
 
-    def _backup_deltas(self, file_header, write_queue):
-        _, modified_blocks = file_header['deltas']
+        :param file_header: header of the file
+        :return: True for the regular files backed up or patched
+        """
+        inode = file_header.get('inode')
+        if not inode or not stat.S_ISREG(inode['mode']):
+            return False
+        if 'link' in file_header:
+            return False
+        return 'prev_name' not in file_header or 'new_level' in file_header
+
+    def _get_old_signatures(self, rel_paths, old_fs_meta_struct):
+        """Get the signatures of the previous version of the files.
+
+        The signatures stored in older backups of the same level zero are
+        downloaded once per backup.
+
+        :param rel_paths: iterable of related file paths
+        :param old_fs_meta_struct: files meta data of the previous backup
+        :return: dict of the available signatures by path
+        """
+        signatures = {}
+        refs = collections.defaultdict(list)
+        for rel_path in rel_paths:
+            old_file_meta = old_fs_meta_struct[rel_path]
+            if 'signature' in old_file_meta:
+                signatures[rel_path] = old_file_meta['signature']
+            elif 'ref' in old_file_meta:
+                refs[tuple(old_file_meta['ref'])].append(rel_path)
+
+        for ref, ref_paths in six.iteritems(refs):
+            if not self.manifest_backup:
+                LOG.warning('[*] Signatures of backup {0} not available, {1} '
+                            'files will be fully backed up'.format(
+                                ref, len(ref_paths)))
+                continue
+            ref_fs_meta_struct = self._get_ref_fs_meta_struct(ref)
+            for rel_path in ref_paths:
+                signature = ref_fs_meta_struct.get(rel_path, {}).get(
+                    'signature')
+                if signature:
+                    signatures[rel_path] = signature
+
+        return signatures
+
+    def _get_ref_fs_meta_struct(self, ref):
+        """Download the files meta data of a previous backup.
+
+        :param ref: [level, timestamp] of a backup of the same level zero
+                    of the backup of the current meta data
+        :return: files meta data
+        """
+        level, timestamp = ref
+        ref_backup = base.Backup(
+            engine=self,
+            hostname_backup_name=self.manifest_backup.hostname_backup_name,
+            level_zero_timestamp=self.manifest_backup.level_zero_timestamp,
+            timestamp=timestamp,
+            level=level,
+            storage=self.manifest_backup.storage)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ref_meta_path = os.path.join(tmpdir, 'engine_meta')
+            ref_backup.storage.get_file(ref_backup.engine_metadata_path,
+                                        ref_meta_path)
+            return self.get_fs_meta_struct(ref_meta_path)[0]
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _backup_patch(self, file_header, write_queue, literals=None):
+        """Put on the queue the literal data of the file patch.
+
+        :param file_header: header of the file
+        :param write_queue: backup data queue
+        :param literals: literal data of the patch if already read
+        """
         rsync_bs = self.rsync_block_size
+        max_seg_size = self.max_segment_size
+        if literals is not None:
+            for offset in range(0, len(literals), max_seg_size):
+                write_queue.put(literals[offset:offset + max_seg_size])
+            return
+
+        offset = 0
         with open(file_header['path'], 'rb') as fd:
-            for block_index in modified_blocks:
-                offset = block_index * rsync_bs
+            for block_index, count in file_header['patch']:
+                if block_index != pyrsync.LITERAL:
+                    offset += count * rsync_bs
+                    continue
                 fd.seek(offset)
-                data_block = fd.read(rsync_bs)
-                write_queue.put(data_block)
+                offset += count
+                while count:
+                    data_block = fd.read(min(count, max_seg_size))
+                    if not data_block:
+                        raise Exception('[*] File {} changed during the '
+                                        'backup'.format(file_header['path']))
+                    write_queue.put(data_block)
+                    count -= len(data_block)
 
     @staticmethod
     def _is_file_modified(old_inode, inode):
@@ -434,8 +1354,7 @@ class Rsyncv2Engine(engine.BackupEngine):
 
         return file_change_flag
 
-    def _patch_reg_file(self, file_path, size, data_stream, data_gen,
-                        deltas_info):
+    def _patch_reg_file(self, file_path, size, data_stream, deltas_info):
         len_deltas, modified_blocks = deltas_info
         rsync_bs = self.rsync_block_size
         if len_deltas:
@@ -444,52 +1363,121 @@ class Rsyncv2Engine(engine.BackupEngine):
             # Get all the block index offset from
             with open(file_path, 'rb+') as fd:
                 for block_index in modified_blocks:
-                    data_stream = self._patch_block(
-                        fd, block_index, data_stream, data_gen,
-                        rsync_bs, rsync_bs)
+                    self._patch_block(fd, block_index, data_stream,
+                                      rsync_bs, rsync_bs)
 
-                data_stream = self._patch_block(
-                    fd, last_block, data_stream, data_gen,
-                    reminder if reminder else rsync_bs, rsync_bs)
+                self._patch_block(fd, last_block, data_stream,
+                                  reminder if reminder else rsync_bs, rsync_bs)
 
                 fd.truncate(size)
 
-        return data_stream
-
     @staticmethod
-    def _patch_block(fd, block_index, data_stream, data_gen, size, bs):
+    def _patch_block(fd, block_index, data_stream, size, bs):
         offset = block_index * bs
         fd.seek(offset)
+        data_stream.write_to(fd, size)
+
+    def _apply_patch(self, file_path, patch, data_stream):
+        """Rebuild the file from the blocks of its previous version and the
+        literal data of the stream, then replace it.
 
-        data_stream_pos = data_stream.tell()
-        while (data_stream.len - data_stream.tell()) < size:
-            data_stream.write(data_gen.next().read())
-            data_stream.flush()
-            data_stream.seek(data_stream_pos)
+        :param file_path: path of the previous version of the file
+        :param patch: list of [block_index, count] operations
+        :param data_stream: streaming.ChunkReader
+        """
+        rsync_bs = self.rsync_block_size
+        fd, new_path = tempfile.mkstemp(dir=os.path.dirname(file_path),
+                                        prefix='.freezer_patch_')
+        try:
+            with os.fdopen(fd, 'wb') as new_fd:
+                # Unbuffered, the holes are looked up on the same descriptor
+                with open(file_path, 'rb', 0) as old_fd:
+                    old_size = os.fstat(old_fd.fileno()).st_size
+                    position = 0
+                    for block_index, count in patch:
+                        if block_index == pyrsync.LITERAL:
+                            data_stream.write_to(new_fd, count)
+                            position += count
+                        else:
+                            offset = block_index * rsync_bs
+                            end = min(offset + count * rsync_bs, old_size)
+                            self._copy_range(old_fd, new_fd, position,
+                                             offset, end)
+                            position += max(end - offset, 0)
+                    # Extend the file if it ends with a hole
+                    new_fd.truncate()
+            os.rename(new_path, file_path)
+        except Exception:
+            os.unlink(new_path)
+            raise
 
-        fd.write(data_stream.read(size))
-        return data_stream
+    def _copy_range(self, src_fd, dst_fd, dst_offset, start, end):
+        """Copy the data between the start and end offsets of src_fd at
+        dst_offset, the current position of dst_fd. The holes of src_fd are
+        seeked over so that they are kept in dst_fd.
+        """
+        position = dst_offset
+        for offset, length in utils.data_extents(src_fd.fileno(), start, end):
+            if dst_offset + offset - start != position:
+                position = dst_offset + offset - start
+                dst_fd.seek(position)
+            src_fd.seek(offset)
+            self._copy_data(src_fd, dst_fd, length)
+            position += length
+        end_position = dst_offset + max(end - start, 0)
+        if position != end_position:
+            dst_fd.seek(end_position)
+
+    def _copy_data(self, src_fd, dst_fd, size):
+        buf = memoryview(bytearray(min(size, self.max_segment_size)))
+        while size:
+            read = src_fd.readinto(buf[:min(size, len(buf))])
+            if not read:
+                break
+            dst_fd.write(buf[:read])
+            size -= read
 
-    def _restore_reg_file(self, file_path, file_meta, data_gen, data_chunk):
+    def _restore_reg_file(self, file_path, file_meta, data_stream, tasks):
         """Create the regular file and write data on it.
 
-        :param size:
+        The data of the small files is read from the stream and written
+        by the workers, the other files are written at once.
+
         :param file_path:
         :param file_meta:
-        :param data_gen:
-        :param data_chunk:
-        :return:
+        :param data_stream: streaming.ChunkReader
+        :param tasks: RestoreTasks running the file operations
         """
 
         new_level = file_meta.get('new_level', False)
         deltas = file_meta.get('deltas')
-        size = file_meta['inode']['size']
-        if new_level and deltas:
-            return self._patch_reg_file(file_path, size, data_chunk,
-                                        data_gen, deltas)
+        inode = file_meta['inode']
+        size = inode['size']
+        extents = file_meta.get('extents')
+        if new_level and 'patch' in file_meta:
+            self._apply_patch(file_path, file_meta['patch'], data_stream)
+        elif new_level and deltas:
+            self._patch_reg_file(file_path, size, data_stream, deltas)
+        elif tasks.concurrent and size <= MAX_RESTORE_BUFFERED:
+            data_size = size
+            if extents is not None:
+                data_size = sum(length for offset, length in extents)
+            data = data_stream.read(data_size)
+            if len(data) != data_size:
+                raise EOFError('Data stream truncated, {0} bytes '
+                               'missing'.format(data_size - len(data)))
+            tasks.submit(self._write_reg_file, file_path, size, data,
+                         extents, inode)
+            return
         else:
-            return self._create_reg_file(file_path, size,
-                                         data_gen, data_chunk)
+            self._create_reg_file(file_path, size, data_stream, extents)
+        tasks.submit(self._set_inode, file_path, inode)
+
+    def _write_reg_file(self, file_path, size, data, extents, inode):
+        """Create the regular file from its data and set its inode."""
+        self._create_reg_file(file_path, size, streaming.ChunkReader([data]),
+                              extents)
+        self._set_inode(file_path, inode)
 
     @staticmethod
     def _set_inode(file_path, inode):
@@ -501,13 +1489,13 @@ class Rsyncv2Engine(engine.BackupEngine):
         """
 
         try:
-            set_uid = pwd.getpwnam(inode['uname']).pw_uid
-            set_gid = grp.getgrnam(inode['gname']).gr_gid
-        except (IOError, OSError):
+            set_uid = scanner.get_user_id(inode['uname'])
+            set_gid = scanner.get_group_id(inode['gname'])
+        except (IOError, OSError, KeyError):
             try:
-                set_uid = pwd.getpwnam(getpass.getuser()).pw_uid
-                set_gid = grp.getgrnam(getpass.getuser()).gr_gid
-            except (OSError, IOError) as err:
+                set_uid = scanner.get_user_id(getpass.getuser())
+                set_gid = scanner.get_group_id(getpass.getuser())
+            except (OSError, IOError, KeyError) as err:
                 raise Exception(err)
         try:
             os.chown(file_path, set_uid, set_gid)
@@ -522,8 +1510,8 @@ class Rsyncv2Engine(engine.BackupEngine):
         header_meta = {
             'mode': os_stat.st_mode,
             'dev': os_stat.st_dev,
-            'uname': pwd.getpwuid(os_stat.st_uid).pw_name,
-            'gname': grp.getgrgid(os_stat.st_gid).gr_name,
+            'uname': scanner.get_user_name(os_stat.st_uid),
+            'gname': scanner.get_group_name(os_stat.st_gid),
             'atime': os_stat.st_atime,
             'mtime': os_stat.st_mtime,
             'size': os_stat.st_size
@@ -532,58 +1520,102 @@ class Rsyncv2Engine(engine.BackupEngine):
         incremental_meta = {
             'mode': os_stat.st_mode,
             'ctime': os_stat.st_ctime,
-            'mtime': os_stat.st_mtime
+            'mtime': os_stat.st_mtime,
+            'dev': os_stat.st_dev,
+            'ino': os_stat.st_ino,
+            'size': os_stat.st_size
         }
 
         return header_meta, incremental_meta
 
-    def _get_file_stat(self, rel_path):
-        """Generate file meta data from file path.
-
-        Return the meta data as a two dicts: header and incremental
+    @staticmethod
+    def _get_file_stat(rel_path, entry=None):
+        """Get the inode information of a file, without following links.
 
         :param rel_path: related file path
-        :return: file meta as a two dicts
+        :param entry: scanner entry of the file, its cached stat is reused
+        :return: os.stat_result
         """
-
-        # Get file inode information
         try:
-            os_stat = os.lstat(rel_path)
+            if entry is not None:
+                return entry.stat(follow_symlinks=False)
+            return os.lstat(rel_path)
         except (OSError, IOError) as error:
             raise Exception('[*] Error on file stat: {}'.format(error))
 
-        return self._parse_file_stat(os_stat)
+    @staticmethod
+    def _get_data_extents(file_path, os_stat):
+        """Find the data ranges of a sparse file.
+
+        :param file_path: related file path
+        :param os_stat: inode information of the file
+        :return: list of [offset, length] or None if the file has no holes
+        """
+        size = os_stat.st_size
+        blocks = getattr(os_stat, 'st_blocks', None)
+        if blocks is None or blocks * 512 >= size:
+            return None
 
-    def _backup_file(self, file_path, write_queue):
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            extents = [[offset, length] for offset, length in
+                       utils.data_extents(fd, 0, size)]
+        finally:
+            os.close(fd)
+
+        if extents == [[0, size]]:
+            return None
+        return extents
+
+    def _backup_file(self, file_path, write_queue, extents=None, size=0):
+        """Put on the queue the data of the file.
+
+        :param file_path: related file path
+        :param write_queue: backup data queue
+        :param extents: data ranges of a sparse file, only they are read
+        :param size: size of the sparse file
+        :return: signature of the file
+        """
         max_seg_size = self.max_segment_size
+        checksums = pyrsync.BlockChecksums(self.rsync_block_size)
         with open(file_path, 'rb') as file_path_fd:
+            if extents is not None:
+                self._backup_extents(file_path_fd, write_queue, extents,
+                                     size, checksums)
+                return checksums.signature()
+
             data_block = file_path_fd.read(max_seg_size)
 
             while data_block:
+                checksums.update(data_block)
                 write_queue.put(data_block)
                 data_block = file_path_fd.read(max_seg_size)
 
-    @staticmethod
-    def _find_same_inode(file_path, old_files):
-        """Find same file meta data for given file name.
-
-        Return the same file name in incremental info if file was removed.
+        return checksums.signature()
 
-        :param file_path: related file path
-        :return: the same file name
+    def _backup_extents(self, fd, write_queue, extents, size, checksums):
+        """Put on the queue the data ranges of a sparse file, the holes are
+        only accounted in its signature.
         """
-
-        file_name = os.path.basename(file_path)
-        for fn in six.iterkeys(old_files):
-            base_name = os.path.basename(fn)
-            if fnmatch.fnmatch(base_name, '*' + file_name + '*'):
-                return base_name
-        return None
+        max_seg_size = self.max_segment_size
+        position = 0
+        for offset, length in extents:
+            checksums.update_zeros(offset - position)
+            position = offset + length
+            fd.seek(offset)
+            while length:
+                data_block = fd.read(min(length, max_seg_size))
+                if not data_block:
+                    raise Exception('[*] File {} changed during the '
+                                    'backup'.format(fd.name))
+                checksums.update(data_block)
+                write_queue.put(data_block)
+                length -= len(data_block)
+        checksums.update_zeros(size - position)
 
     @staticmethod
     def _get_old_file_meta(file_path, file_stat, old_fs_meta_struct):
         old_file_meta = None
-        prev_name = None
         if old_fs_meta_struct:
             try:
                 old_file_meta = old_fs_meta_struct[file_path]
@@ -594,10 +1626,11 @@ class Rsyncv2Engine(engine.BackupEngine):
             except KeyError:
                 pass
 
-        return old_file_meta, prev_name
+        return old_file_meta
 
-    def _prepare_file_info(self, file_path, old_fs_meta_struct):
-        file_stat, file_meta = self._get_file_stat(file_path)
+    def _prepare_file_info(self, file_path, old_fs_meta_struct, entry=None):
+        os_stat = self._get_file_stat(file_path, entry)
+        file_stat, file_meta = self._parse_file_stat(os_stat)
         file_mode = file_stat['mode']
 
         if stat.S_ISSOCK(file_mode):
@@ -608,44 +1641,69 @@ class Rsyncv2Engine(engine.BackupEngine):
         if stat.S_ISLNK(file_mode):
             file_header['lname'] = os.readlink(file_path)
 
-        old_file_meta, old_name = self._get_old_file_meta(
+        old_file_meta = self._get_old_file_meta(
             file_path, file_stat, old_fs_meta_struct)
-        if old_name:
-            file_header['prev_name'] = old_name
 
         if old_file_meta:
             if self._is_file_modified(old_file_meta, file_meta):
                 file_header['new_level'] = True
             else:
-                return old_file_meta, None
-
-        if not stat.S_ISREG(file_mode):
-            return file_meta, file_header
+                carried_meta = dict(self._carry_file_meta(old_file_meta))
+                carried_meta.update(file_meta)
+                return carried_meta, None
 
-        if old_file_meta:
-            len_deltas, mod_blocks = self._get_deltas_info(file_path,
-                                                           old_file_meta)
-            if len_deltas:
-                file_header['deltas'] = (len_deltas, mod_blocks)
+        if stat.S_ISREG(file_mode):
+            extents = self._get_data_extents(file_path, os_stat)
+            if extents is not None:
+                file_header['extents'] = extents
 
         return file_meta, file_header
 
+    def _carry_file_meta(self, old_file_meta):
+        """Get the meta data of an unchanged file.
+
+        The signature stored in the previous backup is referred by its
+        level and timestamp instead of being copied.
+
+        :param old_file_meta: meta data of the previous backup execution
+        :return: file meta data
+        """
+        if 'signature' not in old_file_meta or not self.manifest_backup:
+            return old_file_meta
+
+        file_meta = dict(old_file_meta)
+        del file_meta['signature']
+        file_meta['ref'] = [self.manifest_backup.level,
+                            self.manifest_backup.timestamp]
+        return file_meta
+
     def _get_file_meta(self, fn, fs_path, old_fs_meta_struct, files_meta,
-                       files_header, counts):
+                       files_header, counts, entry=None):
         file_path = os.path.relpath(fn, fs_path)
         header_append = files_header.append
-        counts['backup_size_on_disk'] += os.path.getsize(file_path)
-        meta, header = self._prepare_file_info(file_path, old_fs_meta_struct)
+        meta, header = self._prepare_file_info(file_path, old_fs_meta_struct,
+                                               entry)
+        if entry is not None:
+            counts['backup_size_on_disk'] += entry.stat(
+                follow_symlinks=False).st_size
+        else:
+            counts['backup_size_on_disk'] += os.path.getsize(file_path)
         if meta:
             files_meta['files'][file_path] = meta
         if header:
             header_append(header)
 
-    def _backup_reg_file(self, backup_meta, write_queue):
-        if backup_meta.get('deltas'):
-            self._backup_deltas(backup_meta, write_queue)
+    def _backup_reg_file(self, backup_meta, write_queue, literals=None):
+        """Put on the queue the data of the regular file.
+
+        :return: signature of the file if fully read, None otherwise
+        """
+        if 'patch' in backup_meta:
+            self._backup_patch(backup_meta, write_queue, literals)
         else:
-            self._backup_file(backup_meta['path'], write_queue)
+            return self._backup_file(backup_meta['path'], write_queue,
+                                     backup_meta.get('extents'),
+                                     backup_meta['inode']['size'])
 
     def get_sign_delta(self, fs_path, manifest_path, write_queue):
         """Compute the file or fs tree path signatures.
@@ -681,44 +1739,56 @@ class Rsyncv2Engine(engine.BackupEngine):
         backup_header = []
 
         # Grab list of all files and directories
-        exclude = self.exclude
         if os.path.isdir(fs_path):
-            for dn, dl, fl in os.walk(fs_path):
-                for dir_name in dl:
-                    self._get_file_meta(os.path.join(dn, dir_name),
-                                        fs_path, old_fs_meta_struct,
-                                        files_meta, backup_header, counts)
+            for dn, dl, fl in scanner.walk(fs_path, self.exclude,
+                                           workers=self.scan_workers):
+                for entry in dl:
+                    self._get_file_meta(entry.path, fs_path,
+                                        old_fs_meta_struct, files_meta,
+                                        backup_header, counts, entry)
                     counts['total_dirs'] += 1
 
-                if exclude:
-                    fl = (fn for fn in fl if not fnmatch.fnmatch(fn, exclude))
-
-                for fn in fl:
-                    self._get_file_meta(os.path.join(dn, fn), fs_path,
+                for entry in fl:
+                    self._get_file_meta(entry.path, fs_path,
                                         old_fs_meta_struct, files_meta,
-                                        backup_header, counts)
+                                        backup_header, counts, entry)
                     counts['total_files'] += 1
         else:
             self._get_file_meta(fs_path, os.getcwd(), old_fs_meta_struct,
                                 files_meta, backup_header, counts)
             counts['total_files'] += 1
 
+        backup_header = self._find_links(backup_header, old_fs_meta_struct,
+                                         files_meta)
+
         # Check for deleted files
         for del_file in (f for f in six.iterkeys(old_fs_meta_struct) if
                          f not in files_meta['files']):
             backup_header.append({'path': del_file, 'deleted': True})
 
-        # Write backup header
-        write_queue.put(msgpack.dumps(backup_header))
-
-        # Backup reg files
-        reg_files = (f for f in backup_header if f.get('inode') and
-                     stat.S_ISREG(f['inode']['mode']))
-
-        for reg_file in reg_files:
-            self._backup_reg_file(reg_file, write_queue)
-            self._compute_checksums(reg_file['path'],
-                                    files_meta['files'][reg_file['path']])
+        executor = self._get_executor()
+        try:
+            cached_literals = self._get_deltas_info(
+                backup_header, old_fs_meta_struct, files_meta, executor)
+
+            # Write backup header
+            write_queue.put(msgpack.dumps(backup_header))
+
+            # Backup reg files
+            reg_files = [f for f in backup_header if self._has_data(f)]
+
+            # The signatures of the patched files have been computed with
+            # their delta, the others are computed while reading their data
+            for reg_file in reg_files:
+                signature = self._backup_reg_file(
+                    reg_file, write_queue,
+                    cached_literals.pop(reg_file['path'], None))
+                if signature:
+                    files_meta['files'][reg_file['path']]['signature'] = \
+                        signature
+        finally:
+            if executor:
+                executor.shutdown()
 
         LOG.info("Backup session metrics: {0}".format(counts))
         LOG.info("Count of modified blocks %s, count of fixed blocks %s" % (
@@ -738,19 +1808,38 @@ class Rsyncv2Engine(engine.BackupEngine):
             manifest_file.write(cmp_meta)
 
     def get_fs_meta_struct(self, fs_meta_path):
+        """Load the files meta data of a backup.
+
+        :param fs_meta_path: path of the engine meta data
+        :return: files meta data and rsync block size
+        """
+        old_files_meta = self._load_engine_meta(fs_meta_path)
+        return (old_files_meta.get('files', {}),
+                old_files_meta.get('rsync_block_size'))
+
+    def _load_engine_meta(self, fs_meta_path):
+        """Load the engine meta data of a backup.
+
+        The regular files meta data hold either their signature, as
+        [strong hash name, packed weak hashes, strong hashes], or the
+        [level, timestamp] ref of the backup storing it. The signatures of
+        the struct versions up to 3 are converted.
+
+        :param fs_meta_path: path of the engine meta data
+        :return: engine meta data, empty if not available
+        """
         old_files_meta = {}
 
         if os.path.isfile(fs_meta_path):
-            with open(fs_meta_path) as meta_file:
+            with open(fs_meta_path, 'rb') as meta_file:
                 old_files_meta = msgpack.loads(compress.one_shot_decompress(
                     self.compression_algo, meta_file.read()))
 
-        old_fs_meta_struct = old_files_meta.get('files', {})
-        rsync_bs = old_files_meta.get('rsync_block_size')
-
-        return old_fs_meta_struct, rsync_bs
+        if old_files_meta.get('rsync_struct_ver', 0) < 4:
+            for old_file_meta in six.itervalues(
+                    old_files_meta.get('files', {})):
+                if 'signature' in old_file_meta:
+                    old_file_meta['signature'] = pyrsync.legacy_signature(
+                        old_file_meta['signature'])
 
-    def _compute_checksums(self, rel_path, file_meta):
-        # Files type where the file content can be backed up
-        args = (rel_path, self.rsync_block_size)
-        file_meta['signature'] = pyrsync.blockchecksums(args)
+        return old_files_meta
@@ -101,6 +101,9 @@ class InfoJob(Job):
         pass
 
     def execute(self):
+        if self.storage.catalog and self.conf.hostname_backup_name:
+            return self._catalog_info()
+
         info = self.storage.info()
         if not info:
             return
@@ -123,6 +126,24 @@ class InfoJob(Job):
                 break  # values for given container were found
         return [fields, data]
 
+    def _catalog_info(self):
+        """List the backups of the backup name recorded in the catalog,
+        syncing the catalog from the storage if needed.
+        """
+        fields = ["Storage", "Level Zero Timestamp", "Level", "Timestamp",
+                  "Size"]
+        storages = getattr(self.storage, 'storages', [self.storage])
+        data = []
+        for storage in storages:
+            for zero in storage.get_level_zero(
+                    self.engine, self.conf.hostname_backup_name):
+                zero.get_increments()
+            for row in storage.catalog.backups(
+                    storage, self.engine.name,
+                    self.conf.hostname_backup_name):
+                data.append([storage.catalog_key()] + list(row))
+        return [fields, data]
+
 
 class BackupJob(Job):
 
@@ -375,6 +396,10 @@ class RestoreJob(Job):
             raise Exception(
                 'no-incremental option is not compatible '
                 'with backup level options')
+        if self.conf.restore_path_filter and \
+                not self.engine.supports_path_filter:
+            raise ValueError("--restore-path-filter is not supported by the "
+                             "{0} engine".format(self.engine.name))
 
     def execute(self):
         conf = self.conf
@@ -496,10 +521,18 @@ class AdminJob(Job):
             if not self.conf.fullbackup_rotation:
                 raise Exception("The parameter --fullbackup-rotation "
                                 "is required")
-        elif not (self.conf.remove_from_date or self.conf.remove_older_than):
+        elif not (self.conf.remove_from_date or self.conf.remove_older_than or
+                  self.conf.synthetic_full):
             raise ValueError("You need to provide to remove backup older "
                              "than this time. You can use --remove-older-than "
                              "or --remove-from-date")
+        if self.conf.synthetic_full and self.conf.backup_media != 'fs':
+            raise ValueError("--synthetic-full is only supported with the fs "
+                             "backup media")
+        if self.conf.synthetic_full and \
+                not self.engine.supports_synthetic:
+            raise ValueError("--synthetic-full is not supported by the {0} "
+                             "engine".format(self.engine.name))
 
     def execute(self):
         # remove backups by freezer admin action
@@ -510,6 +543,11 @@ class AdminJob(Job):
                 self.conf.cindernative_vol_id,
                 self.conf.fullbackup_rotation)
             return {}
+        if self.conf.synthetic_full:
+            self.engine.synthetic_backup(self.conf.hostname_backup_name)
+            if not (self.conf.remove_from_date or
+                    self.conf.remove_older_than):
+                return {}
         if self.conf.remove_from_date:
             timestamp = utils.date_to_timestamp(self.conf.remove_from_date)
         else:
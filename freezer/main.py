@@ -32,6 +32,7 @@ from freezer.common import client_manager
 from freezer.common import config as freezer_config
 from freezer.engine import manager as engine_manager
 from freezer import job
+from freezer.storage import catalog
 from freezer.storage import local
 from freezer.storage import multiple
 from freezer.storage import s3
@@ -89,10 +90,18 @@ def freezer_main(backup_args):
         # pylint: disable=abstract-class-instantiated
         storage = multiple.MultipleStorage(
             [storage_from_dict(x, max_segment_size)
-             for x in backup_args.storages])
+             for x in backup_args.storages],
+            replication_mode=backup_args.storages_replication,
+            journal_path=(backup_args.replication_journal or
+                          os.path.join(backup_args.work_dir,
+                                       'replication.json')))
     else:
         storage = storage_from_dict(backup_args.__dict__, max_segment_size)
 
+    if backup_args.backup_catalog:
+        storage.use_catalog(catalog.Catalog(
+            backup_args.backup_catalog, ttl=backup_args.backup_catalog_ttl))
+
     engine_loader = engine_manager.EngineManager()
     backup_args.engine = engine_loader.load_engine(
         compression=backup_args.compression,
@@ -101,8 +110,13 @@ def freezer_main(backup_args):
         storage=storage,
         max_segment_size=backup_args.max_segment_size,
         rsync_block_size=backup_args.rsync_block_size,
+        rsync_workers=backup_args.rsync_workers,
+        rsync_workers_type=backup_args.rsync_workers_type,
+        scan_workers=backup_args.scan_workers,
+        dedup_chunk_size=backup_args.dedup_chunk_size,
         encrypt_key=backup_args.encrypt_pass_file,
-        dry_run=backup_args.dry_run
+        dry_run=backup_args.dry_run,
+        restore_path_filter=backup_args.restore_path_filter
     )
 
     if hasattr(backup_args, 'trickle_command'):
@@ -149,6 +163,7 @@ def run_job(conf, storage):
     start_time = utils.DateTime.now()
     LOG.info('Job execution Started at: {0}'.format(start_time))
     response = freezer_job.execute()
+    storage.wait_replication(block=conf.replication_wait)
     end_time = utils.DateTime.now()
     LOG.info('Job execution Finished, at: {0}'.format(end_time))
     LOG.info('Job time Elapsed: {0}'.format(end_time - start_time))
@@ -192,6 +207,16 @@ def fail(exit_code, e, quiet, do_log=True):
     return exit_code
 
 
+def storage_option(backup_args, name):
+    """Get an option of a storage, the storage sections of the multiple
+    storages only hold the options they set.
+    """
+    value = backup_args.get(name)
+    if value is None:
+        return freezer_config.DEFAULT_PARAMS[name]
+    return value
+
+
 def storage_from_dict(backup_args, max_segment_size):
     storage_name = backup_args['storage']
     container = backup_args['container']
@@ -200,19 +225,28 @@ def storage_from_dict(backup_args, max_segment_size):
         client_manager = backup_args['client_manager']
 
         storage = swift.SwiftStorage(
-            client_manager, container, max_segment_size)
+            client_manager, container, max_segment_size,
+            upload_workers=storage_option(backup_args, 'upload_workers'),
+            slo=storage_option(backup_args, 'swift_slo'),
+            download_workers=storage_option(backup_args, 'download_workers'),
+            delete_workers=storage_option(backup_args, 'delete_workers'))
     elif storage_name == "s3":
         storage = s3.S3Storage(
             backup_args['access_key'],
             backup_args['secret_key'],
             backup_args['endpoint'],
             container,
-            max_segment_size
+            max_segment_size,
+            upload_workers=storage_option(backup_args, 'upload_workers'),
+            download_workers=storage_option(backup_args, 'download_workers'),
+            delete_workers=storage_option(backup_args, 'delete_workers'),
+            listing_cache_ttl=storage_option(backup_args, 'listing_cache_ttl')
         )
     elif storage_name == "local":
         storage = local.LocalStorage(
             storage_path=container,
-            max_segment_size=max_segment_size)
+            max_segment_size=max_segment_size,
+            sync_interval=storage_option(backup_args, 'local_sync_interval'))
     elif storage_name == "ssh":
         if backup_args['ssh_password']:
             storage = ssh.SshStorage(
@@ -221,7 +255,8 @@ def storage_from_dict(backup_args, max_segment_size):
                 backup_args['ssh_host'],
                 int(backup_args['ssh_port']),
                 max_segment_size=max_segment_size,
-                remote_pwd=backup_args['ssh_password'])
+                remote_pwd=backup_args['ssh_password'],
+                channels=storage_option(backup_args, 'ssh_channels'))
         else:
             storage = ssh.SshStorage(
                 container,
@@ -229,7 +264,8 @@ def storage_from_dict(backup_args, max_segment_size):
                 backup_args['ssh_host'],
                 int(backup_args['ssh_port']),
                 max_segment_size=max_segment_size,
-                ssh_key_path=backup_args['ssh_key'])
+                ssh_key_path=backup_args['ssh_key'],
+                channels=storage_option(backup_args, 'ssh_channels'))
     elif storage_name in ["ftp", "ftps"]:
         args = [container, backup_args['ftp_password'],
                 backup_args['ftp_username'],
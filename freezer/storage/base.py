@@ -16,6 +16,7 @@
 
 import abc
 import tempfile
+import time
 
 from oslo_log import log
 from oslo_serialization import jsonutils as json
@@ -33,11 +34,37 @@ class Storage(object):
     class.
     """
     _type = None
+    # freezer.storage.catalog.Catalog of the backups, None if disabled
+    catalog = None
 
     def __init__(self, skip_prepare=False):
         if not skip_prepare:
             self.prepare()
 
+    def use_catalog(self, catalog):
+        """Look the backups up in a local catalog before the storage.
+
+        :type catalog: freezer.storage.catalog.Catalog
+        """
+        self.catalog = catalog
+
+    def record_backup(self, backup, size=None, metadata=None):
+        """Record a backup written to the storage in the catalog.
+
+        :type backup: freezer.storage.base.Backup
+        :param size: size in bytes of the data of the backup
+        :param metadata: freezer metadata of the backup
+        """
+        if self.catalog:
+            self.catalog.add(backup.copy(self), size, metadata)
+
+    def wait_replication(self, block=True):
+        """Wait for the copies of the backups made in the background
+
+        :param block: if False, only report the copies not finished
+        """
+        pass
+
     @abc.abstractmethod
     def get_file(self, from_path, to_path):
         pass
@@ -105,7 +132,7 @@ class Storage(object):
 
         increments = backup.get_increments()
 
-        return {level: backup for level, backup in increments.iteritems()
+        return {level: backup for level, backup in six.iteritems(increments)
                 if not recent_to_date or backup.timestamp <= recent_to_date}
 
     def remove_older_than(self, engine, remove_older_timestamp,
@@ -119,8 +146,15 @@ class Storage(object):
         """
         backups = self.get_level_zero(engine, hostname_backup_name,
                                       remove_older_timestamp)
+        started = time.time()
         for backup in backups:
             backup.remove()
+        LOG.info('Removed {0} level zero backups of {1} with their '
+                 'increments in {2:.1f} seconds'.format(
+                     len(backups), hostname_backup_name,
+                     time.time() - started))
+        if backups:
+            engine.remove_unreferenced_data(self)
 
     @abc.abstractmethod
     def info(self):
@@ -239,6 +273,8 @@ class Backup(object):
                 self.increments_metadata_path,
                 "{0}_{1}".format(self.level, self.timestamp), "metadata")
             self.data_path = utils.path_join(self.data_prefix_path, "data")
+            self.data_index_path = utils.path_join(self.data_prefix_path,
+                                                   "data_index")
             self.segments_path = utils.path_join(self.data_prefix_path,
                                                  "segments")
 
@@ -258,26 +294,41 @@ class Backup(object):
     def remove(self):
         self.storage.rmtree(self.increments_metadata_path)
         self.storage.rmtree(self.increments_data_path)
+        if self.storage.catalog:
+            self.storage.catalog.remove_chain(self)
 
     def get_increments(self):
         """
         Gets all incremental backups based on a level-zero backup with
-        timestamp
+        timestamp, from the catalog of the storage if it is synced
         :rtype: dict[int, freezer.storage.base.Backup]
         :return: Dictionary[backup_level, backup]
         """
-        increments = self.storage.listdir(self.increments_metadata_path)
-        sorted(increments)
-        increments = [name.split('_') for name in increments]
-
-        return {int(increment[0]): Backup(
+        catalog = self.storage.catalog
+        increments = None
+        if catalog:
+            increments = catalog.increments(
+                self.storage, self.engine.name, self.hostname_backup_name,
+                self.level_zero_timestamp)
+        if increments is None:
+            increments = sorted(
+                tuple(int(part) for part in name.split('_'))
+                for name in self.storage.listdir(
+                    self.increments_metadata_path))
+            if catalog:
+                catalog.sync_increments(
+                    self.storage, self.engine.name,
+                    self.hostname_backup_name, self.level_zero_timestamp,
+                    increments)
+
+        return {level: Backup(
             storage=self.storage,
             engine=self.engine,
             hostname_backup_name=self.hostname_backup_name,
-            timestamp=int(increment[1]),
+            timestamp=timestamp,
             level_zero_timestamp=self.level_zero_timestamp,
-            level=int(increment[0])
-        ) for increment in increments}
+            level=level
+        ) for level, timestamp in increments}
 
     def _get_file(self, filename):
         file = tempfile.NamedTemporaryFile('wb', delete=True)
@@ -288,7 +339,25 @@ class Backup(object):
         return json.loads(content[0])
 
     def metadata(self):
-        return self._get_file(self.metadata_path)
+        """Get the freezer metadata, downloaded once when the storage has a
+        catalog
+
+        A backup of the catalog missing from the storage expires the
+        listings of its backup name.
+        """
+        catalog = self.storage.catalog
+        metadata = catalog.metadata(self) if catalog else None
+        if metadata is None:
+            try:
+                metadata = self._get_file(self.metadata_path)
+            except Exception:
+                if catalog:
+                    catalog.expire(self.storage, self.engine.name,
+                                   self.hostname_backup_name)
+                raise
+            if catalog:
+                catalog.set_metadata(self, metadata)
+        return metadata
 
     def engine_metadata(self):
         return self._get_file(self.engine_metadata_path)
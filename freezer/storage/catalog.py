@@ -0,0 +1,309 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local catalog of the backups of the storages.
+
+The catalog is a SQLite database recording every backup written by the
+agent, with its size and its freezer metadata. It is synced incrementally
+from the storages: the level zero backups of a backup name, and the
+increments of a level zero backup, are listed from the storage the first
+time they are looked up, then served by the catalog. The metadata of a
+backup is downloaded once. The backups removed by the agent are removed
+from the catalog as well.
+
+The catalog is shared by the agents of a node. To see the backups written
+or removed by other nodes, the listings expire after a time to live and are
+listed again from the storage. The listings of a backup name also expire as
+soon as one of its catalogued backups is found missing from the storage.
+"""
+
+import contextlib
+import os
+import sqlite3
+import time
+
+from oslo_log import log
+from oslo_serialization import jsonutils as json
+
+LOG = log.getLogger(__name__)
+
+CATALOG_VERSION = 2
+# Seconds to wait for the lock of the database held by another agent
+LOCK_TIMEOUT = 60
+# level_zero_timestamp of the listing of the level zero backups of a name
+NAME_LISTING = 0
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS backups ('
+    ' storage TEXT NOT NULL,'
+    ' engine TEXT NOT NULL,'
+    ' name TEXT NOT NULL,'
+    ' level_zero_timestamp INTEGER NOT NULL,'
+    ' level INTEGER NOT NULL,'
+    ' timestamp INTEGER NOT NULL,'
+    ' size INTEGER,'
+    ' data_path TEXT,'
+    ' metadata TEXT,'
+    ' PRIMARY KEY (storage, engine, name, level_zero_timestamp, level,'
+    ' timestamp))',
+    'CREATE TABLE IF NOT EXISTS synced ('
+    ' storage TEXT NOT NULL,'
+    ' engine TEXT NOT NULL,'
+    ' name TEXT NOT NULL,'
+    ' level_zero_timestamp INTEGER NOT NULL,'
+    ' synced_at REAL,'
+    ' PRIMARY KEY (storage, engine, name, level_zero_timestamp))',
+)
+
+
+class Catalog(object):
+    def __init__(self, path, ttl=0):
+        """
+        :param path: path of the SQLite database, created if needed
+        :param ttl: seconds after which the listings of the storages are
+                    listed again, 0 keeps them until a catalogued backup is
+                    found missing
+        """
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl or 0
+        dir_path = os.path.dirname(self.path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        with self._connect() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version not in (0, 1, CATALOG_VERSION):
+                raise Exception('Unsupported version {0} of the backup '
+                                'catalog {1}'.format(version, self.path))
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            if version == 1:
+                # The listings of the first version are expired
+                conn.execute('ALTER TABLE synced ADD COLUMN synced_at REAL')
+            conn.execute('PRAGMA user_version = {0}'.format(
+                CATALOG_VERSION))
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Open a connection for a transaction.
+
+        A connection is opened per operation, so that the catalog can be
+        used from any thread or process.
+        """
+        conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _key(storage, engine_name, name):
+        return storage.catalog_key(), engine_name, name
+
+    def _synced(self, conn, key, level_zero_timestamp):
+        row = conn.execute(
+            'SELECT synced_at FROM synced WHERE storage = ? AND engine = ? '
+            'AND name = ? AND level_zero_timestamp = ?',
+            key + (level_zero_timestamp,)).fetchone()
+        if row is None:
+            return False
+        if self.ttl and (row[0] is None or
+                         row[0] < time.time() - self.ttl):
+            return False
+        return True
+
+    @staticmethod
+    def _set_synced(conn, key, level_zero_timestamp):
+        conn.execute('INSERT OR REPLACE INTO synced VALUES (?, ?, ?, ?, ?)',
+                     key + (level_zero_timestamp, time.time()))
+
+    def level_zero_timestamps(self, storage, engine_name, name):
+        """Get the level zero backups of a backup name.
+
+        :type storage: freezer.storage.physical.PhysicalStorage
+        :return: list of the level zero timestamps, None if the backup name
+                 has not been synced
+        """
+        key = self._key(storage, engine_name, name)
+        with self._connect() as conn:
+            if not self._synced(conn, key, NAME_LISTING):
+                return None
+            return [row[0] for row in conn.execute(
+                'SELECT DISTINCT level_zero_timestamp FROM backups WHERE '
+                'storage = ? AND engine = ? AND name = ? ORDER BY '
+                'level_zero_timestamp', key)]
+
+    def sync_level_zero(self, storage, engine_name, name, timestamps):
+        """Record the level zero backups listed from the storage.
+
+        The backups of the chains missing from the listing are removed.
+
+        :param timestamps: level zero timestamps of the backup name
+        """
+        key = self._key(storage, engine_name, name)
+        timestamps = set(timestamps)
+        with self._connect() as conn:
+            known = set(row[0] for row in conn.execute(
+                'SELECT DISTINCT level_zero_timestamp FROM backups WHERE '
+                'storage = ? AND engine = ? AND name = ?', key))
+            for timestamp in known - timestamps:
+                self._remove_chain(conn, key, timestamp)
+            conn.executemany(
+                'INSERT OR IGNORE INTO backups (storage, engine, name, '
+                'level_zero_timestamp, level, timestamp) VALUES '
+                '(?, ?, ?, ?, 0, ?)',
+                [key + (timestamp, timestamp) for timestamp in timestamps])
+            self._set_synced(conn, key, NAME_LISTING)
+
+    def increments(self, storage, engine_name, name, level_zero_timestamp):
+        """Get the backups of a chain.
+
+        :return: list of (level, timestamp) sorted by level and timestamp,
+                 None if the chain has not been synced
+        """
+        key = self._key(storage, engine_name, name)
+        with self._connect() as conn:
+            if not self._synced(conn, key, level_zero_timestamp):
+                return None
+            return [tuple(row) for row in conn.execute(
+                'SELECT level, timestamp FROM backups WHERE storage = ? AND '
+                'engine = ? AND name = ? AND level_zero_timestamp = ? ORDER '
+                'BY level, timestamp', key + (level_zero_timestamp,))]
+
+    def sync_increments(self, storage, engine_name, name,
+                        level_zero_timestamp, increments):
+        """Record the backups of a chain listed from the storage.
+
+        :param increments: list of (level, timestamp) of the chain
+        """
+        key = self._key(storage, engine_name, name)
+        chain = key + (level_zero_timestamp,)
+        increments = set(increments)
+        with self._connect() as conn:
+            known = set(tuple(row) for row in conn.execute(
+                'SELECT level, timestamp FROM backups WHERE storage = ? AND '
+                'engine = ? AND name = ? AND level_zero_timestamp = ?',
+                chain))
+            conn.executemany(
+                'DELETE FROM backups WHERE storage = ? AND engine = ? AND '
+                'name = ? AND level_zero_timestamp = ? AND level = ? AND '
+                'timestamp = ?',
+                [chain + increment for increment in known - increments])
+            conn.executemany(
+                'INSERT OR IGNORE INTO backups (storage, engine, name, '
+                'level_zero_timestamp, level, timestamp) VALUES '
+                '(?, ?, ?, ?, ?, ?)',
+                [chain + increment for increment in increments])
+            self._set_synced(conn, key, level_zero_timestamp)
+
+    def add(self, backup, size=None, metadata=None):
+        """Record a backup written to its storage.
+
+        :type backup: freezer.storage.base.Backup
+        :param size: size in bytes of the data of the backup
+        :param metadata: freezer metadata of the backup
+        """
+        key = self._key(backup.storage, backup.engine.name,
+                        backup.hostname_backup_name)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO backups VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                key + (backup.level_zero_timestamp, backup.level,
+                       backup.timestamp, size, backup.data_path,
+                       None if metadata is None else json.dumps(metadata)))
+            if not backup.level:
+                # A new chain has no other backup to list
+                self._set_synced(conn, key, backup.level_zero_timestamp)
+
+    def _backup_key(self, backup):
+        return self._key(backup.storage, backup.engine.name,
+                         backup.hostname_backup_name) + (
+            backup.level_zero_timestamp, backup.level, backup.timestamp)
+
+    def metadata(self, backup):
+        """Get the freezer metadata of a backup.
+
+        :type backup: freezer.storage.base.Backup
+        :return: the metadata, None if it is not in the catalog
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT metadata FROM backups WHERE storage = ? AND '
+                'engine = ? AND name = ? AND level_zero_timestamp = ? AND '
+                'level = ? AND timestamp = ?',
+                self._backup_key(backup)).fetchone()
+        if not row or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def set_metadata(self, backup, metadata):
+        """Record the freezer metadata downloaded for a backup.
+
+        :type backup: freezer.storage.base.Backup
+        """
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO backups (storage, engine, name, '
+                'level_zero_timestamp, level, timestamp) VALUES '
+                '(?, ?, ?, ?, ?, ?)', self._backup_key(backup))
+            conn.execute(
+                'UPDATE backups SET metadata = ?, data_path = ? WHERE '
+                'storage = ? AND engine = ? AND name = ? AND '
+                'level_zero_timestamp = ? AND level = ? AND timestamp = ?',
+                (json.dumps(metadata), backup.data_path) +
+                self._backup_key(backup))
+
+    def remove_chain(self, backup):
+        """Remove a level zero backup and its increments.
+
+        :type backup: freezer.storage.base.Backup
+        """
+        key = self._key(backup.storage, backup.engine.name,
+                        backup.hostname_backup_name)
+        with self._connect() as conn:
+            self._remove_chain(conn, key, backup.level_zero_timestamp)
+
+    def expire(self, storage, engine_name, name):
+        """Expire the listings of a backup name, to list its backups
+        again from the storage on the next lookup.
+
+        :type storage: freezer.storage.physical.PhysicalStorage
+        """
+        with self._connect() as conn:
+            conn.execute(
+                'DELETE FROM synced WHERE storage = ? AND engine = ? AND '
+                'name = ?', self._key(storage, engine_name, name))
+
+    @staticmethod
+    def _remove_chain(conn, key, level_zero_timestamp):
+        chain = key + (level_zero_timestamp,)
+        conn.execute(
+            'DELETE FROM backups WHERE storage = ? AND engine = ? AND '
+            'name = ? AND level_zero_timestamp = ?', chain)
+        conn.execute(
+            'DELETE FROM synced WHERE storage = ? AND engine = ? AND '
+            'name = ? AND level_zero_timestamp = ?', chain)
+
+    def backups(self, storage, engine_name, name):
+        """List the backups of a backup name.
+
+        :return: list of (level_zero_timestamp, level, timestamp, size)
+                 sorted by timestamp
+        """
+        with self._connect() as conn:
+            return [tuple(row) for row in conn.execute(
+                'SELECT level_zero_timestamp, level, timestamp, size FROM '
+                'backups WHERE storage = ? AND engine = ? AND name = ? ORDER '
+                'BY timestamp, level',
+                self._key(storage, engine_name, name))]
@@ -62,10 +62,23 @@ class FsLikeStorage(physical.PhysicalStorage):
         with self.open(backup.data_path, 'rb') as backup_file:
             while True:
                 chunk = backup_file.read(self.max_segment_size)
-                if chunk == '':
+                if not chunk:
                     break
-                if len(chunk):
-                    yield chunk
+                yield chunk
+
+    def read_range(self, path, offset, length=None):
+        with self.open(path, 'rb') as backup_file:
+            backup_file.seek(offset)
+            while length is None or length > 0:
+                size = self.max_segment_size
+                if length is not None:
+                    size = min(size, length)
+                chunk = backup_file.read(size)
+                if not len(chunk):
+                    break
+                if length is not None:
+                    length -= len(chunk)
+                yield chunk
 
     @abc.abstractmethod
     def open(self, filename, mode):
@@ -15,9 +15,9 @@ limitations under the License.
 
 """
 
+import collections
 import ftplib
 import os
-import shutil
 import socket
 import tempfile
 
@@ -27,9 +27,74 @@ from oslo_log import log
 from oslo_serialization import jsonutils as json
 
 CHUNK_SIZE = 32768
+# Number of attempts to resume an interrupted transfer
+TRANSFER_RETRIES = 5
+# Number of bytes of an upload kept in memory after they are sent, an
+# interrupted upload can be resumed from the size of the remote file as
+# long as it is within this window
+RESUME_WINDOW = 8 * 1024 * 1024
+# Errors of the connections, an interrupted transfer is resumed on them
+TRANSFER_ERRORS = (ftplib.error_temp, socket.error, EOFError)
 LOG = log.getLogger(__name__)
 
 
+class StreamReader(object):
+    """File like object reading an iterable of chunks, to upload a stream
+    with storbinary.
+
+    The last RESUME_WINDOW bytes read are kept, so that the reader can be
+    moved back to the position an interrupted upload is resumed from.
+    """
+
+    def __init__(self, chunks, window=RESUME_WINDOW):
+        self.chunks = iter(chunks)
+        self.window = window
+        # Position of the next byte returned
+        self.position = 0
+        # True when reading the chunks raised an error
+        self.failed = False
+        # (offset, chunk) of the kept chunks
+        self._kept = collections.deque()
+        self._kept_size = 0
+        self._end = 0
+
+    def read(self, size=-1):
+        while self.position == self._end:
+            try:
+                chunk = next(self.chunks, None)
+            except Exception:
+                self.failed = True
+                raise
+            if chunk is None:
+                return b''
+            if not chunk:
+                continue
+            self._kept.append((self._end, chunk))
+            self._end += len(chunk)
+            self._kept_size += len(chunk)
+            while self._kept_size - len(self._kept[0][1]) >= self.window:
+                self._kept_size -= len(self._kept.popleft()[1])
+
+        for start, chunk in reversed(self._kept):
+            if start <= self.position:
+                break
+        offset = self.position - start
+        end = len(chunk) if size < 0 else min(len(chunk), offset + size)
+        self.position += end - offset
+        return chunk[offset:end]
+
+    def seek(self, position):
+        """Move back to a position still kept in memory"""
+        if (not self._kept or position < self._kept[0][0] or
+                position > self._end):
+            raise IOError('Unable to resume the upload at {0}, bytes from '
+                          '{1} to {2} kept'.format(
+                              position,
+                              self._kept[0][0] if self._kept else 0,
+                              self._end))
+        self.position = position
+
+
 class BaseFtpStorage(fslike.FsLikeStorage):
     """
     :type ftp: ftplib
@@ -71,6 +136,11 @@ class BaseFtpStorage(fslike.FsLikeStorage):
     def init(self):
         pass
 
+    def catalog_key(self):
+        return '{0}:{1}@{2}:{3}:{4}'.format(
+            self.type, self.remote_username, self.remote_ip, self.port,
+            self.storage_path)
+
     def _create_tempdir(self):
         try:
             tmpdir = tempfile.mkdtemp()
@@ -119,30 +189,94 @@ class BaseFtpStorage(fslike.FsLikeStorage):
 
     def write_backup(self, rich_queue, backup):
         """
-        Stores backup in storage
+        Stores backup in storage, streaming the data of the queue to the
+        remote file
         :type rich_queue: freezer.streaming.RichQueue
         :type backup: freezer.storage.base.Backup
         """
+        backup = backup.copy(storage=self)
+        path = backup.data_path
+        LOG.info("ftp write_backup %s" % path)
+        self.create_dirs(path.rsplit('/', 1)[0])
+        self._store(path, rich_queue.get_messages())
+
+    def _reconnect(self):
         try:
-            tmpdir = tempfile.mkdtemp()
+            self.ftp.close()
         except Exception:
-            LOG.error("Unable to create a tmp directory")
-            raise
+            pass
+        self.init()
 
-        try:
-            data_meta = utils.path_join(tmpdir, "data_meta")
-            LOG.info("ftp write data_meta %s" % data_meta)
-            backup = backup.copy(storage=self)
-            path = backup.data_path
-            self.create_dirs(path.rsplit('/', 1)[0])
+    def _store(self, path, chunks):
+        """Upload an iterable of chunks to a remote file.
 
-            with open(data_meta, mode='wb') as b_file:
-                for message in rich_queue.get_messages():
-                    b_file.write(message)
+        An interrupted upload is resumed with REST from the size of the
+        remote file, on a new connection.
 
-            self.put_file(data_meta, path)
-        finally:
-            shutil.rmtree(tmpdir)
+        :param path: path of the remote file
+        :param chunks: iterable of the data to upload
+        """
+        reader = StreamReader(chunks)
+        rest = None
+        for attempt in range(TRANSFER_RETRIES):
+            try:
+                msg = self.ftp.storbinary('STOR ' + path, reader,
+                                          self.max_segment_size, rest=rest)
+                # 226
+                LOG.info("FTP PUT %s, ret=%s" % (path, msg))
+                return
+            except TRANSFER_ERRORS as e:
+                if reader.failed or attempt == TRANSFER_RETRIES - 1:
+                    raise
+                LOG.warning("ftp upload of %s interrupted at %s: %s, "
+                            "resuming" % (path, reader.position, e))
+                self._reconnect()
+                self.ftp.voidcmd('TYPE I')
+                rest = self.ftp.size(path)
+                reader.seek(rest)
+
+    def _retrieve(self, path):
+        """Download a remote file in chunks of max_segment_size bytes.
+
+        An interrupted download is resumed with REST from the last byte
+        received, on a new connection.
+
+        :param path: path of the remote file
+        :return: generator of chunks of data
+        """
+        offset = 0
+        attempt = 0
+        while True:
+            try:
+                self.ftp.voidcmd('TYPE I')
+                conn = self.ftp.transfercmd('RETR ' + path,
+                                            rest=offset or None)
+                data_file = conn.makefile('rb')
+                try:
+                    while True:
+                        chunk = data_file.read(self.max_segment_size)
+                        if not chunk:
+                            break
+                        offset += len(chunk)
+                        attempt = 0
+                        yield chunk
+                    if hasattr(conn, 'unwrap'):
+                        # shutdown the ssl layer of ftps
+                        conn.unwrap()
+                finally:
+                    data_file.close()
+                    conn.close()
+                # 226
+                msg = self.ftp.voidresp()
+                LOG.info("FTP GET %s, ret=%s" % (path, msg))
+                return
+            except TRANSFER_ERRORS as e:
+                attempt += 1
+                if attempt == TRANSFER_RETRIES:
+                    raise
+                LOG.warning("ftp download of %s interrupted at %s: %s, "
+                            "resuming" % (path, offset, e))
+                self._reconnect()
 
     def get_file(self, from_path, to_path):
         LOG.info("ftp get_file from_path=%s to_path=%s" % (from_path, to_path))
@@ -206,24 +340,16 @@ class BaseFtpStorage(fslike.FsLikeStorage):
     def open(self, path, mode):
         pass
 
+    def read_range(self, path, offset, length=None):
+        raise NotImplementedError(
+            'Ranged reads not supported by the {0} storage'.format(
+                self.type))
+
     def backup_blocks(self, backup):
         LOG.info("ftp backup_blocks ")
+        # should recreate ftp for new process
         self.init()
-        # should recreate ssh for new process
-        tmpdir = self._create_tempdir()
-        try:
-            data = utils.path_join(tmpdir, "data")
-            LOG.info("backup_blocksa datadown=%s" % data)
-            self.get_file(backup.data_path, data)
-            with open(data, 'rb') as backup_file:
-                while True:
-                    chunk = backup_file.read(self.max_segment_size)
-                    if chunk == '':
-                        break
-                    if len(chunk):
-                        yield chunk
-        finally:
-            shutil.rmtree(tmpdir)
+        return self._retrieve(backup.data_path)
 
     def add_stream(self, stream, package_name, headers=None):
         """
@@ -232,31 +358,21 @@ class BaseFtpStorage(fslike.FsLikeStorage):
         :param headers: backup metadata information
         :return:
         """
-        tmpdir = self._create_tempdir()
         LOG.info('add stream')
-        try:
-            split = package_name.rsplit('/', 1)
-            # create backup_basedir
-            backup_basedir = "{0}/{1}".format(self.storage_path,
-                                              package_name)
-            self.create_dirs(backup_basedir)
-            # define backup_data_name
-            backup_basepath = "{0}/{1}".format(backup_basedir,
-                                               split[0])
-            backup_metadata = "%s/metadata" % backup_basedir
-            # write backup to backup_basepath
-            data_backup = utils.path_join(tmpdir, "data_backup")
-            with open(data_backup, 'wb') as backup_file:
-                for el in stream:
-                    backup_file.write(el)
-            self.put_file(data_backup, backup_basepath)
-            # write data matadata to backup_metadata
-            metadata = utils.path_join(tmpdir, "metadata")
-            with open(metadata, 'wb') as backup_meta:
-                backup_meta.write(json.dumps(headers))
-            self.put_file(metadata, backup_metadata)
-        finally:
-            shutil.rmtree(tmpdir)
+        split = package_name.rsplit('/', 1)
+        # create backup_basedir
+        backup_basedir = "{0}/{1}".format(self.storage_path,
+                                          package_name)
+        self.create_dirs(backup_basedir)
+        # define backup_data_name
+        backup_basepath = "{0}/{1}".format(backup_basedir,
+                                           split[0])
+        backup_metadata = "%s/metadata" % backup_basedir
+        # write backup to backup_basepath
+        self._store(backup_basepath, stream)
+        # write data matadata to backup_metadata
+        self._store(backup_metadata,
+                    [json.dumps(headers).encode('utf-8')])
 
 
 class FtpStorage(BaseFtpStorage):
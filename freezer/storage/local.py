@@ -12,23 +12,119 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-
+import errno
 import io
+import mmap
 import os
 import shutil
 
+import six
+
 from freezer.storage import fslike
 from freezer.utils import utils
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+# Space allocated ahead of the writes of a backup
+PREALLOCATE_SIZE = 64 * 1024 * 1024
+# ioctl cloning a file on the filesystems supporting reflinks, Linux only
+FICLONE = 0x40049409
+# Errors of a kernel copy not supported for a pair of files
+_COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+                     errno.EINVAL, errno.ENOTTY)
+
+
+def _clone(src_fd, dst_fd):
+    """Share the blocks of a file with a copy, on the filesystems
+    supporting reflinks.
+
+    :return: True if the file was cloned
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno not in _COPY_UNSUPPORTED + (errno.EBADF,):
+            raise
+        return False
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _kernel_copy(src_fd, dst_fd, size):
+    """Copy a file without moving its data through user space, with
+    copy_file_range or sendfile when available.
+
+    :return: number of bytes copied
+    """
+    offset = 0
+    for copy, name in ((_copy_file_range, 'copy_file_range'),
+                       (_sendfile, 'sendfile')):
+        if not hasattr(os, name):
+            continue
+        try:
+            while offset < size:
+                copied = copy(src_fd, dst_fd, offset, size - offset)
+                if not copied:
+                    break
+                offset += copied
+            return offset
+        except OSError as e:
+            if offset or e.errno not in _COPY_UNSUPPORTED:
+                raise
+    return offset
+
+
+def copy_file(from_path, to_path):
+    """Copy a file, cloning it or copying it in the kernel when the
+    platform and the filesystems allow it.
+    """
+    with io.open(from_path, 'rb') as src, io.open(to_path, 'wb') as dst:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        if _clone(src_fd, dst_fd):
+            return
+        size = os.fstat(src_fd).st_size
+        offset = _kernel_copy(src_fd, dst_fd, size)
+        src.seek(offset)
+        dst.seek(offset)
+        shutil.copyfileobj(src, dst)
+
 
 class LocalStorage(fslike.FsLikeStorage):
     _type = 'local'
 
+    def __init__(self, storage_path, max_segment_size, skip_prepare=False,
+                 sync_interval=0):
+        """
+        :param sync_interval: bytes of a backup written between two
+                              fdatasync, 0 leaves the writes to the page
+                              cache
+        """
+        self.sync_interval = int(sync_interval or 0)
+        super(LocalStorage, self).__init__(
+            storage_path=storage_path,
+            max_segment_size=max_segment_size,
+            skip_prepare=skip_prepare)
+
     def get_file(self, from_path, to_path):
-        shutil.copyfile(from_path, to_path)
+        copy_file(from_path, to_path)
 
     def put_file(self, from_path, to_path):
-        shutil.copyfile(from_path, to_path)
+        copy_file(from_path, to_path)
 
     def listdir(self, directory):
         try:
@@ -44,3 +140,77 @@ class LocalStorage(fslike.FsLikeStorage):
 
     def open(self, filename, mode):
         return io.open(filename, mode)
+
+    def write_backup(self, rich_queue, backup):
+        """Write the data of a backup without buffering it.
+
+        The space of the file is allocated PREALLOCATE_SIZE bytes ahead of
+        the writes, and the data is synced every sync_interval bytes.
+
+        :type rich_queue: freezer.utils.streaming.RichQueue
+        :type backup: freezer.storage.base.Backup
+        """
+        backup = backup.copy(storage=self)
+        path = backup.data_path
+        self.create_dirs(path.rsplit('/', 1)[0])
+        sync = getattr(os, 'fdatasync', os.fsync)
+
+        with io.open(path, 'wb', buffering=0) as b_file:
+            fd = b_file.fileno()
+            written = 0
+            allocated = 0
+            synced = 0
+            for message in rich_queue.get_messages():
+                if hasattr(os, 'posix_fallocate') and \
+                        written + len(message) > allocated:
+                    allocated = written + len(message) + PREALLOCATE_SIZE
+                    try:
+                        os.posix_fallocate(fd, written, allocated - written)
+                    except OSError as e:
+                        if e.errno not in _COPY_UNSUPPORTED:
+                            raise
+                view = memoryview(message)
+                while view:
+                    view = view[b_file.write(view):]
+                written += len(message)
+                if self.sync_interval and \
+                        written - synced >= self.sync_interval:
+                    sync(fd)
+                    synced = written
+            if allocated > written:
+                # Release the space allocated ahead
+                b_file.truncate(written)
+            if self.sync_interval:
+                sync(fd)
+
+    def backup_blocks(self, backup):
+        """Read the data of a backup from a memory map.
+
+        The blocks are read only views of the map, the data is never copied.
+
+        :type backup: freezer.storage.base.Backup
+        """
+        if six.PY2:
+            for block in super(LocalStorage, self).backup_blocks(backup):
+                yield block
+            return
+
+        with io.open(backup.data_path, 'rb') as backup_file:
+            size = os.fstat(backup_file.fileno()).st_size
+            if not size:
+                return
+            data_map = mmap.mmap(backup_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        if hasattr(data_map, 'madvise'):
+            data_map.madvise(mmap.MADV_SEQUENTIAL)
+        data = memoryview(data_map)
+        try:
+            for offset in range(0, size, self.max_segment_size):
+                yield data[offset:offset + self.max_segment_size]
+        finally:
+            data.release()
+            try:
+                data_map.close()
+            except BufferError:
+                # Blocks still referenced, unmapped once released
+                pass
@@ -12,34 +12,85 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+
+from concurrent import futures
 from oslo_log import log
 # PyCharm will not recognize queue. Puts red squiggle line under it. That's OK.
 from six.moves import queue
 
 from freezer.storage import base
 from freezer.storage import exceptions
+from freezer.storage import replication
 from freezer.utils import streaming
 
 LOG = log.getLogger(__name__)
 
+# Write the backups to all the storages at once
+SYNC_REPLICATION = 'sync'
+# Write the backups to the first storage, then copy them to the others in
+# the background
+ASYNC_REPLICATION = 'async'
+
 
 class MultipleStorage(base.Storage):
     _type = 'multiple'
 
-    def __init__(self, storages):
+    def __init__(self, storages, replication_mode=SYNC_REPLICATION,
+                 journal_path=None):
         """
         :param storages:
         :type storages: list[freezer.storage.base.Storage]
+        :param replication_mode: SYNC_REPLICATION or ASYNC_REPLICATION, the
+                                 first storage is the primary storage of the
+                                 asynchronous replication
+        :param journal_path: path of the journal of the pending copies of
+                             the asynchronous replication
         :return:
         """
         super(MultipleStorage, self).__init__()
         self.storages = storages
+        self.replicator = None
+        if replication_mode == ASYNC_REPLICATION:
+            self.replicator = replication.Replicator(
+                storages[0], storages[1:],
+                replication.ReplicationJournal(journal_path))
+        # Seconds taken by the last lookup on every storage, by storage
+        self._latencies = {}
+
+    @property
+    def primary(self):
+        return self.storages[0]
+
+    def _written_storages(self):
+        """Get the storages written synchronously"""
+        if self.replicator:
+            return [self.primary]
+        return self.storages
 
     def info(self):
         for s in self.storages:
             s.info()
 
+    def use_catalog(self, catalog):
+        super(MultipleStorage, self).use_catalog(catalog)
+        for storage in self.storages:
+            storage.use_catalog(catalog)
+
+    def record_backup(self, backup, size=None, metadata=None):
+        for storage in self._written_storages():
+            storage.record_backup(backup, size, metadata)
+        if self.replicator:
+            self.replicator.replicate(backup.copy(self.primary), size,
+                                      metadata)
+
+    def wait_replication(self, block=True):
+        if self.replicator:
+            self.replicator.wait(block)
+
     def write_backup(self, rich_queue, backup):
+        if self.replicator:
+            return self.primary.write_backup(rich_queue, backup)
         output_queues = [streaming.RichQueue() for x in self.storages]
         except_queues = [queue.Queue() for x in self.storages]
         threads = ([streaming.QueuedThread(storage.write_backup, output_queue,
@@ -85,6 +136,68 @@ class MultipleStorage(base.Storage):
         # flat the list
         return [item for sublist in backups for item in sublist]
 
+    def get_latest_level_zero_increments(self, engine, hostname_backup_name,
+                                         recent_to_date=None):
+        """Get the latest backup chain from the fastest storage holding it.
+
+        The chain is looked up on all the storages concurrently, the
+        storages failing and the incomplete chains are skipped. Among the
+        storages holding the most recent backup, the one answering first is
+        used.
+
+        :rtype: dict[int, freezer.storage.base.Backup]
+        :return: Dictionary[backup_level, backup]
+        """
+        def lookup(storage):
+            started = time.time()
+            increments = storage.get_latest_level_zero_increments(
+                engine=engine, hostname_backup_name=hostname_backup_name,
+                recent_to_date=recent_to_date)
+            return time.time() - started, increments
+
+        executor = futures.ThreadPoolExecutor(max_workers=len(self.storages))
+        try:
+            lookups = [executor.submit(lookup, storage)
+                       for storage in self.storages]
+        finally:
+            executor.shutdown(wait=True)
+
+        candidates = []
+        for index, (storage, future) in enumerate(zip(self.storages,
+                                                      lookups)):
+            try:
+                latency, increments = future.result()
+            except IndexError:
+                continue
+            except Exception as e:
+                LOG.warning('Skipping the {0} storage: {1}'.format(
+                    storage.type, e))
+                continue
+            self._latencies[storage] = latency
+            if sorted(increments) != list(range(len(increments))):
+                LOG.warning('Skipping the incomplete backup chain of the '
+                            '{0} storage'.format(storage.type))
+                continue
+            latest = max(backup.timestamp for backup in increments.values())
+            candidates.append(((-increments[0].timestamp, -latest, latency,
+                                index), increments))
+
+        if not candidates:
+            raise IndexError('No matching backup name "{0}" found'.format(
+                hostname_backup_name))
+        _, increments = min(candidates, key=lambda candidate: candidate[0])
+        LOG.info('Using the backups of the {0} storage'.format(
+            increments[0].storage.type))
+        return increments
+
+    def _by_latency(self):
+        """Get the storages sorted by their last measured latency, the
+        storages not measured yet last
+        """
+        return sorted(self.storages, key=lambda storage: (
+            storage not in self._latencies,
+            self._latencies.get(storage, 0)))
+
     def prepare(self):
         pass
 
@@ -100,7 +213,7 @@ class MultipleStorage(base.Storage):
         :param backup:
         :return:
         """
-        for storage in self.storages:
+        for storage in self._written_storages():
             storage.put_engine_metadata(from_path, backup)
 
     def download_freezer_meta_data(self, backup):
@@ -108,8 +221,20 @@ class MultipleStorage(base.Storage):
         pass
 
     def get_file(self, from_path, to_path):
-        # TODO(DEKLAN): Need to implement.
-        pass
+        """Download a file from the fastest storage holding it, falling
+        back on the other storages on failure.
+        """
+        error = None
+        for storage in self._by_latency():
+            try:
+                return storage.get_file(from_path, to_path)
+            except Exception as e:
+                LOG.warning('Unable to get {0} from the {1} storage: '
+                            '{2}'.format(from_path, storage.type, e))
+                error = e
+        raise exceptions.StorageException(
+            'Unable to get {0} from any storage: {1}'.format(
+                from_path, error))
 
     def meta_file_abs_path(self, backup):
         # TODO(DEKLAN): Need to implement.
@@ -127,11 +252,15 @@ class MultipleStorage(base.Storage):
                      engine_metadata_path,
                      freezer_metadata_path,
                      backup):
-        for storage in self.storages:
+        for storage in self._written_storages():
             storage.put_metadata(engine_metadata_path,
                                  freezer_metadata_path,
                                  backup)
 
+    def put_data_index(self, data_index_path, backup):
+        for storage in self._written_storages():
+            storage.put_data_index(data_index_path, backup)
+
 
 class StorageManager(object):
 
@@ -14,13 +14,60 @@
 
 
 import abc
+import collections
 import os
+import threading
+import time
 
+from concurrent import futures
+from oslo_log import log
 import six
 
 from freezer.storage import base
 from freezer.utils import utils
 
+LOG = log.getLogger(__name__)
+
+# Seconds between two reports of the progress of a deletion
+DELETE_REPORT_INTERVAL = 10
+
+
+class DeletionProgress(object):
+    """Count the objects deleted from a storage, logging the progress and
+    the throughput every DELETE_REPORT_INTERVAL seconds.
+    """
+
+    def __init__(self, path, interval=DELETE_REPORT_INTERVAL):
+        """
+        :param path: path of the deleted tree
+        :param interval: seconds between two reports
+        """
+        self.path = path
+        self.interval = interval
+        self.deleted = 0
+        self.failed = 0
+        self.started = time.time()
+        self._reported = self.started
+        self._lock = threading.Lock()
+
+    def add(self, deleted, failed=0):
+        with self._lock:
+            self.deleted += deleted
+            self.failed += failed
+            now = time.time()
+            if now - self._reported < self.interval:
+                return
+            self._reported = now
+        self.report()
+
+    def report(self, done=False):
+        elapsed = max(time.time() - self.started, 0.001)
+        LOG.info('{0} {1}: {2} objects deleted, {3} failed in {4:.1f} '
+                 'seconds, {5:.1f} objects/s'.format(
+                     'Deleted' if done else 'Deleting', self.path,
+                     self.deleted, self.failed, elapsed,
+                     self.deleted / elapsed))
+
 
 @six.add_metaclass(abc.ABCMeta)
 class PhysicalStorage(base.Storage):
@@ -29,12 +76,21 @@ class PhysicalStorage(base.Storage):
     For example MultipleStorage is not physical.
     """
 
+    # Number of blocks read concurrently by read_ahead
+    download_workers = 1
+    # Number of deletion requests sent concurrently by delete_batches
+    delete_workers = 1
+
     def __init__(self, storage_path, max_segment_size,
                  skip_prepare=False):
         self.storage_path = storage_path
         self.max_segment_size = max_segment_size
         super(PhysicalStorage, self).__init__(skip_prepare=skip_prepare)
 
+    def catalog_key(self):
+        """Identify the storage in the catalog of the backups"""
+        return '{0}:{1}'.format(self.type, self.storage_path)
+
     def metadata_path(self, engine, hostname_backup_name):
         return utils.path_join(self.storage_path, "metadata", engine.name,
                                hostname_backup_name)
@@ -56,17 +112,27 @@ class PhysicalStorage(base.Storage):
         :return: dictionary of level zero timestamps with attached storage
         """
 
-        path = self.metadata_path(
-            engine=engine,
-            hostname_backup_name=hostname_backup_name)
+        timestamps = None
+        if self.catalog:
+            timestamps = self.catalog.level_zero_timestamps(
+                self, engine.name, hostname_backup_name)
+        if timestamps is None:
+            path = self.metadata_path(
+                engine=engine,
+                hostname_backup_name=hostname_backup_name)
+            timestamps = [int(t) for t in self.listdir(path)]
+            if self.catalog:
+                self.catalog.sync_level_zero(self, engine.name,
+                                             hostname_backup_name,
+                                             timestamps)
 
         zeros = [base.Backup(
             storage=self,
             engine=engine,
             hostname_backup_name=hostname_backup_name,
-            level_zero_timestamp=int(t),
-            timestamp=int(t),
-            level=0) for t in self.listdir(path)]
+            level_zero_timestamp=t,
+            timestamp=t,
+            level=0) for t in timestamps]
         if recent_to_date:
             zeros = [zero for zero in zeros
                      if zero.timestamp <= recent_to_date]
@@ -81,6 +147,76 @@ class PhysicalStorage(base.Storage):
         """
         pass
 
+    def read_ahead(self, read, blocks):
+        """Read blocks concurrently, yielding their data in order.
+
+        Up to download_workers blocks are read ahead of the consumer, so at
+        most as many blocks are held in memory.
+
+        :param read: function reading a block, returning its data
+        :param blocks: iterable of the blocks to read
+        :return: generator of the data of the blocks
+        """
+        pending = collections.deque()
+        executor = futures.ThreadPoolExecutor(
+            max_workers=self.download_workers)
+        try:
+            for block in blocks:
+                pending.append(executor.submit(read, block))
+                if len(pending) >= self.download_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def delete_batches(self, path, delete, names, batch_size):
+        """Delete objects by batches, sending up to delete_workers requests
+        concurrently.
+
+        :param path: path of the deleted tree, for the progress report
+        :param delete: function deleting a list of names, returning the
+                       number of objects that could not be deleted
+        :param names: names of the objects to delete
+        :param batch_size: maximum number of names per request
+        :raises Exception: if some objects could not be deleted
+        """
+        progress = DeletionProgress(path)
+
+        def delete_batch(batch):
+            failed = delete(batch)
+            progress.add(len(batch) - failed, failed)
+
+        batches = [names[start:start + batch_size]
+                   for start in range(0, len(names), batch_size)]
+        executor = futures.ThreadPoolExecutor(
+            max_workers=self.delete_workers)
+        try:
+            list(executor.map(delete_batch, batches))
+        finally:
+            executor.shutdown(wait=True)
+        progress.report(done=True)
+        if progress.failed:
+            raise Exception('Unable to delete {0} objects of {1}'.format(
+                progress.failed, path))
+
+    def read_range(self, path, offset, length=None):
+        """Read a range of bytes of a stored object.
+
+        :param path: path of the object, as backup.data_path
+        :param offset: offset of the first byte to read
+        :param length: number of bytes to read, None to read up to the end
+                       of the object
+        :return: iterable of chunks of data
+        :raises NotImplementedError: if the storage does not support ranged
+                                     reads
+        """
+        raise NotImplementedError(
+            'Ranged reads not supported by the {0} storage'.format(
+                self.type))
+
     @abc.abstractmethod
     def listdir(self, path):
         """
@@ -106,6 +242,15 @@ class PhysicalStorage(base.Storage):
         self.create_dirs(os.path.dirname(backup.metadata_path))
         self.put_file(freezer_metadata_path, backup.metadata_path)
 
+    def put_data_index(self, data_index_path, backup):
+        """
+        :param data_index_path: local path of the data offset index
+        :type backup: freezer.storage.base.Backup
+        :param backup:
+        """
+        backup = backup.copy(self)
+        self.put_file(data_index_path, backup.data_index_path)
+
     @abc.abstractmethod
     def rmtree(self, path):
         pass
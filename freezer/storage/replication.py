@@ -0,0 +1,333 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asynchronous replication of the backups between storages.
+
+The backups written to the primary storage are copied to the secondary
+storages in the background. Every copy is a job recorded in a journal before
+it starts and removed once the backup is complete on its target, so the
+copies interrupted by a failure or by the end of the agent are resumed by
+the next backup. A job records the steps of the copy already done and
+resumes from the first missing one. The freezer metadata is copied last, a
+backup only becomes visible on a secondary storage once it is complete.
+
+The copies to a storage are made in order, one at a time, so that the
+increments of a chain never reach a storage before their parent. After a
+failure, the remaining copies to that storage are left to the next run.
+
+The copies run in daemon threads: unless the agent waits for them, the
+copies not finished when it exits are left to the next run.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+from oslo_log import log
+from oslo_serialization import jsonutils as json
+from six.moves import queue
+
+from freezer.storage import base
+from freezer.utils import streaming
+
+LOG = log.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+# Steps of a copy, in order
+COPY_STEPS = ('data', 'data_index', 'metadata')
+
+
+class ReplicationJournal(object):
+    """Pending copy jobs, kept in a json file.
+
+    The journal is shared by the threads of an agent. The agents running
+    concurrently must use distinct journals.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the journal, created if needed
+        """
+        self.path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        dir_path = os.path.dirname(self.path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path) as journal_file:
+                data = json.loads(journal_file.read())
+        except ValueError as e:
+            LOG.warning('Ignoring the corrupted replication journal {0}: '
+                        '{1}'.format(self.path, e))
+            return []
+        if data.get('version') != JOURNAL_VERSION:
+            raise Exception('Unsupported version {0} of the replication '
+                            'journal {1}'.format(data.get('version'),
+                                                 self.path))
+        return data['jobs']
+
+    def _write(self, jobs):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as journal_file:
+            journal_file.write(json.dumps({'version': JOURNAL_VERSION,
+                                           'jobs': jobs}))
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+    def jobs(self):
+        """:return: list of the pending jobs, in order"""
+        with self._lock:
+            return self._read()
+
+    def add(self, job):
+        with self._lock:
+            jobs = [pending for pending in self._read()
+                    if pending['id'] != job['id']]
+            jobs.append(job)
+            self._write(jobs)
+
+    def set_done(self, job_id, done):
+        """Record the steps of a copy already done.
+
+        :param done: list of the steps done
+        """
+        with self._lock:
+            jobs = self._read()
+            for job in jobs:
+                if job['id'] == job_id:
+                    job['done'] = list(done)
+            self._write(jobs)
+
+    def remove(self, job_id):
+        with self._lock:
+            self._write([job for job in self._read()
+                         if job['id'] != job_id])
+
+
+class Replicator(object):
+    def __init__(self, source, targets, journal):
+        """
+        :type source: freezer.storage.physical.PhysicalStorage
+        :param source: primary storage
+        :type targets: list[freezer.storage.physical.PhysicalStorage]
+        :param targets: secondary storages
+        :type journal: ReplicationJournal
+        """
+        self.source = source
+        self.targets = targets
+        self.journal = journal
+        # One worker per target keeps the copies to a target in order
+        self._queues = {}
+        self._submitted = set()
+        # Keys of the targets that failed a copy during this run
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def _storages(self):
+        return dict((storage.catalog_key(), storage)
+                    for storage in [self.source] + list(self.targets))
+
+    def replicate(self, backup, size=None, metadata=None):
+        """Copy a backup of the source to all the targets in the
+        background, after the pending copies of the same engine.
+
+        :type backup: freezer.storage.base.Backup
+        :param size: size in bytes of the data of the backup
+        :param metadata: freezer metadata of the backup
+        """
+        self.resume(backup.engine)
+        for target in self.targets:
+            job = {
+                'id': '|'.join(str(part) for part in (
+                    target.catalog_key(), backup.engine.name,
+                    backup.hostname_backup_name,
+                    backup.level_zero_timestamp, backup.level,
+                    backup.timestamp)),
+                'source': self.source.catalog_key(),
+                'target': target.catalog_key(),
+                'engine': backup.engine.name,
+                'hostname_backup_name': backup.hostname_backup_name,
+                'level_zero_timestamp': backup.level_zero_timestamp,
+                'level': backup.level,
+                'timestamp': backup.timestamp,
+                'size': size,
+                'metadata': metadata,
+                'done': []}
+            self.journal.add(job)
+            self._submit(job, backup.engine)
+
+    def resume(self, engine):
+        """Resume the pending copies of the backups of an engine.
+
+        :type engine: freezer.engine.engine.BackupEngine
+        """
+        storages = self._storages()
+        for job in self.journal.jobs():
+            if job['engine'] != engine.name:
+                continue
+            if job['source'] not in storages or \
+                    job['target'] not in storages:
+                LOG.debug('Skipping the copy {0} of a storage no longer '
+                          'configured'.format(job['id']))
+                continue
+            self._submit(job, engine)
+
+    def _submit(self, job, engine):
+        with self._lock:
+            if job['id'] in self._submitted:
+                return
+            self._submitted.add(job['id'])
+            jobs = self._queues.get(job['target'])
+            if jobs is None:
+                jobs = queue.Queue()
+                self._queues[job['target']] = jobs
+                worker = threading.Thread(target=self._work, args=(jobs,))
+                worker.daemon = True
+                worker.start()
+            jobs.put((job, engine))
+
+    def _work(self, jobs):
+        while True:
+            job, engine = jobs.get()
+            try:
+                self._run(job, engine)
+            except Exception as e:
+                LOG.exception(e)
+            finally:
+                jobs.task_done()
+
+    def _run(self, job, engine):
+        if job['target'] in self._failed:
+            return
+        storages = self._storages()
+        backup = base.Backup(
+            engine=engine,
+            hostname_backup_name=job['hostname_backup_name'],
+            level_zero_timestamp=job['level_zero_timestamp'],
+            timestamp=job['timestamp'],
+            level=job['level'])
+        source = backup.copy(storages[job['source']])
+        target = backup.copy(storages[job['target']])
+        try:
+            self.copy(job, source, target)
+        except Exception as e:
+            self._failed.add(job['target'])
+            LOG.warning('Unable to copy the backup {0} to {1}, the copies '
+                        'to this storage are resumed by the next backup: '
+                        '{2}'.format(source.data_prefix_path,
+                                     job['target'], e))
+
+    def copy(self, job, source, target):
+        """Copy a backup, skipping the steps already done.
+
+        :type source: freezer.storage.base.Backup
+        :type target: freezer.storage.base.Backup
+        """
+        name = '{0}_{1}'.format(source.level, source.timestamp)
+        if name not in source.storage.listdir(
+                source.increments_metadata_path):
+            LOG.warning('The backup {0} no longer exists, dropping its '
+                        'copy to {1}'.format(source.data_prefix_path,
+                                             job['target']))
+            self.journal.remove(job['id'])
+            return
+
+        LOG.info('Copying the backup {0} to {1}'.format(
+            source.data_prefix_path, job['target']))
+        done = list(job['done'])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for step in COPY_STEPS:
+                if step in done:
+                    continue
+                getattr(self, '_copy_' + step)(source, target, tmpdir)
+                done.append(step)
+                self.journal.set_done(job['id'], done)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        target.storage.record_backup(target, job.get('size'),
+                                     job.get('metadata'))
+        self.journal.remove(job['id'])
+        LOG.info('Copied the backup {0} to {1}'.format(
+            source.data_prefix_path, job['target']))
+
+    @staticmethod
+    def _copy_data(source, target, tmpdir):
+        rich_queue = streaming.RichQueue()
+        except_queue = queue.Queue()
+        writer = streaming.QueuedThread(
+            target.storage.write_backup, rich_queue, except_queue,
+            kwargs={'backup': target})
+        writer.daemon = True
+        writer.start()
+        try:
+            for block in source.storage.backup_blocks(source):
+                # The local storage reads blocks as memoryviews
+                rich_queue.put(bytes(block))
+            rich_queue.finish()
+        except Exception:
+            rich_queue.force_stop()
+            writer.join()
+            if not except_queue.empty():
+                # The writer failed first, stopping the queue
+                raise except_queue.get_nowait()
+            raise
+        writer.join()
+        if not except_queue.empty():
+            raise except_queue.get_nowait()
+
+    @staticmethod
+    def _copy_data_index(source, target, tmpdir):
+        if 'data_index' not in source.storage.listdir(
+                source.data_prefix_path):
+            return
+        data_index = os.path.join(tmpdir, 'data_index')
+        source.storage.get_file(source.data_index_path, data_index)
+        target.storage.put_data_index(data_index, target)
+
+    @staticmethod
+    def _copy_metadata(source, target, tmpdir):
+        engine_metadata = os.path.join(tmpdir, 'engine_metadata')
+        freezer_metadata = os.path.join(tmpdir, 'metadata')
+        source.storage.get_file(source.engine_metadata_path,
+                                engine_metadata)
+        source.storage.get_file(source.metadata_path, freezer_metadata)
+        target.storage.put_metadata(engine_metadata, freezer_metadata,
+                                    target)
+
+    def wait(self, block=True):
+        """Wait for the copies submitted.
+
+        :param block: if False, do not wait, the copies not finished when
+                      the agent exits are left to the next run
+        :return: number of copies left to the next run
+        """
+        if block:
+            with self._lock:
+                queues = list(self._queues.values())
+            for jobs in queues:
+                jobs.join()
+        with self._lock:
+            submitted = set(self._submitted)
+        left = len([job for job in self.journal.jobs()
+                    if job['id'] in submitted])
+        if left:
+            LOG.warning('{0} copies of backups left to the next '
+                        'backup'.format(left))
+        return left
@@ -12,9 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
 import botocore
+import botocore.config
+import botocore.exceptions
 import botocore.session
-import logging
+from concurrent import futures
 import requests
 
 from oslo_log import log
@@ -28,19 +38,49 @@ LOG = log.getLogger(__name__)
 logging.getLogger('botocore').setLevel(logging.WARNING)
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# Number of attempts to upload a part
+UPLOAD_RETRIES = 10
+# Delay in seconds before retrying an upload, doubled after every failure
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+# Minimum size of the connection pool of the client, the botocore default
+MIN_POOL_CONNECTIONS = 10
+# Maximum number of keys of a DeleteObjects request
+DELETE_OBJECTS_MAX = 1000
+# Separator of the levels of the object keys
+DELIMITER = '/'
+
 
 class S3Storage(physical.PhysicalStorage):
 
     _type = 's3'
 
     def __init__(self, access_key, secret_key, endpoint, container,
-                 max_segment_size, skip_prepare=False):
+                 max_segment_size, skip_prepare=False, upload_workers=1,
+                 download_workers=1, delete_workers=1, listing_cache_ttl=0):
         """
         :type container: str
+        :param upload_workers: number of parts uploaded concurrently
+        :param download_workers: number of ranges downloaded concurrently on
+                                 restore
+        :param delete_workers: number of deletion requests sent
+                               concurrently
+        :param listing_cache_ttl: seconds during which the result of listdir
+                                  is reused, 0 disables the cache
         """
         self.access_key = access_key
         self.secret_key = secret_key
         self.endpoint = endpoint
+        self.upload_workers = int(upload_workers or 1)
+        self.download_workers = int(download_workers or 1)
+        self.delete_workers = int(delete_workers or 1)
+        self.listing_cache_ttl = float(listing_cache_ttl or 0)
+        # (expiry time, names) by listed path
+        self._listing_cache = {}
+        # Client of the process, shared by its threads
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
         super(S3Storage, self).__init__(
             storage_path=container,
             max_segment_size=max_segment_size,
@@ -50,6 +90,10 @@ class S3Storage(physical.PhysicalStorage):
         self._bucket_name = storage_info[0]
         self._object_prefix = storage_info[1]
 
+    def catalog_key(self):
+        return '{0}:{1}/{2}'.format(self.type, self.endpoint,
+                                    self.storage_path)
+
     def get_storage_info(self):
         storage_info = self.storage_path.split('/', 1)
         bucket_name = storage_info[0]
@@ -57,18 +101,67 @@ class S3Storage(physical.PhysicalStorage):
         return bucket_name, object_prefix
 
     def rmtree(self, path):
+        """Delete the objects under path with DeleteObjects requests of up
+        to DELETE_OBJECTS_MAX keys, or one by one if the storage does not
+        support them, up to delete_workers requests at a time.
+        """
+        self._listing_cache.clear()
         split = path.split('/', 1)
         all_s3_objects = self.list_all_objects(
             bucket_name=split[0],
             prefix=split[1]
         )
-        for s3_object in all_s3_objects:
-            self.get_s3_connection().delete_object(
-                Bucket=split[0],
-                Key=s3_object['Key']
-            )
+        keys = [s3_object['Key'] for s3_object in all_s3_objects]
+        if not keys:
+            return
+        try:
+            self.delete_batches(
+                path, functools.partial(self._delete_objects, split[0]),
+                keys, DELETE_OBJECTS_MAX)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NotImplemented':
+                raise
+            LOG.warning('DeleteObjects not supported, deleting the objects '
+                        'of {0} one by one'.format(path))
+            self.delete_batches(
+                path, functools.partial(self._delete_keys, split[0]),
+                keys, 1)
+
+    def _delete_objects(self, bucket_name, keys):
+        """Delete objects with a DeleteObjects request.
+
+        :return: number of objects not deleted
+        """
+        response = self.get_s3_connection().delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': key} for key in keys],
+                    'Quiet': True}
+        )
+        errors = response.get('Errors') or []
+        for error in errors:
+            LOG.warning('Unable to delete {0}: {1}'.format(
+                error.get('Key'), error.get('Message')))
+        return len(errors)
+
+    def _delete_keys(self, bucket_name, keys):
+        """Delete objects one by one.
+
+        :return: number of objects not deleted
+        """
+        failed = 0
+        for key in keys:
+            try:
+                self.get_s3_connection().delete_object(
+                    Bucket=bucket_name,
+                    Key=key
+                )
+            except Exception as e:
+                LOG.warning('Unable to delete {0}: {1}'.format(key, e))
+                failed += 1
+        return failed
 
     def put_file(self, from_path, to_path):
+        self._listing_cache.clear()
         split = to_path.split('/', 1)
         self.get_s3_connection().put_object(
             Bucket=split[0],
@@ -77,16 +170,31 @@ class S3Storage(physical.PhysicalStorage):
         )
 
     def get_s3_connection(self):
-        """
-        :rtype: s3client.Connection
+        """Get the client of the current process.
+
+        The client is created once per process and shared by its threads,
+        the botocore clients are thread safe. Its connection pool holds a
+        connection for every upload, download and delete worker.
+
+        :rtype: botocore.client.S3
         :return:
         """
-        return botocore.session.get_session().create_client(
-            's3',
-            aws_access_key_id=self.access_key,
-            aws_secret_access_key=self.secret_key,
-            endpoint_url=self.endpoint
-        )
+        with self._client_lock:
+            if self._client_pid != os.getpid():
+                self._client = botocore.session.get_session().create_client(
+                    's3',
+                    aws_access_key_id=self.access_key,
+                    aws_secret_access_key=self.secret_key,
+                    endpoint_url=self.endpoint,
+                    config=botocore.config.Config(
+                        max_pool_connections=max(
+                            MIN_POOL_CONNECTIONS,
+                            self.upload_workers + 1,
+                            self.download_workers + 1,
+                            self.delete_workers + 1))
+                )
+                self._client_pid = os.getpid()
+            return self._client
 
     def prepare(self):
         """
@@ -128,7 +236,7 @@ class S3Storage(physical.PhysicalStorage):
                 obj_fd.write(object_trunk)
 
     def add_stream(self, stream, package_name, headers=None):
-
+        self._listing_cache.clear()
         split = package_name.rsplit('/', 1)
         backup_basedir = package_name \
             if self.get_object_prefix() == '' \
@@ -145,31 +253,63 @@ class S3Storage(physical.PhysicalStorage):
             Key=backup_meta_data
         )
 
+    def upload_part(self, backup_basepath, upload_id, part_number, content):
+        """Upload a part, retrying with an exponential backoff.
+
+        If the upload fails for UPLOAD_RETRIES consecutive times, then the
+        program will exit with an Exception.
+
+        :return: part info {'PartNumber': ..., 'ETag': ...}
+        """
+        for attempt in range(UPLOAD_RETRIES):
+            try:
+                LOG.debug('Uploading part {0} of {1}'.format(
+                    part_number, backup_basepath))
+                response = self.get_s3_connection().upload_part(
+                    Body=content,
+                    Bucket=self.get_bucket_name(),
+                    Key=backup_basepath,
+                    PartNumber=part_number,
+                    UploadId=upload_id
+                )
+                return {'PartNumber': part_number, 'ETag': response['ETag']}
+            except Exception as error:
+                if attempt == UPLOAD_RETRIES - 1:
+                    LOG.critical('Error: upload_part: {0}'.format(error))
+                    raise Exception("cannot add object to storage")
+                delay = min(RETRY_DELAY * 2 ** attempt, MAX_RETRY_DELAY)
+                LOG.info(
+                    'Retrying to upload part {0} of {1} in {2} seconds: '
+                    '{3}'.format(part_number, backup_basepath, delay, error))
+                time.sleep(random.uniform(delay / 2.0, delay))
+
     def upload_stream(self, backup_basepath, stream):
+        """Upload a stream as a multipart upload.
+
+        Up to upload_workers parts are uploaded concurrently, so at most as
+        many parts are held in memory. A part failing is retried on its
+        own. If the upload cannot be completed, the multipart upload is
+        aborted so that its stored parts are deleted.
+
+        :param backup_basepath: key of the object
+        :param stream: iterable of the parts
+        """
         upload_id = self.get_s3_connection().create_multipart_upload(
             Bucket=self.get_bucket_name(),
             Key=backup_basepath
         )['UploadId']
-        upload_part_index = 1
         uploaded_parts = []
+        pending = collections.deque()
+        executor = futures.ThreadPoolExecutor(max_workers=self.upload_workers)
         try:
-            for el in stream:
-                response = self.get_s3_connection().upload_part(
-                    Body=el,
-                    Bucket=self.get_bucket_name(),
-                    Key=backup_basepath,
-                    PartNumber=upload_part_index,
-                    UploadId=upload_id
-                )
-                uploaded_parts.append({
-                    'PartNumber': upload_part_index,
-                    'ETag': response['ETag']
-                })
-                upload_part_index += 1
-            # Complete the upload, which requires info on all of the parts
-            part_info = {
-                'Parts': uploaded_parts
-            }
+            for part_number, el in enumerate(stream, 1):
+                pending.append(executor.submit(
+                    self.upload_part, backup_basepath, upload_id,
+                    part_number, el))
+                while len(pending) >= self.upload_workers:
+                    uploaded_parts.append(pending.popleft().result())
+            while pending:
+                uploaded_parts.append(pending.popleft().result())
 
             if not uploaded_parts:
                 # currently, not support volume boot instance
@@ -180,28 +320,56 @@ class S3Storage(physical.PhysicalStorage):
                     'No part uploaded(not support volume boot instance)'
                 )
 
+            # Complete the upload, which requires info on all of the parts
             self.get_s3_connection().complete_multipart_upload(
                 Bucket=self.get_bucket_name(),
                 Key=backup_basepath,
-                MultipartUpload=part_info,
+                MultipartUpload={'Parts': uploaded_parts},
                 UploadId=upload_id
             )
         except Exception as e:
-            LOG.error("Upload stream to S3 error, so abort it. "
-                      "Exception: {0}".format(e))
-            self.get_s3_connection().abort_multipart_upload(
-                Bucket=self.get_bucket_name(),
-                Key=backup_basepath,
-                UploadId=upload_id
-            )
+            # The parts being uploaded would be kept if stored after the
+            # abort
+            futures.wait(pending)
+            LOG.error("Upload stream to S3 error, aborting the multipart "
+                      "upload {0} of {1}. Exception: {2}"
+                      .format(upload_id, backup_basepath, e))
+            try:
+                self.get_s3_connection().abort_multipart_upload(
+                    Bucket=self.get_bucket_name(),
+                    Key=backup_basepath,
+                    UploadId=upload_id
+                )
+            except Exception as abort_error:
+                LOG.warning("Unable to abort the multipart upload {0} of "
+                            "{1}, its parts are left in the bucket: {2}"
+                            .format(upload_id, backup_basepath,
+                                    abort_error))
+            raise
+        finally:
+            executor.shutdown(wait=True)
 
     def backup_blocks(self, backup):
         """
+        The object is downloaded with concurrent ranged reads of
+        max_segment_size bytes when there are several download workers.
+
         :param backup:
         :type backup: freezer.storage.base.Backup
         :return:
         """
         split = backup.data_path.split('/', 1)
+        if self.download_workers > 1:
+            size = self.get_s3_connection().head_object(
+                Bucket=split[0],
+                Key=split[1]
+            )['ContentLength']
+            ranges = [(offset, min(self.max_segment_size, size - offset))
+                      for offset in range(0, size, self.max_segment_size)]
+            return self.read_ahead(
+                lambda block: self._get_range(split[0], split[1], *block),
+                ranges)
+
         s3_object = self.get_s3_connection().get_object(
             Bucket=split[0],
             Key=split[1]
@@ -212,6 +380,27 @@ class S3Storage(physical.PhysicalStorage):
             chunk_size=self.max_segment_size
         )
 
+    def _get_range(self, bucket_name, key, offset, length):
+        return self.get_s3_connection().get_object(
+            Bucket=bucket_name,
+            Key=key,
+            Range='bytes={0}-{1}'.format(offset, offset + length - 1)
+        )['Body'].read()
+
+    def read_range(self, path, offset, length=None):
+        split = path.split('/', 1)
+        end = '' if length is None else offset + length - 1
+        s3_object = self.get_s3_connection().get_object(
+            Bucket=split[0],
+            Key=split[1],
+            Range='bytes={0}-{1}'.format(offset, end)
+        )
+
+        return utils.S3ResponseStream(
+            data=s3_object['Body'],
+            chunk_size=self.max_segment_size
+        )
+
     def write_backup(self, rich_queue, backup):
         """
         Upload object to the remote S3 compatible storage server
@@ -219,28 +408,51 @@ class S3Storage(physical.PhysicalStorage):
         :type backup: freezer.storage.base.Backup
         """
         backup = backup.copy(storage=self)
+        self._listing_cache.clear()
         path = backup.data_path.split('/', 1)[1]
         self.upload_stream(path, rich_queue.get_messages())
 
     def listdir(self, path):
-        """
+        """List the names of the next level of the keys under path.
+
+        Only the objects and the common prefixes of that level are listed,
+        with ListObjectsV2 requests delimited by DELIMITER. The result is
+        reused for listing_cache_ttl seconds, until an object is written or
+        deleted by the storage.
+
         :type path: str
         :param path:
         :rtype: collections.Iterable[str]
         """
+        if self.listing_cache_ttl:
+            cached = self._listing_cache.get(path)
+            if cached and cached[0] > time.time():
+                return list(cached[1])
         try:
-            files = set()
             split = path.split('/', 1)
-            all_s3_objects = self.list_all_objects(
-                bucket_name=split[0],
-                prefix=split[1]
-            )
-            for s3_object in all_s3_objects:
-                files.add(s3_object['Key'][len(split[1]):].split('/', 2)[1])
-            return files
+            prefix = split[1].rstrip(DELIMITER) if len(split) > 1 else ''
+            if prefix:
+                prefix += DELIMITER
+            files = set()
+            paginator = self.get_s3_connection().get_paginator(
+                'list_objects_v2')
+            for page in paginator.paginate(Bucket=split[0],
+                                           Prefix=prefix,
+                                           Delimiter=DELIMITER):
+                for common_prefix in page.get('CommonPrefixes') or []:
+                    files.add(common_prefix['Prefix'][len(prefix):].rstrip(
+                        DELIMITER))
+                for s3_object in page.get('Contents') or []:
+                    files.add(s3_object['Key'][len(prefix):])
+            files.discard('')
+            files = sorted(files)
         except Exception as e:
             LOG.error(e)
             return []
+        if self.listing_cache_ttl:
+            self._listing_cache[path] = (
+                time.time() + self.listing_cache_ttl, files)
+        return list(files)
 
     def create_dirs(self, folder_list):
         pass
@@ -259,21 +471,9 @@ class S3Storage(physical.PhysicalStorage):
 
     def list_all_objects(self, bucket_name, prefix):
         all_objects = []
-        is_truncated = True
-        marker = ''
-        while is_truncated:
-            response = self.get_s3_connection().list_objects(
-                Bucket=bucket_name,
-                Marker=marker,
-                Prefix=prefix
-            )
-
-            if 'Contents' not in response:
-                break
-
-            all_objects.extend(response['Contents'])
-            is_truncated = response['IsTruncated']
-            marker = response['Contents'][-1]['Key']
+        paginator = self.get_s3_connection().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            all_objects.extend(page.get('Contents') or [])
         return all_objects
 
     def put_object(self, bucket_name, key, data):
@@ -13,16 +13,22 @@
 # limitations under the License.
 
 
+import collections
 import errno
 import os
 import stat
+import threading
 
+from concurrent import futures
 import paramiko
 
 from freezer.storage import fslike
 from freezer.utils import utils
 
 CHUNK_SIZE = 32768
+# Flow control window of the SFTP channels, the paramiko default of 2 MiB
+# limits a channel to 2 MiB per round trip on high latency links
+WINDOW_SIZE = 16 * 1024 * 1024
 
 
 class SshStorage(fslike.FsLikeStorage):
@@ -32,12 +38,22 @@ class SshStorage(fslike.FsLikeStorage):
     _type = 'ssh'
 
     def __init__(self, storage_path, remote_username, remote_ip, port,
-                 max_segment_size, ssh_key_path=None, remote_pwd=None):
+                 max_segment_size, ssh_key_path=None, remote_pwd=None,
+                 channels=1):
         """
             :param storage_path: directory of storage
             :type storage_path: str
+            :param channels: number of SFTP channels the segments of the
+                             backups are transferred on concurrently
             :return:
             """
+        self.channels = int(channels or 1)
+        self.download_workers = self.channels
+        # SFTP channels and open files of the transfer threads
+        self._local = threading.local()
+        self._open_files = []
+        self._open_clients = []
+        self._open_files_lock = threading.Lock()
         self.ssh_key_path = ssh_key_path
         self.remote_pwd = remote_pwd
         self.remote_username = remote_username
@@ -90,7 +106,67 @@ class SshStorage(fslike.FsLikeStorage):
 
         # we should keep link to ssh to prevent garbage collection
         self.ssh = ssh
-        self.ftp = self.ssh.open_sftp()
+        self.ftp = self._open_sftp()
+
+    def _open_sftp(self):
+        return paramiko.SFTPClient.from_transport(self.ssh.get_transport(),
+                                                  window_size=WINDOW_SIZE)
+
+    def _thread_file(self, path, mode):
+        """Get a file opened on the SFTP channel of the current thread.
+
+        Every thread opens its own channel on the SSH transport, unless a
+        single channel is used, and every file once. The files and the
+        channels are closed by _close_files.
+        """
+        local = self._local
+        transport = self.ssh.get_transport()
+        if getattr(local, 'transport', None) is not transport:
+            if self.channels == 1:
+                local.sftp = self.ftp
+            else:
+                local.sftp = self._open_sftp()
+                with self._open_files_lock:
+                    self._open_clients.append(local.sftp)
+            local.transport = transport
+            local.files = {}
+        sftp_file = local.files.get((path, mode))
+        if sftp_file is None:
+            sftp_file = local.sftp.open(path, mode=mode,
+                                        bufsize=self.max_segment_size)
+            sftp_file.set_pipelined(True)
+            local.files[(path, mode)] = sftp_file
+            with self._open_files_lock:
+                self._open_files.append(sftp_file)
+        return sftp_file
+
+    def _close_files(self):
+        """Close the files of the transfer threads, waiting for the
+        acknowledgement of the pipelined writes, then their SFTP channels.
+        """
+        with self._open_files_lock:
+            open_files, self._open_files = self._open_files, []
+            open_clients, self._open_clients = self._open_clients, []
+            # The threads open new channels on their next transfer
+            self._local = threading.local()
+        errors = []
+        for sftp_file in open_files:
+            try:
+                sftp_file.close()
+            except Exception as e:
+                errors.append(e)
+        for sftp in open_clients:
+            try:
+                sftp.close()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def catalog_key(self):
+        return '{0}:{1}@{2}:{3}:{4}'.format(
+            self.type, self.remote_username, self.remote_ip, self.port,
+            self.storage_path)
 
     def _is_dir(self, check_dir):
         return stat.S_IFMT(self.ftp.stat(check_dir).st_mode) == stat.S_IFDIR
@@ -146,8 +222,51 @@ class SshStorage(fslike.FsLikeStorage):
                 raise
 
     def open(self, filename, mode):
-        return self.ftp.open(filename, mode=mode,
-                             bufsize=self.max_segment_size)
+        """Open a remote file, its writes are pipelined: they do not wait
+        for the acknowledgement of the server, whose errors are raised by
+        the following operations on the file.
+        """
+        sftp_file = self.ftp.open(filename, mode=mode,
+                                  bufsize=self.max_segment_size)
+        sftp_file.set_pipelined(True)
+        return sftp_file
+
+    def write_backup(self, rich_queue, backup):
+        """
+        Stores backup in storage, the segments written concurrently at
+        their offset on the SFTP channels
+        :type rich_queue: freezer.utils.streaming.RichQueue
+        :type backup: freezer.storage.base.Backup
+        """
+        if self.channels == 1:
+            return super(SshStorage, self).write_backup(rich_queue, backup)
+
+        backup = backup.copy(storage=self)
+        path = backup.data_path
+        self.create_dirs(path.rsplit('/', 1)[0])
+        self.open(path, 'wb').close()
+
+        def write(offset, message):
+            sftp_file = self._thread_file(path, 'r+b')
+            sftp_file.seek(offset)
+            sftp_file.write(message)
+
+        offset = 0
+        pending = collections.deque()
+        executor = futures.ThreadPoolExecutor(max_workers=self.channels)
+        try:
+            for message in rich_queue.get_messages():
+                pending.append(executor.submit(write, offset, message))
+                offset += len(message)
+                while len(pending) >= self.channels:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self._close_files()
 
     def read_metadata_file(self, path):
         file_stats = self.ftp.stat(path)
@@ -167,5 +286,25 @@ class SshStorage(fslike.FsLikeStorage):
         return data
 
     def backup_blocks(self, backup):
+        """
+        Every segment is read with all its requests sent at once, up to a
+        segment per SFTP channel ahead of the restore.
+
+        :param backup:
+        :type backup: freezer.storage.base.Backup
+        :return:
+        """
         self.init()  # should recreate ssh for new process
-        return super(SshStorage, self).backup_blocks(backup)
+        path = backup.data_path
+        size = self.ftp.stat(path).st_size
+        ranges = [(offset, min(self.max_segment_size, size - offset))
+                  for offset in range(0, size, self.max_segment_size)]
+
+        def read(block):
+            return b''.join(self._thread_file(path, 'rb').readv([block]))
+
+        try:
+            for chunk in self.read_ahead(read, ranges):
+                yield chunk
+        finally:
+            self._close_files()
@@ -13,17 +13,36 @@
 # limitations under the License.
 
 
+import collections
+import functools
+import json
 import os
+import random
+import threading
 import time
 
+from concurrent import futures
 from oslo_log import log
 import requests
 from requests.packages import urllib3
+from six.moves.urllib import parse
 
 from freezer.storage import physical
 
 LOG = log.getLogger(__name__)
 
+# Number of attempts to upload a segment
+UPLOAD_RETRIES = 10
+# Delay in seconds before retrying an upload, doubled after every failure
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+# Maximum number of segments of a static large object, the default limit
+# of the Swift clusters
+SLO_MAX_SEGMENTS = 1000
+# Maximum number of objects deleted by a bulk delete request, the default
+# limit of the Swift clusters
+BULK_DELETE_MAX = 10000
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
@@ -35,13 +54,83 @@ class SwiftStorage(physical.PhysicalStorage):
     _type = 'swift'
 
     def rmtree(self, path):
+        """Delete the objects under path, with bulk delete requests if the
+        cluster supports them, one by one otherwise, up to delete_workers
+        requests at a time.
+        """
         split = path.split('/', 1)
-        for file in self.swift().get_container(split[0],
-                                               prefix=split[1])[1]:
+        names = [obj['name'] for obj in self.swift().get_container(
+            split[0], prefix=split[1], full_listing=True)[1]]
+        if not names:
+            return
+        bulk_delete_size = self._bulk_delete_size()
+        if bulk_delete_size:
+            self.delete_batches(path,
+                                functools.partial(self._bulk_delete, split[0]),
+                                names, bulk_delete_size)
+        else:
+            self.delete_batches(
+                path, functools.partial(self._delete_objects, split[0]),
+                names, 1)
+
+    def _bulk_delete_size(self):
+        """Get the maximum number of objects of a bulk delete request, 0 if
+        the bulk delete middleware is not available
+        """
+        if self._bulk_delete_max is None:
             try:
-                self.swift().delete_object(split[0], file['name'])
-            except Exception:
-                raise
+                capabilities = self.swift().get_capabilities()
+            except Exception as e:
+                LOG.warning('Unable to get the capabilities of the swift '
+                            'cluster: {0}'.format(e))
+                capabilities = {}
+            bulk_delete = capabilities.get('bulk_delete')
+            self._bulk_delete_max = 0
+            if bulk_delete:
+                self._bulk_delete_max = min(
+                    bulk_delete.get('max_deletes_per_request',
+                                    BULK_DELETE_MAX),
+                    BULK_DELETE_MAX)
+        return self._bulk_delete_max
+
+    def _bulk_delete(self, container, names):
+        """Delete objects with a bulk delete request.
+
+        :return: number of objects not deleted
+        """
+        data = '\n'.join(
+            parse.quote(u'/{0}/{1}'.format(container, name).encode('utf-8'))
+            for name in names)
+        _, body = self.swift().post_account(
+            headers={'Accept': 'application/json',
+                     'Content-Type': 'text/plain'},
+            query_string='bulk-delete', data=data)
+        result = json.loads(body)
+        errors = result.get('Errors') or []
+        for name, status in errors:
+            LOG.warning('Unable to delete {0}: {1}'.format(name, status))
+        if not errors and not result.get(
+                'Response Status', '200').startswith('2'):
+            LOG.warning('Bulk delete failed: {0} {1}'.format(
+                result.get('Response Status'), result.get('Response Body')))
+            return len(names)
+        return len(errors)
+
+    def _delete_objects(self, container, names):
+        """Delete objects one by one, the missing objects are ignored.
+
+        :return: number of objects not deleted
+        """
+        failed = 0
+        for name in names:
+            try:
+                self.swift().delete_object(container, name)
+            except Exception as e:
+                if getattr(e, 'http_status', None) == 404:
+                    continue
+                LOG.warning('Unable to delete {0}: {1}'.format(name, e))
+                failed += 1
+        return failed
 
     def put_file(self, from_path, to_path):
         split = to_path.rsplit('/', 1)
@@ -51,12 +140,28 @@ class SwiftStorage(physical.PhysicalStorage):
                                     content_length=file_size)
 
     def __init__(self, client_manager, container, max_segment_size,
-                 skip_prepare=False):
+                 skip_prepare=False, upload_workers=1, slo=False,
+                 download_workers=1, delete_workers=1):
         """
         :type client_manager: freezer.osclients.OSClientManager
         :type container: str
+        :param upload_workers: number of segments uploaded concurrently
+        :param slo: upload static large object manifests instead of dynamic
+                    large object ones
+        :param download_workers: number of segments downloaded concurrently
+                                 on restore
+        :param delete_workers: number of deletion requests sent
+                               concurrently
         """
         self.client_manager = client_manager
+        # Connections of the threads, created once and reused
+        self._connections = threading.local()
+        self.upload_workers = int(upload_workers or 1)
+        self.download_workers = int(download_workers or 1)
+        self.delete_workers = int(delete_workers or 1)
+        # Maximum number of objects of a bulk delete, 0 if not supported
+        self._bulk_delete_max = None
+        self.slo = slo
         super(SwiftStorage, self).__init__(
             storage_path=container,
             max_segment_size=max_segment_size,
@@ -64,56 +169,93 @@ class SwiftStorage(physical.PhysicalStorage):
         self.container = container
         self.segments = "{0}_segments".format(container)
 
+    def catalog_key(self):
+        swift_args = getattr(self.client_manager, 'swift_args', {})
+        return '{0}:{1}/{2}/{3}'.format(
+            self.type, swift_args.get('auth_url'),
+            swift_args.get('project_id') or swift_args.get('project_name'),
+            self.storage_path)
+
     def swift(self):
-        """
+        """Get the connection of the current thread.
+
+        The connection is created once per thread and process, then reused:
+        swiftclient authenticates again when the token expires.
+
         :rtype: swiftclient.Connection
         :return:
         """
-        return self.client_manager.create_swift()
+        connections = self._connections
+        if getattr(connections, 'pid', None) != os.getpid():
+            connections.connection = self.client_manager.create_swift()
+            connections.pid = os.getpid()
+        return connections.connection
+
+    def _reset_connection(self):
+        """Drop the connection of the current thread after an error"""
+        self._connections.pid = None
 
     def upload_chunk(self, content, path):
-        """
-        """
-        # If for some reason the swift client object is not available anymore
-        # an exception is generated and a new client object is initialized/
-        # If the exception happens for 10 consecutive times for a total of
-        # 1 hour, then the program will exit with an Exception.
+        """Upload a segment, retrying with an exponential backoff.
+
+        If the upload fails for UPLOAD_RETRIES consecutive times, then the
+        program will exit with an Exception.
 
-        count = 0
-        success = False
+        :return: etag of the segment
+        """
         split = path.rsplit('/', 1)
-        while not success:
+        for attempt in range(UPLOAD_RETRIES):
             try:
                 LOG.debug(
                     'Uploading file chunk index: {0}'.format(path))
-                self.swift().put_object(
+                etag = self.swift().put_object(
                     split[0], split[1], content,
                     content_type='application/octet-stream',
                     content_length=len(content))
                 LOG.debug('Data successfully uploaded!')
-                success = True
+                return etag
             except Exception as error:
-                LOG.info(
-                    'Retrying to upload file chunk index: {0}'.format(
-                        path))
-                time.sleep(60)
-                count += 1
-                if count == 10:
+                if attempt == UPLOAD_RETRIES - 1:
                     LOG.critical('Error: add_object: {0}'
                                  .format(error))
                     raise Exception("cannot add object to storage")
+                delay = min(RETRY_DELAY * 2 ** attempt, MAX_RETRY_DELAY)
+                LOG.info(
+                    'Retrying to upload file chunk index: {0} in {1} '
+                    'seconds: {2}'.format(path, delay, error))
+                # A new connection is created for the next attempt
+                self._reset_connection()
+                time.sleep(random.uniform(delay / 2.0, delay))
 
-    def upload_manifest(self, backup):
+    def upload_manifest(self, backup, segments=None):
         """
         Upload Manifest to manage segments in Swift
 
         :param backup: Backup
         :type backup: freezer.storage.base.Backup
+        :param segments: list of (path, etag, size) of the segments, needed
+                         for a static large object manifest
         """
         backup = backup.copy(storage=self)
+        split = backup.data_path.rsplit('/', 1)
+        if self.slo and segments and len(segments) <= SLO_MAX_SEGMENTS:
+            manifest = json.dumps([
+                {'path': '/' + path, 'etag': etag, 'size_bytes': size}
+                for path, etag, size in segments])
+            LOG.info('[*] Uploading Swift SLO Manifest: {0}'.format(backup))
+            self.swift().put_object(container=split[0], obj=split[1],
+                                    contents=manifest,
+                                    content_length=len(manifest),
+                                    query_string='multipart-manifest=put')
+            LOG.info('Manifest successfully uploaded!')
+            return
+
+        if self.slo and segments:
+            LOG.warning('[*] {0} segments exceed the static large object '
+                        'limit, uploading a dynamic large object '
+                        'manifest'.format(len(segments)))
         headers = {'x-object-manifest': backup.segments_path}
         LOG.info('[*] Uploading Swift Manifest: {0}'.format(backup))
-        split = backup.data_path.rsplit('/', 1)
         self.swift().put_object(container=split[0], obj=split[1],
                                 contents=u'', headers=headers,
                                 content_length=len(u''))
@@ -180,12 +322,22 @@ class SwiftStorage(physical.PhysicalStorage):
 
     def backup_blocks(self, backup):
         """
+        The segments of a large object are downloaded concurrently when
+        there are several download workers.
 
         :param backup:
         :type backup: freezer.storage.base.Backup
         :return:
         """
         split = backup.data_path.split('/', 1)
+        segments = None
+        if self.download_workers > 1:
+            segments = self._list_segments(split[0], split[1])
+        if segments:
+            for chunk in self.read_ahead(self._get_segment, segments):
+                yield chunk
+            return
+
         try:
             chunks = self.swift().get_object(
                 split[0], split[1],
@@ -199,18 +351,79 @@ class SwiftStorage(physical.PhysicalStorage):
         for chunk in chunks:
             yield chunk
 
+    def _list_segments(self, container, obj):
+        """List the segments of a large object, in order.
+
+        The segments of a dynamic large object are listed from the segments
+        container, they are only used if their total size is the size of
+        the object.
+
+        :return: list of (container, name) of the segments, None if the
+                 object is not a large object
+        """
+        headers = self.swift().head_object(container, obj)
+        if headers.get('x-static-large-object', '').lower() == 'true':
+            manifest = json.loads(self.swift().get_object(
+                container, obj, query_string='multipart-manifest=get')[1])
+            return [segment['name'].lstrip('/').split('/', 1)
+                    for segment in manifest]
+
+        if 'x-object-manifest' not in headers:
+            return None
+        segments_container, prefix = \
+            headers['x-object-manifest'].split('/', 1)
+        listing = self.swift().get_container(
+            segments_container, prefix=prefix, full_listing=True)[1]
+        if sum(item['bytes'] for item in listing) != int(
+                headers.get('content-length', -1)):
+            LOG.warning('[*] Segments listing of {0} incomplete, downloading '
+                        'it sequentially'.format(obj))
+            return None
+        return [(segments_container, item['name']) for item in listing]
+
+    def _get_segment(self, segment):
+        return self.swift().get_object(segment[0], segment[1])[1]
+
+    def read_range(self, path, offset, length=None):
+        split = path.split('/', 1)
+        end = '' if length is None else offset + length - 1
+        headers = {'Range': 'bytes={0}-{1}'.format(offset, end)}
+        return self.swift().get_object(
+            split[0], split[1], headers=headers,
+            resp_chunk_size=self.max_segment_size)[1]
+
     def write_backup(self, rich_queue, backup):
         """
         Upload object on the remote swift server
+
+        Up to upload_workers segments are uploaded concurrently, each on its
+        own connection, so at most as many segments are held in memory.
+
         :type rich_queue: freezer.streaming.RichQueue
         :type backup: freezer.storage.base.Backup
         """
         backup = backup.copy(storage=self)
-        for block_index, message in enumerate(rich_queue.get_messages()):
-            segment_package_name = u'{0}/{1}'.format(
-                backup.segments_path, "%08d" % block_index)
-            self.upload_chunk(message, segment_package_name)
-        self.upload_manifest(backup)
+        segments = []
+        pending = collections.deque()
+        executor = futures.ThreadPoolExecutor(max_workers=self.upload_workers)
+        try:
+            for block_index, message in enumerate(rich_queue.get_messages()):
+                segment_package_name = u'{0}/{1}'.format(
+                    backup.segments_path, "%08d" % block_index)
+                segments.append([segment_package_name, None, len(message)])
+                pending.append((block_index, executor.submit(
+                    self.upload_chunk, message, segment_package_name)))
+                while len(pending) >= self.upload_workers:
+                    index, future = pending.popleft()
+                    segments[index][1] = future.result()
+            while pending:
+                index, future = pending.popleft()
+                segments[index][1] = future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+        self.upload_manifest(backup, segments)
 
     def listdir(self, path):
         """
@@ -314,6 +314,8 @@ class BackupOpt1(object):
         self.max_level = '0'
         self.hostname_backup_name = "hostname_backup_name"
         self.remove_older_than = '0'
+        self.synthetic_full = False
+        self.restore_path_filter = None
         self.max_segment_size = '0'
         self.time_stamp = 123456789
         self.container = 'test-container'
@@ -338,9 +340,11 @@ class BackupOpt1(object):
         self.cinder_vol_id = ''
         self.cinder_vol_name = ''
         self.cindernative_vol_id = ''
+        self.cinderbrick_vol_id = ''
         self.cindernative_backup_id = ''
         self.nova_inst_id = ''
         self.nova_inst_name = ''
+        self.project_id = ''
         self.lvm_snapperm = 'ro'
 
         self.compression = 'gzip'
@@ -0,0 +1,71 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import unittest
+
+import six
+
+from freezer.engine.dedup import chunker
+
+
+class TestChunker(unittest.TestCase):
+    def setUp(self):
+        super(TestChunker, self).setUp()
+        rand = random.Random(0)
+        self.data = bytes(bytearray(
+            rand.randint(0, 255) for _ in range(256 * 1024)))
+
+    def test_chunk_limits(self):
+        self.assertEqual((4096, 65536, 16383), chunker.chunk_limits(16384))
+        self.assertEqual((4096, 65536, 16383), chunker.chunk_limits(20000))
+        self.assertEqual(chunker.MAX_MASK,
+                         chunker.chunk_limits(1 << 30)[2])
+
+    def test_window_flags(self):
+        mask = 255
+        flags = chunker.window_flags(self.data, chunker.WINDOW_SIZE - 1,
+                                     mask)
+        self.assertEqual(len(self.data) - chunker.WINDOW_SIZE + 1,
+                         len(flags))
+        for offset in (chunker.WINDOW_SIZE - 1, 1000, len(self.data) - 1):
+            window = bytearray(
+                self.data[offset - chunker.WINDOW_SIZE + 1:offset + 1])
+            total = sum(chunker.GEAR_TABLE[b] for b in window)
+            self.assertEqual(bool(total & mask),
+                             bool(flags[offset - chunker.WINDOW_SIZE + 1]))
+
+    def test_chunks(self):
+        chunks = list(chunker.chunks(six.BytesIO(self.data), 8192))
+        min_size, max_size, mask = chunker.chunk_limits(8192)
+        self.assertEqual(self.data, b''.join(chunks))
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks[:-1]:
+            self.assertTrue(min_size <= len(chunk) <= max_size)
+
+    def test_chunks_read_size(self):
+        self.addCleanup(setattr, chunker, 'READ_SIZE', chunker.READ_SIZE)
+        expected = list(chunker.chunks(six.BytesIO(self.data), 8192))
+        chunker.READ_SIZE = 1000
+        self.assertEqual(expected,
+                         list(chunker.chunks(six.BytesIO(self.data), 8192)))
+
+    def test_chunks_insertion(self):
+        data = self.data[:5000] + b'inserted' + self.data[5000:]
+        chunks = list(chunker.chunks(six.BytesIO(self.data), 8192))
+        new_chunks = list(chunker.chunks(six.BytesIO(data), 8192))
+        # only the chunks around the insertion change
+        self.assertTrue(len(set(chunks) - set(new_chunks)) <= 2)
+        self.assertEqual(chunks[-5:], new_chunks[-5:])
+
+    def test_chunks_empty(self):
+        self.assertEqual([], list(chunker.chunks(six.BytesIO(b''), 8192)))
@@ -0,0 +1,213 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import mock
+from six.moves import queue
+
+from freezer.engine.dedup import dedup
+from freezer.storage import base
+from freezer.storage import local
+from freezer.utils import streaming
+
+
+class TestDedupEngine(unittest.TestCase):
+    def setUp(self):
+        super(TestDedupEngine, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        self.dst = os.path.join(self.tmpdir, 'dst')
+        self.manifest = os.path.join(self.tmpdir, 'manifest')
+        os.makedirs(os.path.join(self.src, 'dir'))
+        os.makedirs(self.dst)
+
+        rand = random.Random(0)
+        self.data = bytes(bytearray(
+            rand.randint(0, 255) for _ in range(64 * 1024)))
+        self.write_file('file', self.data)
+        self.write_file(os.path.join('dir', 'copy'),
+                        self.data[:100] + b'changed' + self.data[100:])
+        os.symlink('file', os.path.join(self.src, 'link'))
+
+        self.storage = local.LocalStorage(
+            os.path.join(self.tmpdir, 'storage'), 1024, skip_prepare=True)
+        self.engine = dedup.DedupEngine(compression='gzip',
+                                        storage=self.storage,
+                                        max_segment_size=1024,
+                                        dedup_chunk_size=4096)
+
+    def tearDown(self):
+        super(TestDedupEngine, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, rel_path, data):
+        with open(os.path.join(self.src, rel_path), 'wb') as fd:
+            fd.write(data)
+
+    def backup(self):
+        cwd = os.getcwd()
+        os.chdir(self.src)
+        try:
+            return list(self.engine.backup_data('.', self.manifest))
+        finally:
+            os.chdir(cwd)
+
+    def restore(self, blocks):
+        read_pipe = mock.MagicMock()
+        read_pipe.recv_bytes.side_effect = blocks + [EOFError()]
+        backup = mock.MagicMock(storage=self.storage)
+        backup.metadata.return_value = self.engine.metadata()
+        self.engine.restore_level(self.dst, read_pipe, backup, queue.Queue())
+
+    def list_chunks(self):
+        chunks = set()
+        for dir_path, dir_names, file_names in os.walk(
+                os.path.join(self.tmpdir, 'storage', dedup.CHUNKS_DIR)):
+            if dedup.CHUNK_OBJECT in file_names:
+                chunks.add(os.path.basename(dir_path))
+        return chunks
+
+    def test_restore_levels(self):
+        self.assertEqual([2], self.engine.restore_levels(
+            {0: mock.Mock(), 1: mock.Mock(), 2: mock.Mock()}))
+
+    def test_backup_stores_chunks_once(self):
+        self.backup()
+        meta, chunk_size = self.engine.get_fs_meta_struct(self.manifest)
+        self.assertEqual(4096, chunk_size)
+        file_chunks = set(c[0] for c in meta['file']['chunks'])
+        copy_chunks = set(c[0] for c in meta['dir/copy']['chunks'])
+        self.assertTrue(file_chunks & copy_chunks)
+        self.assertEqual(file_chunks | copy_chunks, self.list_chunks())
+
+    def test_backup_exclude(self):
+        self.engine.exclude = 'dir'
+        self.backup()
+        meta, chunk_size = self.engine.get_fs_meta_struct(self.manifest)
+        self.assertEqual(['file'], sorted(meta))
+
+    def test_backup_unchanged_files(self):
+        self.backup()
+        chunks = self.list_chunks()
+        with mock.patch.object(dedup.ChunkPool, 'put') as mock_put:
+            with mock.patch('freezer.engine.dedup.chunker.chunks') as \
+                    mock_chunks:
+                self.backup()
+        self.assertFalse(mock_chunks.called)
+        self.assertFalse(mock_put.called)
+        self.assertEqual(chunks, self.list_chunks())
+
+    def test_backup_existing_chunks(self):
+        self.backup()
+        chunks = self.list_chunks()
+        os.remove(self.manifest)
+        with mock.patch.object(dedup.ChunkPool, 'put') as mock_put:
+            self.backup()
+        self.assertFalse(mock_put.called)
+        self.assertEqual(chunks, self.list_chunks())
+
+    def test_restore(self):
+        self.restore(self.backup())
+        with open(os.path.join(self.dst, 'file'), 'rb') as fd:
+            self.assertEqual(self.data, fd.read())
+        with open(os.path.join(self.dst, 'dir', 'copy'), 'rb') as fd:
+            self.assertEqual(self.data[:100] + b'changed' + self.data[100:],
+                             fd.read())
+        self.assertEqual('file', os.readlink(os.path.join(self.dst, 'link')))
+        self.assertEqual(os.stat(os.path.join(self.src, 'dir')).st_mtime,
+                         os.stat(os.path.join(self.dst, 'dir')).st_mtime)
+
+    def test_restore_corrupted_chunk(self):
+        blocks = self.backup()
+        chunk_id = self.list_chunks().pop()
+        pool = dedup.ChunkPool(self.storage, 'gzip')
+        chunk_path = os.path.join(pool.chunk_path(chunk_id),
+                                  dedup.CHUNK_OBJECT)
+        with open(chunk_path, 'wb') as fd:
+            fd.write(self.engine._encode_chunk(b'corrupted'))
+        self.assertRaises(Exception, self.restore, blocks)
+
+    def backup_chain(self, hostname_backup_name, timestamp):
+        backup = base.Backup(self.engine, hostname_backup_name, timestamp,
+                             timestamp, 0)
+        rich_queue = streaming.RichQueue(100)
+        rich_queue.put_messages(self.backup())
+        self.storage.write_backup(rich_queue, backup)
+        freezer_meta = os.path.join(self.tmpdir, 'freezer_meta')
+        with open(freezer_meta, 'w') as fd:
+            fd.write(json.dumps(self.engine.metadata()))
+        self.storage.put_metadata(self.manifest, freezer_meta, backup)
+        self.engine._remove_markers()
+        meta, chunk_size = self.engine.get_fs_meta_struct(self.manifest)
+        os.remove(self.manifest)
+        return set(chunk[0] for file_meta in meta.values()
+                   for chunk in file_meta['chunks'])
+
+    def test_remove_frees_unreferenced_chunks(self):
+        removed_chunks = self.backup_chain('host_a', 1000)
+        os.remove(os.path.join(self.src, 'file'))
+        self.write_file('new', self.data[::-1])
+        kept_chunks = self.backup_chain('host/b', 2000)
+        self.assertTrue(removed_chunks - kept_chunks)
+        self.assertTrue(removed_chunks & kept_chunks)
+        self.assertEqual(removed_chunks | kept_chunks, self.list_chunks())
+
+        self.storage.remove_older_than(self.engine, 1500, 'host_a')
+        self.assertEqual(kept_chunks, self.list_chunks())
+
+    def test_remove_keeps_chunks_of_incomplete_backups(self):
+        self.backup_chain('host_a', 1000)
+        chunks = self.list_chunks()
+        os.makedirs(os.path.join(self.storage.storage_path, 'data',
+                                 'dedup', 'host_b', '1000', '0_1000'))
+        self.storage.remove_older_than(self.engine, 1500, 'host_a')
+        self.assertEqual(chunks, self.list_chunks())
+
+    def test_remove_during_backup(self):
+        other_agent = dedup.DedupEngine(compression='gzip',
+                                        storage=self.storage,
+                                        max_segment_size=1024,
+                                        dedup_chunk_size=4096)
+        put = dedup.ChunkPool.put
+
+        def put_and_remove(pool, chunk_id, from_path):
+            put(pool, chunk_id, from_path)
+            other_agent.remove_unreferenced_data(self.storage)
+
+        with mock.patch.object(dedup.ChunkPool, 'put', autospec=True,
+                               side_effect=put_and_remove):
+            self.backup()
+        meta, chunk_size = self.engine.get_fs_meta_struct(self.manifest)
+        self.assertEqual(set(chunk[0] for file_meta in meta.values()
+                             for chunk in file_meta['chunks']),
+                         self.list_chunks())
+
+    def test_remove_ignores_expired_markers(self):
+        self.backup_chain('host_b', 1000)
+        os.makedirs(os.path.join(
+            self.storage.storage_path, dedup.IN_PROGRESS_DIR,
+            '1000_{0}'.format('0' * 32)))
+        self.storage.remove_older_than(self.engine, 1500, 'host_b')
+        self.assertEqual(set(), self.list_chunks())
+
+    def test_backup_checks_known_chunks(self):
+        self.backup()
+        self.engine._remove_markers()
+        pool = dedup.ChunkPool(self.storage, 'gzip')
+        shutil.rmtree(pool.chunk_path(self.list_chunks().pop()))
+        self.assertRaises(Exception, self.backup)
@@ -0,0 +1,80 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from freezer.engine.rsyncv2 import dataindex
+from freezer.utils import compress
+
+
+class TestDataIndex(unittest.TestCase):
+    def setUp(self):
+        super(TestDataIndex, self).setUp()
+        self.index = dataindex.DataIndex(
+            100, [[0, 10], [50, 60], [100, 130], [150, 190]])
+
+    def test_segment(self):
+        self.assertEqual((0, 10), self.index.segment(0))
+        self.assertEqual((1, 30), self.index.segment(2))
+
+    def test_runs(self):
+        pieces = [(0, 10), (20, 40), (70, 10), (160, 5)]
+        self.assertEqual([(0, 2, [(0, 10), (20, 40), (70, 10)]),
+                          (3, None, [(160, 5)])],
+                         self.index.runs(pieces))
+
+    def test_write_read(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'data_index')
+            self.index.write(path, 'gzip')
+            index = dataindex.DataIndex.read(path, 'gzip')
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(100, index.segment_size)
+        self.assertEqual(self.index.points, index.points)
+
+
+class TestIndexingCompressor(unittest.TestCase):
+    @mock.patch('freezer.engine.rsyncv2.dataindex.DATA_INDEX_INTERVAL', 100)
+    def test_sync_points(self):
+        data = os.urandom(250)
+        compressor = dataindex.IndexingCompressor(
+            compress.Compressor('gzip'), 64, 16)
+        stream = compressor.compress(b'header')
+        compressor.start_data()
+        stream += compressor.compress(data[:120])
+        stream += compressor.compress(data[120:])
+        stream += compressor.flush()
+
+        points = compressor.index.points
+        self.assertEqual([0, 100, 200], [point[0] for point in points])
+        self.assertEqual(16 + len(stream), compressor.position)
+        decompressor = compress.Decompressor('gzip')
+        self.assertEqual(b'header' + data, decompressor.decompress(stream))
+        for data_offset, position in points:
+            decompressor = compress.Decompressor('gzip', raw=True)
+            self.assertEqual(
+                data[data_offset:],
+                decompressor.decompress(stream[position - 16:]))
+
+    def test_no_sync_points(self):
+        compressor = dataindex.IndexingCompressor(
+            compress.Compressor('bzip2'), 64)
+        compressor.start_data()
+        compressor.compress(b'data')
+        self.assertIsNone(compressor.index)
@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import stat
+import unittest
+
+from freezer.engine.rsyncv2 import planner
+from freezer.engine.rsyncv2 import pyrsync
+
+REG = stat.S_IFREG | 0o644
+DIR = stat.S_IFDIR | 0o755
+
+
+def reg(path, size, **kwargs):
+    file_header = {'path': path, 'inode': {'mode': REG, 'size': size}}
+    file_header.update(kwargs)
+    return file_header
+
+
+class TestPlannedFile(unittest.TestCase):
+    def test_data_ranges(self):
+        planned_file = planner.PlannedFile(
+            reg('f', 40), 40, [(0, 10, 0, 100), (10, 5, 1, 0),
+                               (20, 20, 0, 200)])
+        self.assertEqual([[0, 15], [20, 20]], planned_file.data_ranges())
+
+
+class TestPatchPieces(unittest.TestCase):
+    def test_patch_pieces(self):
+        old_file = planner.PlannedFile(
+            reg('f', 40), 40, [(0, 10, 0, 100), (20, 20, 0, 200)])
+        patch = [[pyrsync.LITERAL, 3], [0, 2], [3, 2], [1, 1]]
+        pieces, size, literals_size = planner.patch_pieces(
+            old_file, patch, 8, 1, 50)
+        self.assertEqual(3, literals_size)
+        # 3 literals, blocks 0-1 [0, 16), blocks 3-4 [24, 40), block 1
+        self.assertEqual(3 + 16 + 16 + 8, size)
+        self.assertEqual([(0, 3, 1, 50),
+                          (3, 10, 0, 100),
+                          (19, 16, 0, 204),
+                          (35, 2, 0, 108)], pieces)
+
+    def test_patch_pieces_merged(self):
+        old_file = planner.PlannedFile(reg('f', 32), 32, [(0, 32, 0, 0)])
+        pieces, size, _ = planner.patch_pieces(
+            old_file, [[0, 1], [1, 1], [2, 2]], 8, 1, 0)
+        self.assertEqual(32, size)
+        self.assertEqual([(0, 32, 0, 0)], pieces)
+
+    def test_data_pieces_extents(self):
+        pieces, size, data_size = planner.data_pieces(
+            reg('f', 100, extents=[[10, 5], [50, 5]]), 2, 7)
+        self.assertEqual(100, size)
+        self.assertEqual(10, data_size)
+        self.assertEqual([(10, 5, 2, 7), (50, 5, 2, 12)], pieces)
+
+
+class TestRestorePlan(unittest.TestCase):
+    def setUp(self):
+        super(TestRestorePlan, self).setUp()
+        self.plan = planner.RestorePlan()
+        self.plan.add_level(0, [
+            {'path': 'd', 'inode': {'mode': DIR}},
+            reg('d/a', 10),
+            reg('b', 20),
+            reg('c', 30)], 8)
+
+    def test_level_zero(self):
+        self.assertEqual(['b', 'c', 'd', 'd/a'], sorted(self.plan.files))
+        self.assertEqual({0: 60}, self.plan.data_sizes)
+        self.assertEqual({0: [(0, 10, 'd/a', 0), (10, 20, 'b', 0),
+                              (30, 30, 'c', 0)]},
+                         self.plan.level_pieces())
+
+    def test_overwritten_and_deleted(self):
+        self.plan.add_level(1, [
+            reg('c', 5, new_level=True),
+            {'path': 'd', 'deleted': True},
+            {'path': 'd/a', 'deleted': True}], 8)
+        self.assertEqual(['b', 'c'], sorted(self.plan.files))
+        self.assertEqual(set(['d', 'd/a']), self.plan.removed_paths())
+        self.assertEqual({0: [(10, 20, 'b', 0)], 1: [(0, 5, 'c', 0)]},
+                         self.plan.level_pieces())
+
+    def test_patched(self):
+        self.plan.add_level(1, [
+            reg('c', 25, new_level=True,
+                patch=[[2, 2], [pyrsync.LITERAL, 3], [0, 1]])], 8)
+        self.assertEqual(25, self.plan.files['c'].size)
+        self.assertEqual(3, self.plan.data_sizes[1])
+        self.assertEqual({0: [(0, 10, 'd/a', 0),
+                              (10, 20, 'b', 0),
+                              (30, 8, 'c', 17),
+                              (46, 14, 'c', 0)],
+                          1: [(0, 3, 'c', 14)]},
+                         self.plan.level_pieces())
+
+    def test_patch_missing_file(self):
+        self.assertRaises(Exception, self.plan.add_level, 1,
+                          [reg('x', 8, new_level=True, patch=[[0, 1]])], 8)
+
+    def test_renamed_and_linked(self):
+        b_file = self.plan.files['b']
+        self.plan.add_level(1, [
+            reg('c', 20, prev_name='b'),
+            reg('b', 30, prev_name='c'),
+            reg('e', 20, link='c')], 8)
+        self.assertIs(b_file, self.plan.files['c'])
+        self.assertIs(b_file, self.plan.files['e'])
+        self.assertEqual({0: [(0, 10, 'd/a', 0), (10, 20, 'c', 0),
+                              (30, 30, 'b', 0)],
+                          1: []},
+                         self.plan.level_pieces())
+
+    def test_select(self):
+        self.plan.add_level(1, [{'path': 'd/e', 'inode': {'mode': DIR}},
+                                reg('d/e/f', 5)], 8)
+        self.plan.select(['d/e', 'c'])
+        self.assertEqual(['c', 'd', 'd/e', 'd/e/f'], sorted(self.plan.files))
+        self.assertEqual(set(), self.plan.removed_paths())
+        self.assertEqual({0: [(30, 30, 'c', 0)], 1: [(0, 5, 'd/e/f', 0)]},
+                         self.plan.level_pieces())
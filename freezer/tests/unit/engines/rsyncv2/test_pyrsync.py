@@ -0,0 +1,173 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import binascii
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from freezer.engine.rsyncv2 import pyrsync
+
+
+class TestPyrsync(unittest.TestCase):
+    def setUp(self):
+        super(TestPyrsync, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmpdir, 'file')
+
+    def tearDown(self):
+        super(TestPyrsync, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, data):
+        with open(self.file_path, 'wb') as fd:
+            fd.write(data)
+
+    def test_blockchecksums(self):
+        self.write_file(b'aae9dd83aa45f906'
+                        b'a4629f42e97eac99'
+                        b'b9882284dc7030ca'
+                        b'427ad365fedd2a55')
+        hash_name, weak, strong = pyrsync.blockchecksums(
+            (self.file_path, 16, 'sha1'))
+        self.assertEqual('sha1', hash_name)
+        self.assertEqual(16, len(weak))
+        self.assertEqual(80, len(strong))
+        self.assertEqual(
+            '0f923c37c14f648de4065d4666c2429231a923bc',
+            binascii.hexlify(strong[:20]).decode())
+        self.assertEqual(pyrsync.adler32fast(b'a4629f42e97eac99'),
+                         pyrsync.unpack_weak(weak)[1])
+
+    def test_blockchecksums_default_hash(self):
+        self.write_file(os.urandom(40))
+        hash_name, weak, strong = pyrsync.blockchecksums((self.file_path, 16))
+        self.assertEqual(pyrsync.STRONG_HASH, hash_name)
+        self.assertEqual(12, len(weak))
+        digest_size = len(pyrsync.strong_digest(hash_name)(b''))
+        self.assertEqual(3 * digest_size, len(strong))
+
+    def test_block_checksums_pieces(self):
+        data = os.urandom(1000)
+        self.write_file(data)
+        checksums = pyrsync.BlockChecksums(16)
+        for offset, size in ((0, 5), (5, 11), (16, 40), (56, 0), (56, 944)):
+            checksums.update(data[offset:offset + size])
+        self.assertEqual(pyrsync.blockchecksums((self.file_path, 16)),
+                         checksums.signature())
+
+    def test_block_checksums_zeros(self):
+        data = b'abc' + b'\0' * 50 + b'def' + b'\0' * 7
+        checksums = pyrsync.BlockChecksums(16)
+        checksums.update(b'abc')
+        checksums.update_zeros(50)
+        checksums.update(b'def')
+        checksums.update_zeros(7)
+        expected = pyrsync.BlockChecksums(16)
+        expected.update(data)
+        self.assertEqual(expected.signature(), checksums.signature())
+
+    def test_legacy_signature(self):
+        legacy = ([pyrsync.adler32fast(b'x')],
+                  ['0f923c37c14f648de4065d4666c2429231a923bc'])
+        self.assertEqual(
+            ['sha1', pyrsync.pack_weak([pyrsync.adler32fast(b'x')]),
+             binascii.unhexlify('0f923c37c14f648de4065d4666c2429231a923bc')],
+            pyrsync.legacy_signature(legacy))
+
+    def test_adler32_windows(self):
+        data = os.urandom(1000)
+        for blocksize in (1, 16, 100, 1000):
+            checksums = array.array(
+                'I', pyrsync.adler32_windows(data, blocksize))
+            if sys.byteorder == 'big':
+                checksums.byteswap()
+            self.assertEqual(
+                [pyrsync.adler32fast(data[i:i + blocksize])
+                 for i in range(len(data) - blocksize + 1)],
+                checksums.tolist())
+
+    def test_adler32_windows_short(self):
+        self.assertEqual(b'', pyrsync.adler32_windows(b'data', 16))
+
+    def test_rsyncpatch_info(self):
+        data = b''.join(os.urandom(16) for _ in range(4))
+        self.write_file(data)
+        signature = pyrsync.blockchecksums((self.file_path, 16))
+
+        self.write_file(b'X' * 16 + data[16:48] + b'Y' * 20)
+        len_literals, patch, fixed_blocks = pyrsync.rsyncpatch_info(
+            (self.file_path, signature, 16))
+
+        self.assertEqual(36, len_literals)
+        self.assertEqual([[pyrsync.LITERAL, 16], [1, 2],
+                          [pyrsync.LITERAL, 20]], patch)
+        self.assertEqual(2, fixed_blocks)
+
+    def test_rsyncpatch_info_shifted(self):
+        data = os.urandom(1024)
+        self.write_file(data)
+        signature = pyrsync.blockchecksums((self.file_path, 16))
+
+        self.write_file(b'Z' + data[:500] + data[510:])
+        len_literals, patch, fixed_blocks = pyrsync.rsyncpatch_info(
+            (self.file_path, signature, 16))
+
+        self.assertEqual([[pyrsync.LITERAL, 1], [0, 31],
+                          [pyrsync.LITERAL, 6], [32, 32]], patch)
+        self.assertEqual(7, len_literals)
+        self.assertEqual(63, fixed_blocks)
+
+    def test_rsyncpatch_info_sha1(self):
+        data = os.urandom(64)
+        self.write_file(data)
+        signature = pyrsync.blockchecksums((self.file_path, 16, 'sha1'))
+
+        self.write_file(data[16:] + b'tail')
+        self.assertEqual(
+            (4, [[1, 3], [pyrsync.LITERAL, 4]], 3),
+            pyrsync.rsyncpatch_info((self.file_path, signature, 16)))
+
+    def test_rsyncpatch_info_unchanged(self):
+        self.write_file(os.urandom(100))
+        signature = pyrsync.blockchecksums((self.file_path, 16))
+        self.assertEqual(
+            (0, [[0, 7]], 7),
+            pyrsync.rsyncpatch_info((self.file_path, signature, 16)))
+
+    def test_rsyncpatch_info_signature(self):
+        data = os.urandom(256)
+        self.write_file(data)
+        signature = pyrsync.blockchecksums((self.file_path, 16))
+
+        self.write_file(data[:100] + b'new data' + data[100:])
+        new_signature = pyrsync.blockchecksums((self.file_path, 16))
+        len_literals, patch, fixed_blocks, signature, literals = \
+            pyrsync.rsyncpatch_info((self.file_path, signature, 16,
+                                     pyrsync.STRONG_HASH, 100))
+
+        self.assertEqual(new_signature, signature)
+        self.assertEqual(len_literals, len(literals))
+        self.assertEqual(data[96:100] + b'new data' + data[100:112],
+                         literals)
+
+    def test_rsyncpatch_info_max_literals(self):
+        self.write_file(os.urandom(64))
+        signature = pyrsync.blockchecksums((self.file_path, 16))
+        self.write_file(os.urandom(64))
+        len_literals, _, _, _, literals = pyrsync.rsyncpatch_info(
+            (self.file_path, signature, 16, pyrsync.STRONG_HASH, 63))
+        self.assertEqual(64, len_literals)
+        self.assertIsNone(literals)
@@ -0,0 +1,453 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mock
+import msgpack
+from six.moves import queue
+
+from freezer.engine.rsyncv2 import planner
+from freezer.engine.rsyncv2 import pyrsync
+from freezer.engine.rsyncv2 import rsyncv2
+from freezer.utils import compress
+from freezer.utils import streaming
+
+
+class TestRsyncv2Engine(unittest.TestCase):
+    def setUp(self):
+        super(TestRsyncv2Engine, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmpdir, 'file')
+        self.engine = rsyncv2.Rsyncv2Engine(compression='gzip',
+                                            storage=None,
+                                            max_segment_size=7,
+                                            rsync_block_size=16)
+
+    def tearDown(self):
+        super(TestRsyncv2Engine, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, data):
+        with open(self.file_path, 'wb') as fd:
+            fd.write(data)
+
+    def read_file(self):
+        with open(self.file_path, 'rb') as fd:
+            return fd.read()
+
+    def backup_patch(self, old_data, new_data):
+        self.write_file(old_data)
+        signature = pyrsync.blockchecksums((self.file_path, 16))
+        self.write_file(new_data)
+        _, patch, _ = pyrsync.rsyncpatch_info(
+            (self.file_path, signature, 16))
+
+        write_queue = queue.Queue()
+        self.engine._backup_patch({'path': self.file_path, 'patch': patch},
+                                  write_queue)
+        blocks = []
+        while not write_queue.empty():
+            blocks.append(write_queue.get())
+        return patch, blocks
+
+    def test_backup_patch(self):
+        old_data = os.urandom(256)
+        patch, blocks = self.backup_patch(
+            old_data, b'new' + old_data[:100] + b'changed' + old_data[100:])
+        self.assertEqual(b'new' + old_data[96:100] + b'changed' +
+                         old_data[100:112], b''.join(blocks))
+        self.assertTrue(all(len(block) <= 7 for block in blocks))
+
+    def test_backup_patch_literals(self):
+        write_queue = queue.Queue()
+        self.engine._backup_patch(
+            {'path': self.file_path, 'patch': [[pyrsync.LITERAL, 10]]},
+            write_queue, b'0123456789')
+        self.assertEqual([b'0123456', b'789'],
+                         [write_queue.get(), write_queue.get()])
+        self.assertTrue(write_queue.empty())
+
+    def test_get_deltas_info(self):
+        old_data = os.urandom(256)
+        self.write_file(old_data)
+        old_fs_meta_struct = {self.file_path: {
+            'signature': pyrsync.blockchecksums((self.file_path, 16))}}
+        self.write_file(old_data[:50] + b'changed' + old_data[50:])
+        backup_header = [{'path': self.file_path, 'new_level': True,
+                          'inode': {'mode': 33188}}]
+        files_meta = {'files': {self.file_path: {'mode': 33188}}}
+
+        cached_literals = self.engine._get_deltas_info(
+            backup_header, old_fs_meta_struct, files_meta, None)
+
+        self.assertIn('patch', backup_header[0])
+        self.assertEqual(pyrsync.blockchecksums((self.file_path, 16)),
+                         files_meta['files'][self.file_path]['signature'])
+        self.assertEqual({self.file_path: old_data[48:50] + b'changed' +
+                          old_data[50:64]}, cached_literals)
+
+    def test_backup_file_signature(self):
+        self.write_file(os.urandom(100))
+        write_queue = queue.Queue()
+        self.assertEqual(
+            pyrsync.blockchecksums((self.file_path, 16)),
+            self.engine._backup_file(self.file_path, write_queue))
+        self.assertEqual(15, write_queue.qsize())
+
+    def test_apply_patch(self):
+        old_data = os.urandom(256)
+        new_data = old_data[:40] + b'changed' + old_data[50:] + b'tail'
+        patch, blocks = self.backup_patch(old_data, new_data)
+
+        self.write_file(old_data)
+        self.engine._apply_patch(self.file_path, patch,
+                                 streaming.ChunkReader(blocks))
+
+        self.assertEqual(new_data, self.read_file())
+        self.assertEqual(['file'], os.listdir(self.tmpdir))
+
+    def test_apply_patch_missing_data(self):
+        self.write_file(b'old')
+        self.assertRaises(EOFError, self.engine._apply_patch,
+                          self.file_path, [[pyrsync.LITERAL, 10]],
+                          streaming.ChunkReader([b'short']))
+        self.assertEqual(b'old', self.read_file())
+        self.assertEqual(['file'], os.listdir(self.tmpdir))
+
+    def test_load_files_meta(self):
+        files_meta = [{'path': 'file', 'inode': {'size': 9}}] * 10
+        data = msgpack.dumps(files_meta) + b'file data'
+        data_stream = streaming.ChunkReader(
+            data[i:i + 7] for i in range(0, len(data), 7))
+
+        self.assertEqual(files_meta,
+                         self.engine._load_files_meta(data_stream))
+        self.engine._create_reg_file(self.file_path, 9, data_stream)
+        self.assertEqual(b'file data', self.read_file())
+        self.assertEqual(b'', data_stream.read())
+
+    def test_load_files_meta_empty(self):
+        self.assertRaises(EOFError, self.engine._load_files_meta,
+                          streaming.ChunkReader([]))
+
+    def write_manifest(self, path, files_meta):
+        with open(path, 'wb') as fd:
+            fd.write(compress.one_shot_compress(
+                'gzip', msgpack.dumps(files_meta)))
+
+    def test_get_fs_meta_struct_legacy(self):
+        self.write_manifest(self.file_path, {
+            'files': {'file': {'mode': 33188, 'signature': [
+                [1, 2], ['0f923c37c14f648de4065d4666c2429231a923bc'] * 2]}},
+            'rsync_struct_ver': 3,
+            'rsync_block_size': 16})
+        fs_meta_struct, rsync_bs = self.engine.get_fs_meta_struct(
+            self.file_path)
+        self.assertEqual(16, rsync_bs)
+        self.assertEqual(
+            pyrsync.legacy_signature(
+                ([1, 2], ['0f923c37c14f648de4065d4666c2429231a923bc'] * 2)),
+            fs_meta_struct['file']['signature'])
+
+    def test_carry_file_meta(self):
+        old_file_meta = {'mode': 33188, 'signature': ['sha1', b'', b'']}
+        self.assertIs(old_file_meta,
+                      self.engine._carry_file_meta(old_file_meta))
+
+        self.engine.manifest_backup = mock.Mock(level=2, timestamp=1000)
+        self.assertEqual({'mode': 33188, 'ref': [2, 1000]},
+                         self.engine._carry_file_meta(old_file_meta))
+        self.assertEqual({'mode': 33188, 'ref': [1, 500]},
+                         self.engine._carry_file_meta(
+                             {'mode': 33188, 'ref': [1, 500]}))
+
+    def test_get_old_signatures(self):
+        old_fs_meta_struct = {
+            'a': {'signature': ['sha1', b'a', b'a']},
+            'b': {'ref': [0, 100]},
+            'c': {'ref': [1, 200]},
+            'd': {'ref': [0, 100]}}
+        self.assertEqual(
+            {'a': ['sha1', b'a', b'a']},
+            self.engine._get_old_signatures('abcd', old_fs_meta_struct))
+
+        self.engine.manifest_backup = mock.Mock()
+        with mock.patch.object(self.engine, '_get_ref_fs_meta_struct') as \
+                get_ref:
+            get_ref.side_effect = lambda ref: {
+                (0, 100): {'b': {'signature': ['sha1', b'b', b'b']},
+                           'd': {'ref': [0, 50]}},
+                (1, 200): {'c': {'signature': ['sha1', b'c', b'c']}}}[ref]
+            self.assertEqual(
+                {'a': ['sha1', b'a', b'a'],
+                 'b': ['sha1', b'b', b'b'],
+                 'c': ['sha1', b'c', b'c']},
+                self.engine._get_old_signatures('abcd', old_fs_meta_struct))
+            self.assertEqual(2, get_ref.call_count)
+
+    def test_get_ref_fs_meta_struct(self):
+        signature = ['sha1', b'weak', b'strong']
+        storage = mock.Mock(storage_path='/storage')
+        storage.get_file.side_effect = lambda from_path, to_path: \
+            self.write_manifest(to_path, {
+                'files': {'file': {'signature': signature}},
+                'rsync_struct_ver': rsyncv2.RSYNC_DATA_STRUCT_VERSION})
+        self.engine.manifest_backup = mock.Mock(
+            hostname_backup_name='host_backup', level_zero_timestamp=100,
+            storage=storage)
+
+        self.assertEqual({'file': {'signature': signature}},
+                         self.engine._get_ref_fs_meta_struct([1, 200]))
+        self.assertEqual(
+            '/storage/data/rsync/host_backup/100/1_200/engine_metadata',
+            storage.get_file.call_args[0][0])
+
+    def test_backup_data_segments(self):
+        data = os.urandom(100)
+        self.write_file(data)
+        manifest_path = os.path.join(self.tmpdir, 'engine_meta')
+        segments = list(self.engine.backup_data(self.file_path,
+                                                manifest_path))
+
+        self.assertTrue(all(len(segment) == 7 for segment in segments[:-1]))
+        self.assertTrue(0 < len(segments[-1]) <= 7)
+        data_stream = streaming.ChunkReader([compress.one_shot_decompress(
+            'gzip', b''.join(segments))])
+        files_meta = self.engine._load_files_meta(data_stream)
+        self.assertEqual(1, len(files_meta))
+        self.assertEqual(data, data_stream.read())
+
+    def test_encrypt_segment(self):
+        cipher = mock.Mock()
+        cipher.encrypt.side_effect = lambda data: data.upper()
+        self.assertEqual(b'HEADERdata', self.engine._encrypt_segment(
+            b'HEADERdata', None, 6))
+        self.assertEqual(b'HEADERDATA', self.engine._encrypt_segment(
+            b'HEADERdata', cipher, 6))
+        self.assertEqual(b'DATA', self.engine._encrypt_segment(
+            b'data', cipher, 0))
+
+    def test_find_links(self):
+        reg_mode = 33188
+        old_fs_meta_struct = {
+            'old': {'mode': reg_mode, 'mtime': 1, 'size': 10, 'dev': 1,
+                    'ino': 10, 'signature': ['sha1', b'', b'']},
+            'log': {'mode': reg_mode, 'mtime': 1, 'size': 10, 'dev': 1,
+                    'ino': 20, 'signature': ['sha1', b'', b'']},
+            'mod': {'mode': reg_mode, 'mtime': 1, 'size': 10, 'dev': 1,
+                    'ino': 30, 'ref': [0, 100]}}
+        new_files = {
+            'new': {'mode': reg_mode, 'mtime': 1, 'size': 10, 'dev': 1,
+                    'ino': 10},
+            'link': {'mode': reg_mode, 'mtime': 1, 'size': 10, 'dev': 1,
+                     'ino': 10},
+            'log': {'mode': reg_mode, 'mtime': 2, 'size': 5, 'dev': 1,
+                    'ino': 40},
+            'log.1': {'mode': reg_mode, 'mtime': 1, 'size': 10, 'dev': 1,
+                      'ino': 20},
+            'mod.new': {'mode': reg_mode, 'mtime': 2, 'size': 10, 'dev': 1,
+                        'ino': 30}}
+        backup_header = [
+            {'path': path, 'inode': {'mode': reg_mode}}
+            for path in ('link', 'new', 'log', 'log.1', 'mod.new')]
+        backup_header[2]['new_level'] = True
+
+        backup_header = self.engine._find_links(
+            backup_header, old_fs_meta_struct, {'files': new_files})
+        self.assertEqual(
+            [{'path': 'link', 'prev_name': 'old'},
+             {'path': 'log'},
+             {'path': 'log.1', 'prev_name': 'log'},
+             {'path': 'mod.new', 'prev_name': 'mod', 'new_level': True},
+             {'path': 'new', 'link': 'link'}],
+            [dict((k, v) for k, v in f.items() if k != 'inode')
+             for f in backup_header])
+        self.assertEqual(['sha1', b'', b''], new_files['link']['signature'])
+        self.assertEqual(10, new_files['link']['ino'])
+        self.assertNotIn('ref', new_files['mod.new'])
+        self.assertEqual([False, True, False, True, False],
+                         [self.engine._has_data(f) for f in backup_header])
+
+    def test_restore_renamed_and_linked_files(self):
+        restore_path = os.path.join(self.tmpdir, 'restore')
+        os.mkdir(restore_path)
+        for name in ('a', 'b'):
+            with open(os.path.join(restore_path, name), 'wb') as fd:
+                fd.write(name.encode())
+        files_meta = [{'path': 'b', 'prev_name': 'a', 'inode': {}},
+                      {'path': 'a', 'prev_name': 'b', 'inode': {}},
+                      {'path': 'c', 'link': 'a', 'inode': {}}]
+
+        moved_dir, moved_files = self.engine._move_renamed_files(
+            files_meta, restore_path)
+        with mock.patch.object(self.engine, '_set_inode'):
+            for file_meta in files_meta:
+                self.engine._restore_file(file_meta, restore_path, None, 1,
+                                          rsyncv2.RestoreTasks(),
+                                          moved_files)
+        os.rmdir(moved_dir)
+
+        self.assertEqual(['a', 'b', 'c'], sorted(os.listdir(restore_path)))
+        with open(os.path.join(restore_path, 'a'), 'rb') as fd:
+            self.assertEqual(b'b', fd.read())
+        with open(os.path.join(restore_path, 'b'), 'rb') as fd:
+            self.assertEqual(b'a', fd.read())
+        self.assertEqual(os.stat(os.path.join(restore_path, 'a')).st_ino,
+                         os.stat(os.path.join(restore_path, 'c')).st_ino)
+
+    def test_create_reg_file_sparse(self):
+        data_stream = streaming.ChunkReader([b'abcdef'])
+        self.engine._create_reg_file(self.file_path, 16, data_stream,
+                                     [[2, 3], [10, 3]])
+        self.assertEqual(b'\0\0abc\0\0\0\0\0def\0\0\0',
+                         self.read_file())
+
+    def test_backup_file_extents(self):
+        data = b'\0' * 20 + b'data' + b'\0' * 20
+        self.write_file(data)
+        write_queue = queue.Queue()
+        signature = self.engine._backup_file(self.file_path, write_queue,
+                                             [[20, 4]], len(data))
+        self.assertEqual(b'data', write_queue.get())
+        self.assertTrue(write_queue.empty())
+        self.assertEqual(pyrsync.blockchecksums((self.file_path, 16)),
+                         signature)
+
+    def test_get_data_extents(self):
+        with open(self.file_path, 'wb') as fd:
+            fd.seek(1024 * 1024)
+            fd.write(b'data')
+        os_stat = os.stat(self.file_path)
+        extents = self.engine._get_data_extents(self.file_path, os_stat)
+        if os_stat.st_blocks * 512 >= os_stat.st_size:
+            # The filesystem does not support sparse files
+            self.assertIsNone(extents)
+        else:
+            self.assertEqual(os_stat.st_size, sum(extents[-1]))
+            self.assertLess(extents[0][0], 1024 * 1024 + 4)
+
+    def test_write_pieces(self):
+        for name in ('a', 'b'):
+            with open(os.path.join(self.tmpdir, name), 'wb') as fd:
+                fd.truncate(10)
+        data_stream = streaming.ChunkReader([b'0123', b'456789'])
+        # The copies of the same data of the stream overlap
+        pieces = [(1, 3, 'a', 0), (2, 4, 'b', 6), (2, 2, 'a', 8),
+                  (8, 2, 'b', 0)]
+        self.engine._write_pieces(self.tmpdir, pieces, data_stream)
+        with open(os.path.join(self.tmpdir, 'a'), 'rb') as fd:
+            self.assertEqual(b'123' + b'\0' * 5 + b'23', fd.read())
+        with open(os.path.join(self.tmpdir, 'b'), 'rb') as fd:
+            self.assertEqual(b'89' + b'\0' * 4 + b'2345', fd.read())
+
+    def test_restore_increments_legacy(self):
+        backups = {0: mock.Mock(), 1: mock.Mock()}
+        with mock.patch.object(
+                self.engine, '_plan_restore', return_value=None), \
+                mock.patch('freezer.engine.engine.BackupEngine.'
+                           'restore_increments') as mock_restore:
+            self.engine.restore_increments(self.tmpdir, backups)
+        mock_restore.assert_called_once_with(self.tmpdir, backups)
+
+    def test_restore_increments_dry_run_filter(self):
+        self.engine.dry_run = True
+        self.engine.restore_path_filter = 'a'
+        backups = {0: mock.Mock()}
+        plan = mock.Mock(files={'a': mock.Mock()})
+        with mock.patch.object(self.engine, '_get_data_index'), \
+                mock.patch.object(self.engine, '_plan_restore',
+                                  return_value=plan), \
+                mock.patch.object(self.engine, '_restore_plan') as \
+                mock_restore_plan, \
+                mock.patch('freezer.engine.engine.BackupEngine.'
+                           'restore_increments') as mock_restore:
+            self.engine.restore_increments(self.tmpdir, backups)
+        plan.select.assert_called_once_with(['a'])
+        self.assertFalse(mock_restore_plan.called)
+        self.assertFalse(mock_restore.called)
+
+    def test_synthetic_header(self):
+        plan = planner.RestorePlan()
+        reg = stat.S_IFREG | 0o644
+        plan.add_level(0, [
+            {'path': 'd', 'inode': {'mode': stat.S_IFDIR | 0o755}},
+            {'path': 'd/a', 'inode': {'mode': reg, 'size': 30},
+             'extents': [[0, 10], [20, 10]]},
+            {'path': 'b', 'inode': {'mode': reg, 'size': 5}}], 8)
+        plan.add_level(1, [
+            {'path': 'b', 'inode': {'mode': reg, 'size': 5},
+             'new_level': True, 'patch': [[pyrsync.LITERAL, 5]]},
+            {'path': 'c', 'inode': {'mode': reg, 'size': 5}, 'link': 'b'}],
+            8)
+        backup_header, data_files = self.engine._synthetic_header(plan)
+        self.assertEqual(
+            [{'path': 'b', 'inode': {'mode': reg, 'size': 5}},
+             {'path': 'd', 'inode': {'mode': stat.S_IFDIR | 0o755}},
+             {'path': 'd/a', 'inode': {'mode': reg, 'size': 30},
+              'extents': [[0, 10], [20, 10]]},
+             {'path': 'c', 'inode': {'mode': reg, 'size': 5}, 'link': 'b'}],
+            backup_header)
+        self.assertEqual([plan.files['b'], plan.files['d/a']], data_files)
+
+    def test_synthetic_blocks(self):
+        with open(os.path.join(self.tmpdir, '0'), 'wb') as fd:
+            fd.write(b'0123456789')
+        with open(os.path.join(self.tmpdir, '1'), 'wb') as fd:
+            fd.write(b'abcdef')
+        data_file = planner.PlannedFile(
+            {}, 12, [(0, 3, 1, 2), (3, 9, 0, 1)])
+        blocks = list(self.engine._synthetic_blocks(
+            self.tmpdir, [{'path': 'f'}], [data_file]))
+        self.assertEqual([{'path': 'f'}], msgpack.loads(blocks[0]))
+        self.assertEqual(b'cde123456789', b''.join(blocks[1:]))
+        self.assertTrue(all(len(block) <= 7 for block in blocks[1:]))
+
+
+class TestRestoreTasks(unittest.TestCase):
+    def test_inline(self):
+        calls = []
+        tasks = rsyncv2.RestoreTasks()
+        self.assertFalse(tasks.concurrent)
+        tasks.submit(calls.append, 1)
+        tasks.defer(calls.append, 2)
+        tasks.defer(calls.append, 3)
+        self.assertEqual([1], calls)
+        tasks.finish()
+        self.assertEqual([1, 3, 2], calls)
+
+    def test_concurrent(self):
+        calls = []
+        tasks = rsyncv2.RestoreTasks(4, 2)
+        self.assertTrue(tasks.concurrent)
+        try:
+            tasks.defer(calls.append, 'deferred')
+            for index in range(20):
+                tasks.submit(calls.append, index)
+                self.assertTrue(len(tasks._pending) <= 2)
+            tasks.finish()
+        finally:
+            tasks.shutdown()
+        self.assertEqual(list(range(20)), sorted(calls[:-1]))
+        self.assertEqual('deferred', calls[-1])
+
+    def test_errors(self):
+        tasks = rsyncv2.RestoreTasks(2, 4)
+        try:
+            tasks.submit(os.unlink, '/nonexistent/freezer/file')
+            self.assertRaises(OSError, tasks.wait)
+        finally:
+            tasks.shutdown()
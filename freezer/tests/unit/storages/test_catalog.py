@@ -0,0 +1,161 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import mock
+
+from freezer.storage import base
+from freezer.storage import catalog
+from freezer.storage import local
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        super(TestCatalog, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.storage = local.LocalStorage(
+            os.path.join(self.tmpdir, 'storage'), 1024)
+        self.catalog = catalog.Catalog(
+            os.path.join(self.tmpdir, 'catalog', 'backups.db'))
+        self.storage.use_catalog(self.catalog)
+        self.engine = mock.Mock()
+        self.engine.name = 'tar'
+        for level_zero_timestamp, level, timestamp in (
+                (10, 0, 10), (10, 1, 11), (20, 0, 20), (20, 1, 21)):
+            self.write_backup(level_zero_timestamp, level, timestamp)
+
+    def backup(self, level_zero_timestamp, level, timestamp):
+        return base.Backup(
+            engine=self.engine, hostname_backup_name='host_backup',
+            level_zero_timestamp=level_zero_timestamp, timestamp=timestamp,
+            level=level, storage=self.storage)
+
+    def write_backup(self, level_zero_timestamp, level, timestamp):
+        backup = self.backup(level_zero_timestamp, level, timestamp)
+        os.makedirs(os.path.dirname(backup.metadata_path))
+        os.makedirs(backup.data_prefix_path)
+        with open(backup.metadata_path, 'w') as metadata_file:
+            metadata_file.write(json.dumps({'level': level}))
+        return backup
+
+    def test_listed_once(self):
+        with mock.patch.object(self.storage, 'listdir',
+                               wraps=self.storage.listdir) as listdir:
+            for _ in range(2):
+                increments = self.storage.get_latest_level_zero_increments(
+                    self.engine, 'host_backup')
+                self.assertEqual([(0, 20), (1, 21)], sorted(
+                    (level, backup.timestamp)
+                    for level, backup in increments.items()))
+            self.assertEqual(2, listdir.call_count)
+
+        increments = self.storage.get_latest_level_zero_increments(
+            self.engine, 'host_backup', recent_to_date=15)
+        self.assertEqual([0, 1], sorted(increments))
+        self.assertEqual(11, increments[1].timestamp)
+
+    def test_record_backup(self):
+        self.storage.get_latest_level_zero_increments(self.engine,
+                                                      'host_backup')
+        self.storage.record_backup(self.write_backup(20, 2, 22), 1234,
+                                   {'level': 2})
+        self.storage.record_backup(self.write_backup(30, 0, 30), 5678,
+                                   {'level': 0})
+        with mock.patch.object(self.storage, 'listdir') as listdir:
+            increments = self.storage.get_latest_level_zero_increments(
+                self.engine, 'host_backup', recent_to_date=25)
+            self.assertEqual(22, increments[2].timestamp)
+            increments = self.storage.get_latest_level_zero_increments(
+                self.engine, 'host_backup')
+            self.assertEqual([0], list(increments))
+            self.assertFalse(listdir.called)
+        self.assertIn((30, 0, 30, 5678), self.catalog.backups(
+            self.storage, 'tar', 'host_backup'))
+
+    def test_metadata_downloaded_once(self):
+        backup = self.backup(10, 1, 11)
+        with mock.patch.object(self.storage, 'get_file',
+                               wraps=self.storage.get_file) as get_file:
+            self.assertEqual({'level': 1}, backup.metadata())
+            self.assertEqual({'level': 1}, backup.metadata())
+            self.assertEqual(1, get_file.call_count)
+
+    def test_remove_older_than(self):
+        self.storage.remove_older_than(self.engine, 15, 'host_backup')
+        with mock.patch.object(self.storage, 'listdir') as listdir:
+            self.assertEqual([20], [
+                zero.timestamp for zero in self.storage.get_level_zero(
+                    self.engine, 'host_backup')])
+            self.assertFalse(listdir.called)
+        self.assertEqual([(20, 0, 20, None)],
+                         self.catalog.backups(self.storage, 'tar',
+                                              'host_backup'))
+
+    def test_sync_removes_missing_chains(self):
+        self.catalog.add(self.backup(5, 0, 5), 10)
+        self.storage.get_level_zero(self.engine, 'host_backup')
+        self.assertEqual([10, 20], self.catalog.level_zero_timestamps(
+            self.storage, 'tar', 'host_backup'))
+
+    def level_zero_timestamps(self):
+        return sorted(zero.timestamp for zero in self.storage.get_level_zero(
+            self.engine, 'host_backup'))
+
+    def test_listing_expires(self):
+        self.catalog.ttl = 60
+        self.assertEqual([10, 20], self.level_zero_timestamps())
+        # Written by another node
+        self.write_backup(30, 0, 30)
+        self.assertEqual([10, 20], self.level_zero_timestamps())
+        with mock.patch('freezer.storage.catalog.time.time',
+                        return_value=time.time() + 61):
+            self.assertEqual([10, 20, 30], self.level_zero_timestamps())
+            with mock.patch.object(self.storage, 'listdir') as listdir:
+                self.assertEqual([10, 20, 30], self.level_zero_timestamps())
+                self.assertFalse(listdir.called)
+
+    def test_missing_backup_expires_listing(self):
+        self.assertEqual([10, 20], self.level_zero_timestamps())
+        # Removed by another node
+        backup = self.backup(10, 1, 11)
+        shutil.rmtree(backup.increments_metadata_path)
+        shutil.rmtree(backup.increments_data_path)
+        self.assertEqual([10, 20], self.level_zero_timestamps())
+        self.assertRaises(Exception, backup.metadata)
+        self.assertEqual([20], self.level_zero_timestamps())
+        self.assertEqual([20], self.catalog.level_zero_timestamps(
+            self.storage, 'tar', 'host_backup'))
+
+    def test_upgrade_expires_listings(self):
+        path = os.path.join(self.tmpdir, 'catalog', 'v1.db')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE synced (storage TEXT NOT NULL, engine '
+                     'TEXT NOT NULL, name TEXT NOT NULL, '
+                     'level_zero_timestamp INTEGER NOT NULL, PRIMARY KEY '
+                     '(storage, engine, name, level_zero_timestamp))')
+        conn.execute('INSERT INTO synced VALUES (?, ?, ?, ?)',
+                     (self.storage.catalog_key(), 'tar', 'host_backup', 0))
+        conn.execute('PRAGMA user_version = 1')
+        conn.commit()
+        conn.close()
+        self.storage.use_catalog(catalog.Catalog(path, ttl=60))
+        self.assertEqual(None, self.storage.catalog.level_zero_timestamps(
+            self.storage, 'tar', 'host_backup'))
+        self.assertEqual([10, 20], self.level_zero_timestamps())
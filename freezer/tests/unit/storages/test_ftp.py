@@ -12,8 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import shutil
-import sys
+import socket
 import tempfile
 import unittest
 
@@ -83,6 +84,7 @@ class FtpStorageTestCase(unittest.TestCase):
         self.ftp_opt.ftp_remote_username = 'usrname'
         self.ftp_opt.ftp_remote_ip = '0.0.0.0'
         self.ftp_opt.ftp_port = 2121
+        self.ftp_opt.ftp_max_segment_size = 1024
         self.ftp_test_file_dir = None
         self.ftp_test_file_name = None
 
@@ -218,75 +220,120 @@ class FtpStorageTestCase(unittest.TestCase):
         self.assertTrue(mock_ftp.dir.called)
         self.assertTrue(mock_ftp.rmd.called)
 
-    @unittest.skipIf(sys.version_info.major == 3,
-                     'Not supported on python v 3.x')
     @patch("freezer.storage.ftp.BaseFtpStorage.create_dirs")
-    @patch("freezer.storage.ftp.BaseFtpStorage.put_file")
-    @patch("__builtin__.open")
     @patch('ftplib.FTP')
     def test_write_backup_FtpStorage(self, mock_ftp_constructor,
-                                     mock_open,
-                                     mock_put_file,
                                      mock_create_dirs):
+        mock_ftp = mock_ftp_constructor.return_value
+        uploaded = []
+        mock_ftp.storbinary.side_effect = (
+            lambda cmd, fp, blocksize, rest: uploaded.extend(
+                iter(lambda: fp.read(blocksize), b'')))
         ftpobj = self.create_ftpstorage_obj()
 
         rich_queue = mock.MagicMock()
-        rich_queue.get_messages = mock.MagicMock()
-        rich_queue.get_messages.return_value = ['1']
+        rich_queue.get_messages.return_value = [b'12', b'345']
 
         backup = mock.MagicMock()
-        backup.copy = mock.MagicMock()
         backup.copy.return_value = backup
-
-        path = 'fakepath'
-        backup.data_path = mock.MagicMock()
-        backup.data_path.return_value = path
-
-        b_file = mock.MagicMock()
-        b_file.write = mock.MagicMock()
-
-        mock_open = mock.MagicMock()
-        mock_open.return_value = b_file
+        backup.data_path = '/path/data'
 
         ftpobj.write_backup(rich_queue=rich_queue,
                             backup=backup)
-        self.assertTrue(mock_create_dirs.called)
-        self.assertTrue(mock_put_file.called)
+        mock_create_dirs.assert_called_with('/path')
+        self.assertEqual('STOR /path/data',
+                         mock_ftp.storbinary.call_args[0][0])
+        self.assertEqual(b'12345', b''.join(uploaded))
 
-    @unittest.skipIf(sys.version_info.major == 3,
-                     'Not supported on python v 3.x')
     @patch("freezer.storage.ftp.BaseFtpStorage.create_dirs")
-    @patch("freezer.storage.ftp.BaseFtpStorage.put_file")
-    @patch("__builtin__.open")
     @patch('ftplib.FTP')
     def test_add_stream_FtpStorage(self, mock_ftp_constructor,
-                                   mock_open,
-                                   mock_put_file,
                                    mock_create_dirs):
+        mock_ftp = mock_ftp_constructor.return_value
         ftpobj = self.create_ftpstorage_obj()
 
-        rich_queue = mock.MagicMock()
-        rich_queue.get_messages = mock.MagicMock()
-        rich_queue.get_messages.return_value = ['1']
-
         package_name = 'fakedir/fakename'
-        stream = ['fakestream']
-
-        backup = mock.MagicMock()
-        backup.copy = mock.MagicMock()
-        backup.copy.return_value = backup
-
-        b_file = mock.MagicMock()
-        b_file.write = mock.MagicMock()
-
-        mock_open = mock.MagicMock()
-        mock_open.return_value = b_file
+        stream = [b'fakestream']
 
         ftpobj.add_stream(stream=stream,
                           package_name=package_name)
 
         self.assertTrue(mock_create_dirs.called)
-        self.assertTrue(mock_put_file.called)
+        self.assertEqual(
+            ['STOR /just/a/path/fakedir/fakename/fakedir',
+             'STOR /just/a/path/fakedir/fakename/metadata'],
+            [call[0][0] for call in mock_ftp.storbinary.call_args_list])
+
+    @patch('ftplib.FTP')
+    def test_store_resumed_FtpStorage(self, mock_ftp_constructor):
+        mock_ftp = mock_ftp_constructor.return_value
+        uploaded = []
+
+        def storbinary(cmd, fp, blocksize, rest):
+            if rest is None:
+                uploaded.append(fp.read(3))
+                fp.read(3)
+                raise socket.error('connection reset')
+            uploaded.append(b''.join(iter(lambda: fp.read(blocksize), b'')))
+
+        mock_ftp.storbinary.side_effect = storbinary
+        mock_ftp.size.return_value = 3
+        ftpobj = self.create_ftpstorage_obj()
+        ftpobj._store('/path/data', [b'0123', b'4567', b'89'])
+        self.assertEqual(b'0123456789', b''.join(uploaded))
+        self.assertEqual(3, mock_ftp.storbinary.call_args[1]['rest'])
+        mock_ftp.size.assert_called_once_with('/path/data')
+
+    @patch('ftplib.FTP')
+    def test_store_stream_error_FtpStorage(self, mock_ftp_constructor):
+        mock_ftp = mock_ftp_constructor.return_value
+        mock_ftp.storbinary.side_effect = (
+            lambda cmd, fp, blocksize, rest: fp.read(blocksize))
+        ftpobj = self.create_ftpstorage_obj()
+
+        def stream():
+            raise socket.error('read error')
+            yield b''
+
+        self.assertRaises(socket.error, ftpobj._store, '/path/data',
+                          stream())
+        self.assertEqual(1, mock_ftp.storbinary.call_count)
+
+    @patch('ftplib.FTP')
+    def test_backup_blocks_resumed_FtpStorage(self, mock_ftp_constructor):
+        mock_ftp = mock_ftp_constructor.return_value
+        interrupted = io.BytesIO(b'01234')
+        interrupted.read = mock.Mock(side_effect=[b'0123', b'4',
+                                                  socket.error('reset')])
+        conns = [mock.Mock(spec=['makefile', 'close']),
+                 mock.Mock(spec=['makefile', 'close'])]
+        conns[0].makefile.return_value = interrupted
+        conns[1].makefile.return_value = io.BytesIO(b'56789')
+        mock_ftp.transfercmd.side_effect = conns
+        ftpobj = self.create_ftpstorage_obj()
+        ftpobj.max_segment_size = 4
+        backup = mock.Mock(data_path='/path/data')
+        self.assertEqual([b'0123', b'4', b'5678', b'9'],
+                         list(ftpobj.backup_blocks(backup)))
+        self.assertEqual([mock.call('RETR /path/data', rest=None),
+                          mock.call('RETR /path/data', rest=5)],
+                         mock_ftp.transfercmd.call_args_list)
+        self.assertEqual(1, mock_ftp.voidresp.call_count)
+
+    def test_stream_reader(self):
+        reader = ftp.StreamReader([b'012', b'', b'345', b'678'], window=4)
+        self.assertEqual(b'01', reader.read(2))
+        self.assertEqual(b'2', reader.read(4))
+        self.assertEqual(b'345', reader.read(4))
+        reader.seek(1)
+        self.assertEqual(b'12', reader.read(4))
+        self.assertEqual(b'345', reader.read())
+        self.assertEqual(b'678', reader.read())
+        self.assertRaises(IOError, reader.seek, 1)
+        reader.seek(4)
+        self.assertEqual(b'45', reader.read())
+        self.assertEqual(b'678', reader.read())
+        self.assertEqual(b'', reader.read())
 
 
 class FtpsStorageTestCase(unittest.TestCase):
@@ -12,11 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
+import os
 import shutil
 import tempfile
 import unittest
 
+import mock
+
+from freezer.storage import base
 from freezer.storage import local
+from freezer.utils import streaming
 from freezer.utils import utils
 
 
@@ -71,3 +77,54 @@ class TestLocalStorage(unittest.TestCase):
         backup_dir, files_dir, work_dir = self.create_dirs()
         storage = local.LocalStorage(backup_dir, work_dir, 10000)
         storage.info()
+
+    def test_read_range(self):
+        backup_dir, files_dir, work_dir = self.create_dirs()
+        storage = local.LocalStorage(backup_dir, 4)
+        path = files_dir + "/file_1"
+        self.assertEqual([b'o Wo', b'rl'],
+                         list(storage.read_range(path, 4, 6)))
+        self.assertEqual(b'World!\n',
+                         b''.join(storage.read_range(path, 6)))
+        self.remove_dirs(work_dir, files_dir, backup_dir)
+
+    def test_put_get_file(self):
+        backup_dir, files_dir, work_dir = self.create_dirs()
+        storage = local.LocalStorage(backup_dir, 4)
+        storage.put_file(files_dir + "/file_1", backup_dir + "/file_1")
+        storage.get_file(backup_dir + "/file_1", work_dir + "/file_1")
+        with open(work_dir + "/file_1") as copied_file:
+            self.assertEqual(self.HELLO, copied_file.read())
+        self.remove_dirs(work_dir, files_dir, backup_dir)
+
+    @mock.patch('freezer.storage.local._clone', return_value=False)
+    def test_copy_file_unsupported_kernel_copy(self, mock_clone):
+        backup_dir, files_dir, work_dir = self.create_dirs()
+        error = OSError(errno.EXDEV, 'Invalid cross-device link')
+        with mock.patch('freezer.storage.local._copy_file_range',
+                        side_effect=error), \
+                mock.patch('freezer.storage.local._sendfile',
+                           side_effect=error):
+            local.copy_file(files_dir + "/file_1", work_dir + "/file_1")
+        with open(work_dir + "/file_1") as copied_file:
+            self.assertEqual(self.HELLO, copied_file.read())
+        self.remove_dirs(work_dir, files_dir, backup_dir)
+
+    @mock.patch('freezer.storage.local.os.fdatasync', create=True)
+    def test_write_backup_blocks(self, mock_fdatasync):
+        backup_dir, files_dir, work_dir = self.create_dirs()
+        storage = local.LocalStorage(backup_dir, 4, sync_interval=5)
+        engine = mock.Mock()
+        engine.name = 'tar'
+        backup = base.Backup(engine, 'host_name', 1000, 1000, 0)
+        rich_queue = streaming.RichQueue(3)
+        rich_queue.put_messages([b'Hello', b' World', b'!'])
+        storage.write_backup(rich_queue, backup)
+        # Synced after 5 and 11 bytes, then when closing the file
+        self.assertEqual(3, mock_fdatasync.call_count)
+        backup = backup.copy(storage)
+        self.assertEqual(12, os.path.getsize(backup.data_path))
+        self.assertEqual([b'Hell', b'o Wo', b'rld!'],
+                         [bytes(block) for block in
+                          storage.backup_blocks(backup)])
+        self.remove_dirs(work_dir, files_dir, backup_dir)
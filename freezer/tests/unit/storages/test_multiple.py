@@ -0,0 +1,185 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from freezer.storage import base
+from freezer.storage import local
+from freezer.storage import multiple
+from freezer.utils import streaming
+
+
+class TestMultipleStorageReplication(unittest.TestCase):
+    def setUp(self):
+        super(TestMultipleStorageReplication, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.primary = local.LocalStorage(
+            os.path.join(self.tmpdir, 'primary'), 1024)
+        self.secondary = local.LocalStorage(
+            os.path.join(self.tmpdir, 'secondary'), 1024)
+        self.journal_path = os.path.join(self.tmpdir, 'replication.json')
+        self.storage = multiple.MultipleStorage(
+            [self.primary, self.secondary],
+            replication_mode=multiple.ASYNC_REPLICATION,
+            journal_path=self.journal_path)
+        self.engine = mock.Mock()
+        self.engine.name = 'tar'
+        self.engine_metadata = os.path.join(self.tmpdir, 'engine_metadata')
+        self.freezer_metadata = os.path.join(self.tmpdir, 'metadata')
+        for path in (self.engine_metadata, self.freezer_metadata):
+            with open(path, 'w') as metadata_file:
+                metadata_file.write('{}')
+
+    def store(self, level_zero_timestamp, level, timestamp, data):
+        backup = base.Backup(self.engine, 'host_name', level_zero_timestamp,
+                             timestamp, level)
+        rich_queue = streaming.RichQueue()
+        rich_queue.put(data)
+        rich_queue.finish()
+        self.storage.write_backup(rich_queue, backup)
+        self.storage.put_metadata(self.engine_metadata,
+                                  self.freezer_metadata, backup)
+        self.storage.record_backup(backup, len(data), {})
+        return backup
+
+    def read(self, storage, backup):
+        return b''.join(storage.backup_blocks(backup.copy(storage)))
+
+    def test_replicate(self):
+        backup = self.store(1000, 0, 1000, b'data')
+        self.storage.wait_replication()
+        self.assertEqual(b'data', self.read(self.secondary, backup))
+        increments = self.secondary.get_latest_level_zero_increments(
+            self.engine, 'host_name')
+        self.assertEqual([0], list(increments))
+        self.assertEqual([], self.storage.replicator.journal.jobs())
+
+    def test_replicate_without_waiting(self):
+        release = threading.Event()
+        write_backup = self.secondary.write_backup
+
+        def slow_write_backup(rich_queue, backup):
+            release.wait()
+            write_backup(rich_queue, backup)
+
+        with mock.patch.object(self.secondary, 'write_backup',
+                               side_effect=slow_write_backup):
+            backup = self.store(1000, 0, 1000, b'data')
+            self.assertEqual(1, self.storage.replicator.wait(block=False))
+            self.assertEqual(1, len(self.storage.replicator.journal.jobs()))
+            release.set()
+            self.storage.wait_replication()
+        self.assertEqual(b'data', self.read(self.secondary, backup))
+        self.assertEqual([], self.storage.replicator.journal.jobs())
+
+    def test_resume_failed_copy(self):
+        with mock.patch.object(self.secondary, 'write_backup',
+                               side_effect=Exception('offline')):
+            backup = self.store(1000, 0, 1000, b'data')
+            increment = self.store(1000, 1, 2000, b'more')
+            self.storage.wait_replication()
+        jobs = self.storage.replicator.journal.jobs()
+        self.assertEqual([0, 1], [job['level'] for job in jobs])
+        self.assertEqual([], self.secondary.listdir(
+            self.secondary.metadata_path(self.engine, 'host_name')))
+
+        self.storage = multiple.MultipleStorage(
+            [self.primary, self.secondary],
+            replication_mode=multiple.ASYNC_REPLICATION,
+            journal_path=self.journal_path)
+        self.store(3000, 0, 3000, b'new')
+        self.storage.wait_replication()
+        self.assertEqual(b'data', self.read(self.secondary, backup))
+        self.assertEqual(b'more', self.read(self.secondary, increment))
+        self.assertEqual([], self.storage.replicator.journal.jobs())
+
+    def test_resume_skips_done_steps(self):
+        with mock.patch.object(self.secondary, 'put_metadata',
+                               side_effect=Exception('offline')):
+            backup = self.store(1000, 0, 1000, b'data')
+            self.storage.wait_replication()
+        jobs = self.storage.replicator.journal.jobs()
+        self.assertEqual(['data', 'data_index'], jobs[0]['done'])
+
+        self.storage = multiple.MultipleStorage(
+            [self.primary, self.secondary],
+            replication_mode=multiple.ASYNC_REPLICATION,
+            journal_path=self.journal_path)
+        with mock.patch.object(self.secondary, 'write_backup') as write:
+            self.storage.replicator.resume(self.engine)
+            self.storage.wait_replication()
+        self.assertFalse(write.called)
+        self.assertEqual(['1000'], self.secondary.listdir(
+            self.secondary.metadata_path(self.engine, 'host_name')))
+        self.assertEqual(b'data', self.read(self.secondary, backup))
+
+    def test_latest_increments_fastest_replica(self):
+        self.store(1000, 0, 1000, b'data')
+        self.storage.wait_replication()
+        self.storage._latencies = {}
+        with mock.patch('freezer.storage.multiple.time.time',
+                        side_effect=[0, 0, 5, 1]):
+            with mock.patch(
+                    'freezer.storage.multiple.futures.ThreadPoolExecutor',
+                    return_value=SerialExecutor()):
+                increments = self.storage.get_latest_level_zero_increments(
+                    self.engine, 'host_name')
+        self.assertIs(self.secondary, increments[0].storage)
+
+    def test_latest_increments_most_recent_replica(self):
+        self.store(1000, 0, 1000, b'data')
+        self.storage.wait_replication()
+        with mock.patch.object(self.secondary, 'write_backup',
+                               side_effect=Exception('offline')):
+            self.store(1000, 1, 2000, b'more')
+            self.storage.wait_replication()
+        with mock.patch.object(self.secondary, 'get_level_zero',
+                               side_effect=Exception('offline')):
+            increments = self.storage.get_latest_level_zero_increments(
+                self.engine, 'host_name')
+        self.assertEqual([0, 1], sorted(increments))
+        increments = self.storage.get_latest_level_zero_increments(
+            self.engine, 'host_name')
+        self.assertEqual([0, 1], sorted(increments))
+        self.assertIs(self.primary, increments[1].storage)
+
+    def test_get_file_fallback(self):
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'w') as file_handle:
+            file_handle.write('content')
+        to_path = os.path.join(self.tmpdir, 'copy')
+        self.storage._latencies = {self.secondary: 0.1, self.primary: 0.5}
+        with mock.patch.object(self.secondary, 'get_file',
+                               side_effect=Exception('offline')):
+            self.storage.get_file(path, to_path)
+        with open(to_path) as file_handle:
+            self.assertEqual('content', file_handle.read())
+
+
+class SerialExecutor(object):
+    def submit(self, function, *args):
+        future = mock.Mock()
+        try:
+            future.result.return_value = function(*args)
+        except Exception as e:
+            future.result.side_effect = e
+        return future
+
+    def shutdown(self, wait=True):
+        pass
@@ -0,0 +1,177 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+import mock
+
+from freezer.storage import s3
+
+
+class TestS3Storage(unittest.TestCase):
+    def setUp(self):
+        super(TestS3Storage, self).setUp()
+        patcher = mock.patch('freezer.storage.s3.botocore.session')
+        self.mock_session = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = mock.Mock()
+        self.client.create_multipart_upload.return_value = {
+            'UploadId': 'upload-id'}
+        self.client.upload_part.side_effect = (
+            lambda **kwargs: {'ETag': 'etag-{0}'.format(kwargs['Body'])})
+        self.mock_session.get_session().create_client.return_value = \
+            self.client
+        self.paginate = self.client.get_paginator.return_value.paginate
+        self.storage = s3.S3Storage('access', 'secret', 'http://endpoint',
+                                    'bucket/prefix', 1024, skip_prepare=True,
+                                    upload_workers=3)
+
+    def test_client_cached(self):
+        create_client = self.mock_session.get_session().create_client
+        thread = threading.Thread(target=self.storage.get_s3_connection)
+        thread.start()
+        thread.join()
+        self.assertIs(self.client, self.storage.get_s3_connection())
+        self.assertEqual(1, create_client.call_count)
+        config = create_client.call_args[1]['config']
+        self.assertEqual(s3.MIN_POOL_CONNECTIONS, config.max_pool_connections)
+
+    def test_upload_stream(self):
+        self.storage.upload_stream('prefix/key', (str(i) for i in range(7)))
+        self.assertEqual(7, self.client.upload_part.call_count)
+        self.client.complete_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='prefix/key', UploadId='upload-id',
+            MultipartUpload={'Parts': [
+                {'PartNumber': i + 1, 'ETag': 'etag-{0}'.format(i)}
+                for i in range(7)]})
+
+    @mock.patch('freezer.storage.s3.time.sleep')
+    def test_upload_part_retry(self, mock_sleep):
+        self.client.upload_part.side_effect = [Exception('error'),
+                                               Exception('error'),
+                                               {'ETag': 'etag'}]
+        self.assertEqual({'PartNumber': 4, 'ETag': 'etag'},
+                         self.storage.upload_part('key', 'upload-id', 4,
+                                                  b'data'))
+        self.assertEqual(2, mock_sleep.call_count)
+        self.assertLessEqual(mock_sleep.call_args_list[1][0][0],
+                             2 * s3.RETRY_DELAY)
+
+    @mock.patch('freezer.storage.s3.time.sleep')
+    def test_upload_stream_failed_aborts(self, mock_sleep):
+        def stream():
+            yield b'0'
+            yield b'1'
+            raise Exception('read error')
+
+        self.assertRaises(Exception, self.storage.upload_stream,
+                          'prefix/key', stream())
+        self.assertEqual(2, self.client.upload_part.call_count)
+        self.client.abort_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='prefix/key', UploadId='upload-id')
+        self.assertFalse(self.client.complete_multipart_upload.called)
+
+    @mock.patch('freezer.storage.s3.time.sleep')
+    def test_upload_stream_failed_part_aborts(self, mock_sleep):
+        self.client.upload_part.side_effect = Exception('error')
+        self.client.abort_multipart_upload.side_effect = Exception('error')
+        self.assertRaises(Exception, self.storage.upload_stream,
+                          'prefix/key', iter([b'0']))
+        self.client.abort_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='prefix/key', UploadId='upload-id')
+
+    def test_backup_blocks_ranges(self):
+        self.storage = s3.S3Storage('access', 'secret', 'http://endpoint',
+                                    'bucket', 4, skip_prepare=True,
+                                    download_workers=3)
+        data = b'0123456789'
+        self.client.head_object.return_value = {'ContentLength': len(data)}
+
+        def get_object(Bucket, Key, Range):
+            start, end = Range[len('bytes='):].split('-')
+            body = mock.Mock()
+            body.read.return_value = data[int(start):int(end) + 1]
+            return {'Body': body}
+
+        self.client.get_object.side_effect = get_object
+        backup = mock.Mock(data_path='bucket/path/data')
+        self.assertEqual([b'0123', b'4567', b'89'],
+                         list(self.storage.backup_blocks(backup)))
+        self.assertEqual(['bytes=0-3', 'bytes=4-7', 'bytes=8-9'],
+                         sorted(call[1]['Range'] for call in
+                                self.client.get_object.call_args_list))
+
+    def test_rmtree_delete_objects(self):
+        keys = ['prefix/obj{0}'.format(i) for i in range(2500)]
+        self.paginate.return_value = [
+            {'Contents': [{'Key': key} for key in keys],
+             'IsTruncated': False}]
+        self.client.delete_objects.return_value = {}
+        self.storage.rmtree('bucket/prefix')
+        calls = self.client.delete_objects.call_args_list
+        self.assertEqual([1000, 1000, 500],
+                         [len(call[1]['Delete']['Objects'])
+                          for call in calls])
+        self.assertFalse(self.client.delete_object.called)
+
+        self.paginate.return_value = [
+            {'Contents': [{'Key': 'prefix/obj'}], 'IsTruncated': False}]
+        self.client.delete_objects.return_value = {
+            'Errors': [{'Key': 'prefix/obj', 'Message': 'Access Denied'}]}
+        self.assertRaises(Exception, self.storage.rmtree, 'bucket/prefix')
+
+    def test_rmtree_delete_objects_not_implemented(self):
+        self.paginate.return_value = [
+            {'Contents': [{'Key': 'prefix/a'}, {'Key': 'prefix/b'}],
+             'IsTruncated': False}]
+        self.client.delete_objects.side_effect = (
+            s3.botocore.exceptions.ClientError(
+                {'Error': {'Code': 'NotImplemented'}}, 'DeleteObjects'))
+        self.storage.rmtree('bucket/prefix')
+        self.assertEqual(
+            [mock.call(Bucket='bucket', Key='prefix/a'),
+             mock.call(Bucket='bucket', Key='prefix/b')],
+            self.client.delete_object.call_args_list)
+
+    def test_listdir_delimited(self):
+        self.paginate.return_value = [
+            {'CommonPrefixes': [{'Prefix': 'prefix/metadata/tar/1000/'},
+                                {'Prefix': 'prefix/metadata/tar/2000/'}]},
+            {'CommonPrefixes': [{'Prefix': 'prefix/metadata/tar/3000/'}],
+             'Contents': [{'Key': 'prefix/metadata/tar/file'}]}]
+        self.assertEqual(['1000', '2000', '3000', 'file'],
+                         self.storage.listdir('bucket/prefix/metadata/tar'))
+        self.client.get_paginator.assert_called_with('list_objects_v2')
+        self.paginate.assert_called_once_with(
+            Bucket='bucket', Prefix='prefix/metadata/tar/', Delimiter='/')
+
+    @mock.patch('freezer.storage.s3.time.time')
+    def test_listdir_cache(self, mock_time):
+        mock_time.return_value = 100
+        self.storage.listing_cache_ttl = 30
+        self.paginate.return_value = [
+            {'CommonPrefixes': [{'Prefix': 'prefix/a/'}]}]
+        self.assertEqual(['a'], self.storage.listdir('bucket/prefix'))
+        self.assertEqual(['a'], self.storage.listdir('bucket/prefix'))
+        self.assertEqual(1, self.paginate.call_count)
+
+        mock_time.return_value = 131
+        self.assertEqual(['a'], self.storage.listdir('bucket/prefix'))
+        self.assertEqual(2, self.paginate.call_count)
+
+        self.storage.put_file(__file__, 'bucket/prefix/b')
+        self.paginate.return_value = [
+            {'CommonPrefixes': [{'Prefix': 'prefix/a/'}],
+             'Contents': [{'Key': 'prefix/b'}]}]
+        self.assertEqual(['a', 'b'], self.storage.listdir('bucket/prefix'))
+        self.assertEqual(3, self.paginate.call_count)
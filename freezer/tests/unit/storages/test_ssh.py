@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+import mock
+
+from freezer.storage import ssh
+
+
+class FakeSftpFile(object):
+    def __init__(self, content):
+        self.content = content
+        self.position = 0
+        self.pipelined = False
+        self.closed = False
+
+    def set_pipelined(self, pipelined=True):
+        self.pipelined = pipelined
+
+    def seek(self, offset):
+        self.position = offset
+
+    def write(self, data):
+        end = self.position + len(data)
+        if len(self.content) < end:
+            self.content.extend(b'\0' * (end - len(self.content)))
+        self.content[self.position:end] = data
+        self.position = end
+
+    def readv(self, chunks):
+        for offset, length in chunks:
+            yield bytes(self.content[offset:offset + length])
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TestSshStorage(unittest.TestCase):
+    def setUp(self):
+        super(TestSshStorage, self).setUp()
+        patcher = mock.patch('freezer.storage.ssh.paramiko')
+        self.mock_paramiko = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.content = bytearray()
+        self.files = []
+        self.lock = threading.Lock()
+
+        def sftp_open(path, mode, bufsize):
+            with self.lock:
+                if mode == 'wb':
+                    del self.content[:]
+                sftp_file = FakeSftpFile(self.content)
+                self.files.append(sftp_file)
+                return sftp_file
+
+        self.sftp = self.mock_paramiko.SFTPClient.from_transport.return_value
+        self.sftp.open.side_effect = sftp_open
+        self.sftp.stat.side_effect = (
+            lambda path: mock.Mock(st_size=len(self.content)))
+        self.storage = ssh.SshStorage('/storage', 'user', 'host', 22, 4,
+                                      remote_pwd='secret', channels=3)
+        self.backup = mock.Mock(data_path='/storage/data')
+        self.backup.copy.return_value = self.backup
+
+    def test_sftp_window_size(self):
+        self.mock_paramiko.SFTPClient.from_transport.assert_called_with(
+            self.storage.ssh.get_transport(), window_size=ssh.WINDOW_SIZE)
+
+    def test_open_pipelined(self):
+        self.assertTrue(self.storage.open('/storage/file', 'wb').pipelined)
+
+    def test_write_backup_striped(self):
+        rich_queue = mock.Mock()
+        rich_queue.get_messages.return_value = [
+            b'0123', b'45', b'6789', b'abcd', b'e']
+        self.storage.write_backup(rich_queue, self.backup)
+        self.assertEqual(b'0123456789abcde', bytes(self.content))
+        # The created file and a file per channel
+        self.assertLessEqual(len(self.files), 4)
+        self.assertTrue(all(sftp_file.closed for sftp_file in self.files))
+
+    def test_write_backup_single_channel(self):
+        self.storage.channels = 1
+        rich_queue = mock.Mock()
+        rich_queue.get_messages.return_value = [b'0123', b'45']
+        self.storage.write_backup(rich_queue, self.backup)
+        self.assertEqual(b'012345', bytes(self.content))
+        self.assertEqual(1, len(self.files))
+        self.assertTrue(self.files[0].pipelined)
+
+    def test_backup_blocks(self):
+        self.content.extend(b'0123456789')
+        self.assertEqual([b'0123', b'4567', b'89'],
+                         list(self.storage.backup_blocks(self.backup)))
+        self.assertTrue(all(sftp_file.closed for sftp_file in self.files))
+
+    def test_transfers_close_channels(self):
+        clients = []
+
+        def from_transport(transport, window_size):
+            sftp = mock.Mock()
+            sftp.open.side_effect = self.sftp.open.side_effect
+            clients.append(sftp)
+            return sftp
+
+        self.mock_paramiko.SFTPClient.from_transport.side_effect = \
+            from_transport
+        rich_queue = mock.Mock()
+        rich_queue.get_messages.return_value = [b'0123', b'4567', b'89']
+        self.storage.write_backup(rich_queue, self.backup)
+        self.assertTrue(clients)
+        self.assertTrue(all(sftp.close.called for sftp in clients))
+        self.assertFalse(self.storage.ftp.close.called)
+        self.assertEqual([], self.storage._open_clients)
+
+        del clients[:]
+        self.storage.write_backup(rich_queue, self.backup)
+        self.assertTrue(clients)
+        self.assertTrue(all(sftp.close.called for sftp in clients))
+
+    def test_backup_blocks_single_channel(self):
+        self.storage.channels = 1
+        self.content.extend(b'0123456789')
+        opened = self.mock_paramiko.SFTPClient.from_transport.call_count
+        self.assertEqual([b'0123', b'4567', b'89'],
+                         list(self.storage.backup_blocks(self.backup)))
+        # The channel reopened by init only
+        self.assertEqual(
+            opened + 1,
+            self.mock_paramiko.SFTPClient.from_transport.call_count)
+        self.assertFalse(self.storage.ftp.close.called)
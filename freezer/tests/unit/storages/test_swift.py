@@ -0,0 +1,177 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import unittest
+
+import mock
+
+from freezer.storage import base
+from freezer.storage import swift
+
+
+class TestSwiftStorage(unittest.TestCase):
+    def setUp(self):
+        super(TestSwiftStorage, self).setUp()
+        self.connection = mock.Mock()
+        self.connection.put_object.side_effect = (
+            lambda container, obj, contents, **kwargs: 'etag-' + obj)
+        self.client_manager = mock.Mock()
+        self.client_manager.create_swift.return_value = self.connection
+        self.storage = swift.SwiftStorage(
+            self.client_manager, 'container', 1024, skip_prepare=True,
+            upload_workers=3)
+        engine = mock.Mock()
+        engine.name = 'rsync'
+        self.backup = base.Backup(
+            engine=engine, hostname_backup_name='backup',
+            level_zero_timestamp=1, timestamp=2, level=1,
+            storage=self.storage)
+
+    def test_swift_connection_reused(self):
+        self.storage.swift()
+        self.storage.swift()
+        self.assertEqual(1, self.client_manager.create_swift.call_count)
+        thread = threading.Thread(target=self.storage.swift)
+        thread.start()
+        thread.join()
+        self.assertEqual(2, self.client_manager.create_swift.call_count)
+
+    @mock.patch('freezer.storage.swift.time.sleep')
+    def test_upload_chunk_retry(self, mock_sleep):
+        self.connection.put_object.side_effect = [Exception('error'),
+                                                  Exception('error'),
+                                                  'etag']
+        self.assertEqual('etag',
+                         self.storage.upload_chunk(b'data', 'c/path/0'))
+        self.assertEqual(2, mock_sleep.call_count)
+        self.assertLessEqual(mock_sleep.call_args_list[1][0][0],
+                             2 * swift.RETRY_DELAY)
+        self.assertEqual(3, self.client_manager.create_swift.call_count)
+
+    @mock.patch('freezer.storage.swift.time.sleep')
+    def test_upload_chunk_fail(self, mock_sleep):
+        self.connection.put_object.side_effect = Exception('error')
+        self.assertRaises(Exception, self.storage.upload_chunk, b'data',
+                          'c/path/0')
+        self.assertEqual(swift.UPLOAD_RETRIES,
+                         self.connection.put_object.call_count)
+
+    def test_write_backup(self):
+        rich_queue = mock.Mock()
+        rich_queue.get_messages.return_value = [b'a' * 5, b'b' * 5, b'c']
+        self.storage.write_backup(rich_queue, self.backup)
+        calls = self.connection.put_object.call_args_list
+        self.assertEqual(4, len(calls))
+        self.assertEqual(
+            ['00000000', '00000001', '00000002'],
+            sorted(call[0][1] for call in calls[:3]))
+        self.assertEqual({'x-object-manifest': self.backup.segments_path},
+                         calls[3][1]['headers'])
+
+    def test_write_backup_slo(self):
+        self.storage.slo = True
+        rich_queue = mock.Mock()
+        rich_queue.get_messages.return_value = [b'a' * 5, b'b']
+        self.storage.write_backup(rich_queue, self.backup)
+        manifest_call = self.connection.put_object.call_args_list[-1]
+        self.assertEqual('multipart-manifest=put',
+                         manifest_call[1]['query_string'])
+        segments_path = self.backup.segments_path
+        self.assertEqual(
+            [{'path': '/' + segments_path + '/00000000',
+              'etag': 'etag-00000000',
+              'size_bytes': 5},
+             {'path': '/' + segments_path + '/00000001',
+              'etag': 'etag-00000001',
+              'size_bytes': 1}],
+            json.loads(manifest_call[1]['contents']))
+
+    def test_backup_blocks_segments(self):
+        self.storage.download_workers = 2
+        self.connection.head_object.return_value = {
+            'x-object-manifest': 'container_segments/path/segments',
+            'content-length': '7'}
+        self.connection.get_container.return_value = (
+            {}, [{'name': 'path/segments/{0:08d}'.format(i), 'bytes': 2}
+                 for i in range(3)] +
+            [{'name': 'path/segments/00000003', 'bytes': 1}])
+        self.connection.get_object.side_effect = (
+            lambda container, obj, **kwargs: ({}, obj[-1:].encode()))
+        self.assertEqual([b'0', b'1', b'2', b'3'],
+                         list(self.storage.backup_blocks(self.backup)))
+        self.connection.get_container.assert_called_once_with(
+            'container_segments', prefix='path/segments', full_listing=True)
+
+    def test_backup_blocks_incomplete_listing(self):
+        self.storage.download_workers = 2
+        self.connection.head_object.return_value = {
+            'x-object-manifest': 'container_segments/path/segments',
+            'content-length': '7'}
+        self.connection.get_container.return_value = (
+            {}, [{'name': 'path/segments/00000000', 'bytes': 2}])
+        self.connection.get_object.return_value = ({}, [b'abc', b'defg'])
+        self.assertEqual([b'abc', b'defg'],
+                         list(self.storage.backup_blocks(self.backup)))
+        self.connection.get_object.assert_called_once_with(
+            'container', mock.ANY, resp_chunk_size=1024)
+
+    def test_backup_blocks_slo(self):
+        self.storage.download_workers = 3
+        self.connection.head_object.return_value = {
+            'x-static-large-object': 'True'}
+        manifest = json.dumps([
+            {'name': '/container_segments/path/{0:08d}'.format(i),
+             'bytes': 1} for i in range(5)])
+        self.connection.get_object.side_effect = (
+            lambda container, obj, **kwargs:
+            ({}, manifest) if kwargs else ({}, obj[-1:].encode()))
+        self.assertEqual([b'0', b'1', b'2', b'3', b'4'],
+                         list(self.storage.backup_blocks(self.backup)))
+
+    def test_rmtree_bulk_delete(self):
+        self.storage.delete_workers = 2
+        self.connection.get_capabilities.return_value = {
+            'bulk_delete': {'max_deletes_per_request': 2}}
+        self.connection.get_container.return_value = (
+            {}, [{'name': 'path/obj {0}'.format(i)} for i in range(5)])
+        self.connection.post_account.return_value = (
+            {}, json.dumps({'Response Status': '200 OK', 'Errors': []}))
+        self.storage.rmtree('container/path')
+        self.assertEqual(3, self.connection.post_account.call_count)
+        data = sorted(call[1]['data'] for call in
+                      self.connection.post_account.call_args_list)
+        self.assertEqual('/container/path/obj%200\n/container/path/obj%201',
+                         data[0])
+        self.assertFalse(self.connection.delete_object.called)
+
+        self.connection.post_account.return_value = (
+            {}, json.dumps({'Response Status': '400 Bad Request',
+                            'Errors': [['/container/path/obj 0',
+                                        '409 Conflict']]}))
+        self.assertRaises(Exception, self.storage.rmtree, 'container/path')
+
+    def test_rmtree_without_bulk_delete(self):
+        self.connection.get_capabilities.return_value = {}
+        self.connection.get_container.return_value = (
+            {}, [{'name': 'path/a'}, {'name': 'path/b'}])
+        not_found = Exception('not found')
+        not_found.http_status = 404
+        self.connection.delete_object.side_effect = [not_found, None]
+        self.storage.rmtree('container/path')
+        self.connection.get_container.assert_called_once_with(
+            'container', prefix='path', full_listing=True)
+        self.assertEqual([mock.call('container', 'path/a'),
+                          mock.call('container', 'path/b')],
+                         self.connection.delete_object.call_args_list)
+        self.assertFalse(self.connection.post_account.called)
@@ -61,6 +61,20 @@ class TestBackupJob(TestJob):
         self.assertRaises(Exception, job.execute)  # noqa
 
 
+class TestRestoreJob(TestJob):
+    def setUp(self):
+        super(TestRestoreJob, self).setUp()
+
+    def test_path_filter_not_supported(self):
+        backup_opt = commons.BackupOpt1()
+        backup_opt.no_incremental = False
+        backup_opt.restore_path_filter = 'etc/*'
+        backup_opt.engine = mock.MagicMock(supports_path_filter=False)
+        self.assertRaises(ValueError, jobs.RestoreJob, backup_opt,
+                          backup_opt.storage)
+        self.assertFalse(backup_opt.engine.restore.called)
+
+
 class TestAdminJob(TestJob):
     def setUp(self):
         super(TestAdminJob, self).setUp()
@@ -69,6 +83,26 @@ class TestAdminJob(TestJob):
         backup_opt = commons.BackupOpt1()
         jobs.AdminJob(backup_opt, backup_opt.storage).execute()
 
+    def test_execute_synthetic_full(self):
+        backup_opt = commons.BackupOpt1()
+        backup_opt.synthetic_full = True
+        backup_opt.remove_older_than = None
+        backup_opt.remove_from_date = None
+        backup_opt.engine = mock.MagicMock()
+        jobs.AdminJob(backup_opt, backup_opt.storage).execute()
+        backup_opt.engine.synthetic_backup.assert_called_once_with(
+            backup_opt.hostname_backup_name)
+
+    def test_synthetic_full_not_supported(self):
+        backup_opt = commons.BackupOpt1()
+        backup_opt.synthetic_full = True
+        backup_opt.engine = mock.MagicMock(supports_synthetic=False)
+        backup_opt.storage = mock.MagicMock()
+        self.assertRaises(ValueError, jobs.AdminJob, backup_opt,
+                          backup_opt.storage)
+        self.assertFalse(backup_opt.storage.mock_calls)
+        self.assertFalse(backup_opt.engine.synthetic_backup.called)
+
 
 class TestExecJob(TestJob):
     def setUp(self):
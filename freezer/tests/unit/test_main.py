@@ -0,0 +1,40 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import mock
+
+from freezer.common import config
+from freezer import main
+
+
+class TestStorageFromDict(unittest.TestCase):
+    def setUp(self):
+        super(TestStorageFromDict, self).setUp()
+        patcher = mock.patch('freezer.storage.s3.botocore.session')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_multiple_storage_section_defaults(self):
+        # A storage section of the multiple storages only holds the options
+        # it sets
+        storage = main.storage_from_dict(
+            {'storage': 's3', 'container': 'bucket/path',
+             'access_key': 'access', 'secret_key': 'secret',
+             'endpoint': 'http://endpoint', 'download_workers': '8'},
+            1024)
+        self.assertEqual(config.DEFAULT_PARAMS['upload_workers'],
+                         storage.upload_workers)
+        self.assertEqual(config.DEFAULT_PARAMS['delete_workers'],
+                         storage.delete_workers)
+        self.assertEqual(8, storage.download_workers)
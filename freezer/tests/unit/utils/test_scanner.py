@@ -0,0 +1,121 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from freezer.utils import scanner
+
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        super(TestScanner, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        for dir_path in ('a/b', 'a/skip/c', 'd'):
+            os.makedirs(os.path.join(self.tmpdir, dir_path))
+        for file_path in ('f1', 'a/f2', 'a/b/f3', 'a/skip/f4', 'd/f5.skip'):
+            with open(os.path.join(self.tmpdir, file_path), 'w') as fd:
+                fd.write(file_path)
+        os.symlink('a', os.path.join(self.tmpdir, 'link'))
+
+    def tearDown(self):
+        super(TestScanner, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def scan(self, **kwargs):
+        result = []
+        for dir_path, dirs, files in scanner.walk(self.tmpdir, **kwargs):
+            dirs.sort(key=lambda entry: entry.name)
+            result.append((os.path.relpath(dir_path, self.tmpdir),
+                           [entry.name for entry in dirs],
+                           sorted(entry.name for entry in files)))
+        return result
+
+    def walk(self, **kwargs):
+        result = []
+        for dir_path, dirs, files in os.walk(self.tmpdir, **kwargs):
+            dirs.sort()
+            result.append((os.path.relpath(dir_path, self.tmpdir),
+                           dirs, sorted(files)))
+        return result
+
+    def test_walk_as_os_walk(self):
+        self.assertEqual(self.walk(), self.scan())
+        self.assertEqual(self.walk(followlinks=True),
+                         self.scan(follow_links=True))
+
+    def test_walk_exclude(self):
+        self.assertEqual([('.', ['a', 'd', 'link'], ['f1']),
+                          ('a', ['b'], ['f2']),
+                          ('a/b', [], ['f3']),
+                          ('d', [], [])],
+                         self.scan(exclude='*skip'))
+
+    def test_walk_workers(self):
+        self.assertEqual(self.scan(), self.scan(workers=4))
+
+    def test_walk_entry_stat(self):
+        for dir_path, dirs, files in scanner.walk(self.tmpdir):
+            for entry in dirs + files:
+                self.assertEqual(os.lstat(entry.path),
+                                 entry.stat(follow_symlinks=False))
+
+    def test_walk_missing_dir(self):
+        self.assertEqual(
+            [], list(scanner.walk(os.path.join(self.tmpdir, 'missing'))))
+
+    def test_listdir_entry(self):
+        entry = scanner.ListdirEntry(self.tmpdir, 'link')
+        self.assertEqual(os.path.join(self.tmpdir, 'link'), entry.path)
+        self.assertTrue(entry.is_symlink())
+        self.assertTrue(entry.is_dir())
+        self.assertFalse(entry.is_dir(follow_symlinks=False))
+        self.assertFalse(scanner.ListdirEntry(self.tmpdir, 'f1').is_dir())
+        self.assertTrue(scanner.ListdirEntry(self.tmpdir, 'f1').is_file())
+
+    @mock.patch.dict(scanner._user_names, clear=True)
+    @mock.patch('freezer.utils.scanner.pwd')
+    def test_get_user_name(self, mock_pwd):
+        mock_pwd.getpwuid.return_value = ['user', 'x', 12345]
+        self.assertEqual('user', scanner.get_user_name(12345))
+        self.assertEqual('user', scanner.get_user_name(12345))
+        mock_pwd.getpwuid.assert_called_once_with(12345)
+
+        mock_pwd.getpwuid.side_effect = KeyError
+        self.assertRaises(KeyError, scanner.get_user_name, 12346)
+        self.assertRaises(KeyError, scanner.get_user_name, 12346)
+        self.assertEqual(2, mock_pwd.getpwuid.call_count)
+
+    @mock.patch.dict(scanner._group_names, clear=True)
+    @mock.patch('freezer.utils.scanner.grp')
+    def test_get_group_name(self, mock_grp):
+        mock_grp.getgrgid.return_value = ['group', 'x', 12345]
+        self.assertEqual('group', scanner.get_group_name(12345))
+        self.assertEqual('group', scanner.get_group_name(12345))
+        mock_grp.getgrgid.assert_called_once_with(12345)
+
+    @mock.patch.dict(scanner._user_ids, clear=True)
+    @mock.patch.dict(scanner._group_ids, clear=True)
+    @mock.patch('freezer.utils.scanner.grp')
+    @mock.patch('freezer.utils.scanner.pwd')
+    def test_get_owner_ids(self, mock_pwd, mock_grp):
+        mock_pwd.getpwnam.return_value = ['user', 'x', 1000, 1000]
+        mock_grp.getgrnam.return_value = ['group', 'x', 2000, []]
+        for _ in range(2):
+            self.assertEqual(1000, scanner.get_user_id('user'))
+            self.assertEqual(2000, scanner.get_group_id('group'))
+        mock_pwd.getpwnam.assert_called_once_with('user')
+        mock_grp.getgrnam.assert_called_once_with('group')
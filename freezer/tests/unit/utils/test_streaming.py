@@ -0,0 +1,157 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+import six
+
+from freezer.utils import streaming
+
+
+class TestChunkReader(unittest.TestCase):
+    def setUp(self):
+        super(TestChunkReader, self).setUp()
+        self.chunks = [b'abc', b'', b'defgh', b'i']
+
+    def test_read(self):
+        reader = streaming.ChunkReader(iter(self.chunks))
+        self.assertEqual(b'ab', reader.read(2))
+        self.assertEqual(b'cdefg', reader.read(5))
+        self.assertEqual(b'hi', reader.read())
+        self.assertEqual(b'', reader.read(1))
+
+    def test_readinto(self):
+        reader = streaming.ChunkReader(self.chunks)
+        buf = bytearray(4)
+        self.assertEqual(4, reader.readinto(buf))
+        self.assertEqual(b'abcd', bytes(buf))
+        self.assertEqual(4, reader.readinto(buf))
+        self.assertEqual(b'efgh', bytes(buf))
+        self.assertEqual(1, reader.readinto(buf))
+        self.assertEqual(b'i', bytes(buf[:1]))
+        self.assertEqual(0, reader.readinto(buf))
+
+    def test_read_chunk_unread(self):
+        reader = streaming.ChunkReader(self.chunks)
+        self.assertEqual(b'abc', bytes(reader.read_chunk()))
+        reader.unread(b'c')
+        self.assertEqual(b'cde', reader.read(3))
+        self.assertEqual(b'fgh', bytes(reader.read_chunk()))
+        self.assertEqual(b'i', bytes(reader.read_chunk()))
+        self.assertEqual(b'', reader.read_chunk())
+
+    def test_write_to(self):
+        reader = streaming.ChunkReader(self.chunks)
+        out = six.BytesIO()
+        reader.write_to(out, 7)
+        self.assertEqual(b'abcdefg', out.getvalue())
+        self.assertRaises(EOFError, reader.write_to, out, 3)
+
+    def test_skip(self):
+        reader = streaming.ChunkReader(self.chunks)
+        reader.skip(0)
+        reader.skip(4)
+        self.assertEqual(b'ef', reader.read(2))
+        reader.skip(2)
+        self.assertRaises(EOFError, reader.skip, 2)
+
+
+class TestSegmentBuilder(unittest.TestCase):
+    def test_add(self):
+        segments = streaming.SegmentBuilder(4)
+        self.assertEqual([], segments.add(b'ab'))
+        self.assertEqual(2, segments.held_bytes)
+        self.assertEqual([b'abcd', b'efgh', b'ijkl'],
+                         segments.add(b'cdefghijklm'))
+        self.assertEqual(1, segments.held_bytes)
+        self.assertEqual([], segments.add(b''))
+        self.assertEqual([b'mnop'], segments.add(b'nop'))
+        self.assertEqual(0, segments.held_bytes)
+
+    def test_flush(self):
+        segments = streaming.SegmentBuilder(4)
+        self.assertEqual(b'', segments.flush())
+        segments.add(b'abcdef')
+        self.assertEqual(b'ef', segments.flush())
+        self.assertEqual(0, segments.held_bytes)
+        self.assertEqual(b'', segments.flush())
+
+    def test_segment_sizes(self):
+        data = bytes(bytearray(range(256))) * 10
+        segments = streaming.SegmentBuilder(100)
+        result = []
+        for offset in range(0, len(data), 37):
+            result.extend(segments.add(data[offset:offset + 37]))
+        self.assertTrue(all(len(segment) == 100 for segment in result))
+        result.append(segments.flush())
+        self.assertEqual(data, b''.join(result))
+
+
+class TestBlockPipe(unittest.TestCase):
+    pipe_class = streaming.BlockPipe
+
+    def setUp(self):
+        super(TestBlockPipe, self).setUp()
+        self.pipe = self.pipe_class()
+        self.addCleanup(self.pipe.close)
+
+    def recv_level(self):
+        blocks = []
+        try:
+            while True:
+                blocks.append(self.pipe.recv_bytes())
+        except EOFError:
+            pass
+        return blocks
+
+    def test_levels(self):
+        self.pipe.send_bytes(b'abc')
+        self.pipe.send_bytes(b'')
+        self.pipe.send_bytes(memoryview(b'def'))
+        self.pipe.end_level()
+        self.pipe.end_level()
+        self.pipe.send_bytes(b'ghi')
+        self.pipe.end_level()
+        self.pipe.close_write_end()
+        self.assertEqual([b'abc', b'def'], self.recv_level())
+        # The end of a level is reported until the next level is read
+        self.assertRaises(EOFError, self.pipe.recv_bytes)
+        self.pipe.skip_level()
+        self.assertEqual([], self.recv_level())
+        self.pipe.skip_level()
+        self.assertEqual([b'ghi'], self.recv_level())
+        self.pipe.skip_level()
+        self.assertRaises(EOFError, self.pipe.recv_bytes)
+
+    def test_skip_level(self):
+        self.pipe.send_bytes(b'abc')
+        self.pipe.send_bytes(b'def')
+        self.pipe.end_level()
+        self.pipe.send_bytes(b'ghi')
+        self.pipe.end_level()
+        self.assertEqual(b'abc', self.pipe.recv_bytes())
+        self.pipe.skip_level()
+        self.assertEqual([b'ghi'], self.recv_level())
+
+
+@unittest.skipUnless(hasattr(streaming.os, 'fork'), 'os.pipe with fork')
+class TestFdBlockPipe(TestBlockPipe):
+    pipe_class = streaming.FdBlockPipe
+
+    def test_recv_bytearray(self):
+        # The blocks are returned in the buffer they are read into
+        self.pipe.send_bytes(b'abc')
+        block = self.pipe.recv_bytes()
+        self.assertIsInstance(block, bytearray)
+        self.assertEqual(b'abc', block)
+        block += b'def'
+        self.assertEqual(b'abcdef', block)
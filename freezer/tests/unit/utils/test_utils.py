@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent import futures
 import datetime
 import fixtures
 import os
@@ -26,6 +27,7 @@ from mock import patch
 from freezer.exceptions import utils as exception_utils
 from freezer.openstack import osclients
 from freezer.tests import commons
+from freezer.utils import scanner
 from freezer.utils import utils
 
 
@@ -145,14 +147,19 @@ class TestUtils(commons.FreezerBaseTestCase):
         assert utils.exclude_path('./a/b', 'c') is False
         assert utils.exclude_path('./a/b/c', '') is False
 
-    @patch('freezer.utils.utils.os.walk')
+    @patch('freezer.utils.utils.scanner.walk')
     @patch('freezer.utils.utils.os.chdir')
     @patch('freezer.utils.utils.os.path.isfile')
     def test_walk_path_dir(self, mock_isfile, mock_chdir, mock_walk):
         mock_isfile.return_value = False
         mock_chdir.return_value = None
-        mock_walk.return_value = [('.', ['d1', 'd2'], ['f1', 'f2']),
-                                  ('./d1', [], ['f3']), ('./d2', [], []), ]
+
+        def entries(dir_path, *names):
+            return [scanner.ListdirEntry(dir_path, name) for name in names]
+
+        mock_walk.return_value = [
+            ('.', entries('.', 'd1', 'd2'), entries('.', 'f1', 'f2')),
+            ('./d1', [], entries('./d1', 'f3')), ('./d2', [], []), ]
         expected = ['.', './f1', './f2', './d1', './d1/f3', './d2']
         files = []
         count = utils.walk_path('root', '', False, self.callback, files=files)
@@ -169,6 +176,39 @@ class TestUtils(commons.FreezerBaseTestCase):
     def callback(self, filepath='', files=[]):
         files.append(filepath)
 
+    def test_imap_ordered_no_executor(self):
+        res = utils.imap_ordered(None, lambda x: x * 2, range(5), 2)
+        self.assertEqual([0, 2, 4, 6, 8], list(res))
+
+    def test_imap_ordered(self):
+        def slow_first(x):
+            if x == 0:
+                time.sleep(0.1)
+            return x * 2
+
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            res = utils.imap_ordered(executor, slow_first, range(10), 4)
+            self.assertEqual([x * 2 for x in range(10)], list(res))
+
+    def test_imap_ordered_max_pending(self):
+        submitted = []
+        executor = mock.MagicMock()
+        executor.submit.side_effect = lambda func, item: (
+            submitted.append(item) or mock.Mock(result=lambda: func(item)))
+        res = utils.imap_ordered(executor, lambda x: x, range(10), 3)
+        self.assertEqual(0, next(res))
+        self.assertEqual([0, 1, 2], submitted)
+
+    def test_bytes_to_long(self):
+        self.assertEqual(0, utils.bytes_to_long(b''))
+        self.assertEqual(0x030201, utils.bytes_to_long(b'\x01\x02\x03'))
+        self.assertEqual(1, utils.bytes_to_long(bytearray(b'\x01\x00')))
+
+    def test_long_to_bytes(self):
+        self.assertEqual(b'\x01\x02\x03\x00',
+                         utils.long_to_bytes(0x030201, 4))
+        self.assertEqual(b'', utils.long_to_bytes(0, 0))
+
 
 class TestDateTime(object):
     def setup(self):
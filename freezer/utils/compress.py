@@ -81,17 +81,34 @@ class Compressor(BaseCompressor):
     def flush(self):
         return self.compressobj.flush()
 
+    def full_flush(self):
+        """Flush the pending data and reset the compression state, so that
+        the data compressed afterwards can be decompressed on its own by a
+        raw Decompressor.
+
+        :return: compressed data or None if the algorithm does not support
+                 it
+        """
+        if self.algo != GZIP:
+            return None
+        return self.compressobj.flush(self.module.Z_FULL_FLUSH)
+
 
 class Decompressor(BaseCompressor):
     """
     Decompress chucks of data.
     """
 
-    def __init__(self, compression_algo):
+    def __init__(self, compression_algo, raw=False):
+        """
+        :param compression_algo: compression algorithm
+        :param raw: decompress the data following a full flush of the
+                    compressor instead of a whole stream
+        """
         super(Decompressor, self).__init__(compression_algo)
-        self.decompressobj = self.create_decompressobj(compression_algo)
+        self.decompressobj = self.create_decompressobj(compression_algo, raw)
 
-    def create_decompressobj(self, compression_algo):
+    def create_decompressobj(self, compression_algo, raw=False):
         def get_obj_name():
             names = {
                 'gzip': 'decompressobj',
@@ -101,6 +118,12 @@ class Decompressor(BaseCompressor):
             return names.get(compression_algo)
 
         obj_name = get_obj_name()
+        if raw:
+            if self.algo != GZIP:
+                raise NotImplementedError(
+                    'Raw decompression not supported by {0}'.format(
+                        compression_algo))
+            return self.module.decompressobj(-self.module.MAX_WBITS)
         return getattr(self.module, obj_name)()
 
     def decompress(self, data):
@@ -0,0 +1,204 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Filesystem tree scanner shared by the engines and the consistency check.
+
+The directories are listed with os.scandir: the type of an entry is
+usually known from the directory listing itself and its lstat result is
+cached on the entry, so every file is stat'ed at most once per scan. The
+names of the owners are looked up once per uid and gid, and their ids once
+per name on restore.
+"""
+
+import fnmatch
+import os
+import stat
+
+from concurrent import futures
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    # Not available on Windows
+    grp = None
+    pwd = None
+
+_user_names = {}
+_group_names = {}
+_user_ids = {}
+_group_ids = {}
+
+
+class ListdirEntry(object):
+    """Minimal os.DirEntry for the python versions without os.scandir.
+
+    The lstat result is cached like os.DirEntry does.
+    """
+
+    def __init__(self, dir_path, name):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            return os.stat(self.path)
+        return self._lstat
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def scandir(dir_path):
+    """List the entries of a directory.
+
+    :param dir_path: path of the directory
+    :return: list of os.DirEntry like objects
+    """
+    if hasattr(os, 'scandir'):
+        return list(os.scandir(dir_path))
+    return [ListdirEntry(dir_path, name) for name in os.listdir(dir_path)]
+
+
+def _prefetch_stat(entry):
+    try:
+        entry.stat(follow_symlinks=False)
+    except OSError:
+        # Raised again when the caller stats the entry
+        pass
+
+
+def walk(top, exclude=None, follow_links=False, workers=1):
+    """Walk the tree rooted at top, yielding the directories top-down in
+    the same order as os.walk.
+
+    The excluded directories are not scanned at all. As with os.walk, the
+    caller can sort or remove items of the yielded dirs list to change the
+    order of the scan or to skip some subtrees, and the directories that
+    cannot be listed are ignored.
+
+    :param top: path of the directory to scan
+    :param exclude: fnmatch pattern of the names of the entries to skip
+    :param follow_links: descend into the symbolic links to directories
+    :param workers: number of threads used to stat the entries of a
+                    directory, useful on high latency filesystems
+    :return: generator of tuples (dir_path, dirs, files) where dirs and
+             files are lists of os.DirEntry like objects
+    """
+    executor = None
+    if workers > 1:
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+
+    try:
+        pending = [top]
+        while pending:
+            dir_path = pending.pop()
+            try:
+                entries = scandir(dir_path)
+            except OSError:
+                continue
+
+            dirs = []
+            files = []
+            for entry in entries:
+                if exclude and fnmatch.fnmatch(entry.name, exclude):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry)
+                else:
+                    files.append(entry)
+
+            if executor:
+                list(executor.map(_prefetch_stat, dirs + files))
+
+            yield dir_path, dirs, files
+
+            for entry in reversed(dirs):
+                if follow_links or not entry.is_symlink():
+                    pending.append(entry.path)
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+
+
+def _cached_lookup(cache, key, lookup, kind):
+    try:
+        value = cache[key]
+    except KeyError:
+        try:
+            value = lookup(key)
+        except KeyError:
+            value = None
+        cache[key] = value
+    if value is None:
+        raise KeyError('{0} not found: {1}'.format(kind, key))
+    return value
+
+
+def get_user_name(uid):
+    """Return the name of the user, looking it up once per uid.
+
+    :param uid: user id
+    :raises KeyError: when the user does not exist
+    """
+    return _cached_lookup(_user_names, uid,
+                          lambda key: pwd.getpwuid(key)[0], 'uid')
+
+
+def get_group_name(gid):
+    """Return the name of the group, looking it up once per gid.
+
+    :param gid: group id
+    :raises KeyError: when the group does not exist
+    """
+    return _cached_lookup(_group_names, gid,
+                          lambda key: grp.getgrgid(key)[0], 'gid')
+
+
+def get_user_id(name):
+    """Return the id of the user, looking it up once per name.
+
+    :param name: user name
+    :raises KeyError: when the user does not exist
+    """
+    return _cached_lookup(_user_ids, name,
+                          lambda key: pwd.getpwnam(key)[2], 'user name')
+
+
+def get_group_id(name):
+    """Return the id of the group, looking it up once per name.
+
+    :param name: group name
+    :raises KeyError: when the group does not exist
+    """
+    return _cached_lookup(_group_ids, name,
+                          lambda key: grp.getgrnam(key)[2], 'group name')
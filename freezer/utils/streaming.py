@@ -17,14 +17,34 @@
 Freezer general utils functions
 """
 
+import collections
+import io
+import multiprocessing
+import os
+import struct
+import sys
 import threading
 
 from oslo_log import log
+import six
 from six.moves import queue
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
 
 LOG = log.getLogger(__name__)
 
+# Length of a block of a BlockPipe
+_FRAME_HEADER = struct.Struct('!Q')
+# fcntl resizing a pipe, Linux only
+F_SETPIPE_SZ = 1031
+# Size requested for the buffer of the pipes, the default maximum of Linux
+PIPE_BUFFER_SIZE = 1024 * 1024
+
 
 class Wait(Exception):
     pass
@@ -43,6 +63,8 @@ class RichQueue(object):
         # transmission changes in atomic way so no synchronization needed
         self.finish_transmission = False
         self.is_force_stop = False
+        # Number of bytes put on the queue
+        self.transmitted_bytes = 0
 
     def finish(self):
         self.finish_transmission = True
@@ -81,6 +103,7 @@ class RichQueue(object):
                 break
             except queue.Full:
                 self.check_stop()
+        self.transmitted_bytes += len(message)
 
     def get_messages(self):
         while self.has_more():
@@ -117,3 +140,317 @@ class QueuedThread(threading.Thread):
             # Thread will exit at this point.
             # @todo print the error using traceback.print_exc(file=sys.stdout)
             raise
+
+
+class SegmentBuilder(object):
+    """Assemble data blocks in segments of exactly segment_size bytes.
+
+    The blocks are kept as they are received and joined once per segment,
+    so every byte is copied at most twice whatever the size of the blocks.
+    """
+    def __init__(self, segment_size):
+        """
+        :param segment_size: size in bytes of the segments
+        """
+        self.segment_size = segment_size
+        self._blocks = collections.deque()
+        # bytes of the first block already emitted
+        self._offset = 0
+        self._held_bytes = 0
+
+    @property
+    def held_bytes(self):
+        """Number of bytes buffered and not yet emitted."""
+        return self._held_bytes
+
+    def add(self, data):
+        """Buffer data and return the completed segments.
+
+        :param data: bytes
+        :return: list of segments of segment_size bytes
+        """
+        if data:
+            self._blocks.append(data)
+            self._held_bytes += len(data)
+
+        segments = []
+        while self._held_bytes >= self.segment_size:
+            segments.append(self._pop(self.segment_size))
+        return segments
+
+    def flush(self):
+        """Return the buffered data, shorter than segment_size.
+
+        :return: bytes, empty if nothing is buffered
+        """
+        return self._pop(self._held_bytes)
+
+    def _pop(self, size):
+        pieces = []
+        remaining = size
+        while remaining:
+            block = self._blocks[0]
+            available = len(block) - self._offset
+            if available <= remaining:
+                pieces.append(block[self._offset:] if self._offset else block)
+                self._blocks.popleft()
+                self._offset = 0
+                remaining -= available
+            else:
+                pieces.append(block[self._offset:self._offset + remaining])
+                self._offset += remaining
+                remaining = 0
+        self._held_bytes -= size
+        return b''.join(pieces)
+
+
+class ChunkReader(io.RawIOBase):
+    """File like reader over a generator of data chunks.
+
+    The chunks are kept in a deque of memoryviews and are never joined:
+    reads copy the data once into the caller buffer and write_to passes
+    slices of the chunks straight to the destination file.
+    """
+    def __init__(self, chunks):
+        """
+        :param chunks: iterable of bytes like objects
+        """
+        super(ChunkReader, self).__init__()
+        self._chunks = iter(chunks)
+        self._buffers = collections.deque()
+
+    def readable(self):
+        return True
+
+    def _next_buffer(self):
+        """Return the first buffered memoryview, pulling a new chunk from the
+        generator if needed, or None when the data is exhausted.
+        """
+        while not self._buffers:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                return None
+            if len(chunk):
+                self._buffers.append(memoryview(chunk))
+        return self._buffers[0]
+
+    def _consume(self, size):
+        buf = self._buffers[0]
+        if size < len(buf):
+            self._buffers[0] = buf[size:]
+        else:
+            self._buffers.popleft()
+
+    def readinto(self, b):
+        """Fill b with the next bytes of the stream.
+
+        :param b: writable bytes like object
+        :return: number of bytes read, less than len(b) only at the end of
+                 the data
+        """
+        out = memoryview(b).cast('B') if six.PY3 else memoryview(b)
+        size = len(out)
+        pos = 0
+        while pos < size:
+            buf = self._next_buffer()
+            if buf is None:
+                break
+            length = min(len(buf), size - pos)
+            out[pos:pos + length] = buf[:length]
+            self._consume(length)
+            pos += length
+        return pos
+
+    def read_chunk(self):
+        """Return the next buffered piece of data, b'' at the end of the
+        data.
+        """
+        buf = self._next_buffer()
+        if buf is None:
+            return b''
+        self._buffers.popleft()
+        return buf
+
+    def unread(self, data):
+        """Push data back in front of the stream.
+
+        :param data: bytes like object
+        """
+        if len(data):
+            self._buffers.appendleft(memoryview(data))
+
+    def write_to(self, fd, size):
+        """Write the next size bytes of the stream to fd.
+
+        :param fd: file object open for writing
+        :param size: number of bytes to write
+        :raise EOFError: if the stream holds less than size bytes
+        """
+        while size:
+            buf = self._next_buffer()
+            if buf is None:
+                raise EOFError('Data stream truncated, {0} bytes '
+                               'missing'.format(size))
+            length = min(len(buf), size)
+            fd.write(buf[:length])
+            self._consume(length)
+            size -= length
+
+    def skip(self, size):
+        """Discard the next size bytes of the stream.
+
+        :param size: number of bytes to discard
+        :raise EOFError: if the stream holds less than size bytes
+        """
+        while size:
+            buf = self._next_buffer()
+            if buf is None:
+                raise EOFError('Data stream truncated, {0} bytes '
+                               'missing'.format(size))
+            length = min(len(buf), size)
+            self._consume(length)
+            size -= length
+
+
+class BlockPipe(object):
+    """One way pipe carrying the blocks of data of the levels of a backup
+    between two processes.
+
+    An empty block ends a level: recv_bytes raises EOFError at the end of
+    every level until skip_level is called, then returns the blocks of the
+    next level. The same pipe, and the same processes, serve all the levels
+    of a restore.
+
+    This implementation is based on multiprocessing.Pipe and works with all
+    the start methods of the processes.
+    """
+
+    def __init__(self):
+        self._reader, self._writer = multiprocessing.Pipe(duplex=False)
+        # The end of the current level has been read
+        self._level_ended = False
+
+    def _send(self, data):
+        self._writer.send_bytes(data)
+
+    def _recv(self):
+        return self._reader.recv_bytes()
+
+    def close_read_end(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def close_write_end(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def close(self):
+        self.close_read_end()
+        self.close_write_end()
+
+    def send_bytes(self, block):
+        """:param block: bytes like object, the empty blocks are dropped"""
+        if len(block):
+            self._send(block)
+
+    def end_level(self):
+        self._send(b'')
+
+    def recv_bytes(self):
+        """
+        :return: the next block of the level
+        :raises EOFError: at the end of the level or of the pipe
+        """
+        if self._level_ended:
+            raise EOFError()
+        try:
+            block = self._recv()
+        except EOFError:
+            self._level_ended = True
+            raise
+        if not len(block):
+            self._level_ended = True
+            raise EOFError()
+        return block
+
+    def skip_level(self):
+        """Discard the rest of the current level and move to the next one"""
+        try:
+            while True:
+                self.recv_bytes()
+        except EOFError:
+            pass
+        self._level_ended = False
+
+
+class FdBlockPipe(BlockPipe):
+    """BlockPipe over an os.pipe, for the processes started by fork.
+
+    Every block is preceded by its length. The blocks are written with their
+    header in a single writev call, straight from the buffer of the caller,
+    and read with readinto in a bytearray of their size which is returned
+    as is, without another copy.
+    """
+
+    def __init__(self):
+        read_fd, self._write_fd = os.pipe()
+        if fcntl is not None and sys.platform.startswith('linux'):
+            try:
+                fcntl.fcntl(self._write_fd, F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+            except (IOError, OSError):
+                # Above the maximum size allowed by the system
+                pass
+        self._read_file = io.open(read_fd, 'rb', buffering=0)
+        self._level_ended = False
+
+    def _send(self, data):
+        header = _FRAME_HEADER.pack(len(data))
+        if hasattr(os, 'writev'):
+            written = os.writev(self._write_fd, [header, data])
+            if written == len(header) + len(data):
+                return
+        else:
+            written = 0
+        remaining = memoryview(header + bytes(data))[written:]
+        while len(remaining):
+            remaining = remaining[os.write(self._write_fd, remaining):]
+
+    def _read_into(self, buf):
+        view = memoryview(buf)
+        while len(view):
+            read = self._read_file.readinto(view)
+            if not read:
+                raise EOFError()
+            view = view[read:]
+
+    def _recv(self):
+        header = bytearray(_FRAME_HEADER.size)
+        self._read_into(header)
+        data = bytearray(_FRAME_HEADER.unpack(bytes(header))[0])
+        self._read_into(data)
+        return data
+
+    def close_read_end(self):
+        if self._read_file is not None:
+            self._read_file.close()
+            self._read_file = None
+
+    def close_write_end(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+
+def block_pipe():
+    """Create the BlockPipe fitting the start method of the processes.
+
+    :rtype: BlockPipe
+    """
+    if os.name == 'posix':
+        get_start_method = getattr(multiprocessing, 'get_start_method', None)
+        if get_start_method is None or get_start_method() == 'fork':
+            return FdBlockPipe()
+    return BlockPipe()
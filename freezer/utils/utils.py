@@ -18,6 +18,8 @@
 Freezer general utils functions
 """
 
+import binascii
+import collections
 import datetime
 import errno
 import fnmatch as fn
@@ -29,8 +31,10 @@ import time
 
 from distutils import spawn as distspawn
 from freezer.exceptions import utils
+from freezer.utils import scanner
 from functools import wraps
 from oslo_log import log
+import six
 from six.moves import configparser
 
 logging.getLogger('botocore').setLevel(logging.WARNING)
@@ -421,7 +425,8 @@ def walk_path(path, exclude, ignorelinks, callback, *kargs, **kwargs):
         return execute_walk_callback(count, path, callback, *kargs, **kwargs)
 
     os.chdir(path)
-    for root, dirs, files in os.walk('.', topdown=True, followlinks=True):
+    # The excluded directories are skipped by the scanner with their content
+    for root, dirs, files in scanner.walk('.', exclude, follow_links=True):
         if not exclude_path(root, exclude):
             count = execute_walk_callback(count, root,
                                           callback, *kargs, **kwargs)
@@ -429,8 +434,8 @@ def walk_path(path, exclude, ignorelinks, callback, *kargs, **kwargs):
             if os.path.islink(root) and ignorelinks:
                 break
 
-            for fname in files:
-                f = os.path.join(root, fname)
+            for entry in files:
+                f = os.path.join(root, entry.name)
                 if not exclude_path(f, exclude):
                     count = execute_walk_callback(count, f,
                                                   callback, *kargs, **kwargs)
@@ -560,3 +565,84 @@ def wait_for(condition_func, wait_interval, timeout, message=None, kwargs={}):
         timeout -= wait_interval
 
     raise utils.TimeoutException(message)
+
+
+def imap_ordered(executor, func, iterable, max_pending):
+    """
+    Apply func to every item of iterable using the provided executor.
+    No more than max_pending calls are submitted ahead of the consumer and
+    the results are yielded in the same order of the iterable items.
+    If executor is None the calls are executed in the current thread.
+    :param executor: concurrent.futures executor or None
+    :param func: callable accepting one item
+    :param iterable: items to process
+    :param max_pending: max number of calls in flight
+    :return: generator of results
+    """
+    if executor is None:
+        for item in iterable:
+            yield func(item)
+        return
+
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def bytes_to_long(data):
+    """
+    Convert little endian bytes to a long, in linear time.
+    :param data: bytes or bytearray
+    :rtype: long
+    """
+    if six.PY3:
+        return int.from_bytes(data, 'little')
+    return int(binascii.hexlify(bytes(data[::-1])) or b'0', 16)
+
+
+def long_to_bytes(value, length):
+    """
+    Convert a long to length little endian bytes, in linear time.
+    :param value: non negative long lower than 2 ** (8 * length)
+    :param length: number of bytes
+    :rtype: bytes
+    """
+    if six.PY3:
+        return value.to_bytes(length, 'little')
+    return binascii.unhexlify('%0*x' % (length * 2, value))[::-1]
+
+
+def data_extents(fd, start, end):
+    """Yield the (offset, length) data ranges of a file between start and
+    end, skipping the holes of sparse files. The whole range is yielded
+    when the holes cannot be found.
+
+    :param fd: file descriptor
+    :param start: first offset
+    :param end: offset following the range
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        if start < end:
+            yield start, end - start
+        return
+
+    offset = start
+    while offset < end:
+        try:
+            data_offset = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                # Only a hole up to the end of the file
+                return
+            yield offset, end - offset
+            return
+        if data_offset >= end:
+            return
+        hole_offset = min(os.lseek(fd, data_offset, os.SEEK_HOLE), end)
+        yield data_offset, hole_offset - data_offset
+        offset = hole_offset